@@ -0,0 +1,453 @@
+import os, io, csv, json, time, random, pickle, sqlite3, shutil, threading, zlib
+import numpy as np
+from collections import deque
+from urllib.parse import urlparse, parse_qs, quote
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from taxutilities import *
+
+''' Offline fixtures for benchmarks.py: a synthetic NCBI taxa.sqlite, an IPNI csv sample,
+    saved scraper pages, and a stub HTTP server standing in for MediaWiki, POTWO and eFloras.
+    Everything is generated from fixed seeds, so every run and every commit sees the same data
+'''
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Real names given to lineages of the synthetic taxonomy, so benchmarks can look them up by name
+fixtureNames = {'order': ['Pinales', 'Rosales', 'Fabales'],
+                'family': ['Pinaceae', 'Rosaceae', 'Fabaceae'],
+                'genus': ['Abies', 'Rosa', 'Astragalus'],
+                'species': ['Abies alba', 'Rosa canina', 'Astragalus alpinus']}
+
+def fixturePath(*names):
+    return os.path.join(fixtures, *names)
+
+# ------------------------------
+# SYNTHETIC NCBI DATABASE
+
+''' Builds a random taxonomy shaped like NCBI's, down to species: most children are at the next major rank,
+    some at an intermediate rank or with no rank, and a few are unclassified or environmental samples.
+    Clades are grown depth first, so the ones that fit in size are complete. Lineages from the
+    largest orders down to species are renamed after fixtureNames '''
+def fixtureTree(size=20000, seed=1):
+    ranks = data['ranks']
+    major = [ranks.index(rank) for rank in ('superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')]
+    rng = random.Random(seed)
+
+    t = Tree(name='1')
+    t.add_features(sci_name='root', rank='no rank')
+    stack = [(t, -1, None)]
+    count = 1
+    while stack and count < size:
+        parent, depth, genus = stack.pop()
+        for i in range(rng.randint(1, 4)):
+            if count >= size:
+                break
+            count += 1
+
+            nextMajor = min(rank for rank in major if rank > depth)
+            rank = 'no rank'
+            if rng.random() < 0.1:
+                childDepth = depth
+            elif rng.random() < 0.25 and nextMajor - depth > 1:
+                childDepth = rng.randint(depth + 1, nextMajor - 1)
+            else:
+                childDepth = nextMajor
+            if childDepth != depth:
+                rank = ranks[childDepth]
+
+            luck = rng.random()
+            if luck < 0.01:
+                name = f'unclassified {parent.sci_name}'
+            elif luck < 0.015:
+                name = 'environmental samples'
+            elif genus is not None and childDepth >= major[-1]:
+                name = f'{genus} sp{count}'
+            else:
+                name = f'Taxon{count}'
+
+            child = parent.add_child(name=str(count))
+            child.add_features(sci_name=name, rank=rank)
+            if childDepth < major[-1]:
+                stack.append((child, childDepth, name if childDepth == major[-2] else genus))
+
+    orders = sorted((node for node in t.traverse() if node.rank == 'order'), key=lambda node: -len(node))
+    for i, order in enumerate(orders[:len(fixtureNames['order'])]):
+        lineage = [order]
+        for rank in ('family', 'genus', 'species'):
+            lineage.append(next((node for node in lineage[-1].traverse('preorder') if node.rank == rank), lineage[-1]))
+        for node, rank in zip(lineage, fixtureNames):
+            if node.rank == rank:
+                node.sci_name = fixtureNames[rank][i]
+    return t
+
+''' Writes the fixture tree as an ete3 taxa.sqlite, with the same tables as one built by
+    NCBITaxa.update_taxonomy_database and its traverse pickle, returns the database path '''
+def buildTaxaDB(path=None, size=20000, seed=1):
+    path = path or fixturePath('taxa.sqlite')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+
+    t = fixtureTree(size, seed)
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE stats (version INT PRIMARY KEY);
+        CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
+        CREATE TABLE synonym (taxid INT, spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid));
+        CREATE TABLE merged (taxid_old INT, taxid_new INT);
+        CREATE INDEX spname1 ON species (spname COLLATE NOCASE);
+        CREATE INDEX spname2 ON synonym (spname COLLATE NOCASE);
+        INSERT INTO stats VALUES (2);
+    ''')
+
+    rows = []
+    for node in t.traverse():
+        track = [node.name] + [ancestor.name for ancestor in node.iter_ancestors()]
+        rows.append((int(node.name), int(node.up.name) if node.up else 1, node.sci_name, '', node.rank, ','.join(track)))
+    db.executemany('INSERT INTO species VALUES (?, ?, ?, ?, ?, ?)', rows)
+    db.commit()
+    db.close()
+
+    writeTraverse(t, path)
+    return path
+
+# Writes the pre and postorder taxid list ete3 keeps next to taxa.sqlite for get_descendant_taxa
+def writeTraverse(t, path):
+    with open(path + '.traverse.pkl', 'wb') as f:
+        pickle.dump([int(node.name) for post, node in t.iter_prepostorder()], f, 2)
+
+''' Applies the kind of changes an NCBI update brings to a fixture taxa.sqlite: renames species
+    and moves genera to other families, rewriting the tracks of the moved subtrees and the traverse pickle '''
+def mutateTaxaDB(path, changes=10, seed=2):
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+
+    species = [taxid for (taxid,) in db.execute("SELECT taxid FROM species WHERE rank = 'species'")]
+    for taxid in rng.sample(species, changes):
+        db.execute("UPDATE species SET spname = spname || ' nov.' WHERE taxid = ?", (taxid,))
+
+    genera = db.execute("SELECT taxid, track FROM species WHERE rank = 'genus'").fetchall()
+    families = db.execute("SELECT taxid, track FROM species WHERE rank = 'family'").fetchall()
+    for (taxid, track), (family, familyTrack) in zip(rng.sample(genera, changes), rng.sample(families, changes)):
+        db.execute('UPDATE species SET parent = ? WHERE taxid = ?', (family, taxid))
+        db.execute("UPDATE species SET track = substr(track, 1, length(track) - length(?)) || ? WHERE (',' || track) LIKE ?",
+                   (track, f'{taxid},{familyTrack}', f'%,{track}'))
+    db.commit()
+
+    nodes = {}
+    for taxid, parent in db.execute('SELECT taxid, parent FROM species ORDER BY taxid'):
+        node = nodes.setdefault(taxid, Tree(name=str(taxid)))
+        if taxid != parent:
+            nodes.setdefault(parent, Tree(name=str(parent))).add_child(node)
+    db.close()
+    writeTraverse(nodes[1], path)
+    return path
+
+# ------------------------------
+# SAVED FIXTURES
+
+# LSID given to a synthetic taxid in the IPNI sample and the POTWO stub
+def fixtureLSID(taxid):
+    return f'urn:lsid:ipni.org:names:{taxid}-1'
+
+# Writes an IPNI csv sample in the GBIF dataset's column layout, for the families, genera and species of the named orders
+def writeIPNISample(path=None, size=20000):
+    path = path or fixturePath('ipni.csv')
+    ranks = {'family': 'fam.', 'genus': 'gen.', 'species': 'spec.'}
+
+    sample = []
+    for order in fixtureTree(size).traverse():
+        if order.rank == 'order' and order.sci_name in fixtureNames['order']:
+            for node in order.traverse():
+                if node.rank in ranks:
+                    sample.append([fixtureLSID(node.name), node.sci_name, 'Author', ranks[node.rank], '', '', '', '', '1900', 'Citation', '', ''])
+
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(sample)
+    return path
+
+# Distribution regions listed on the stub POTWO page of an LSID, None for about a quarter of LSIDs
+def fixtureRegions(lsid):
+    seed = zlib.crc32(lsid.encode())
+    if seed % 4 == 0:
+        return
+    return [f'Region{(seed >> shift) % 350}' for shift in range(0, 20, 4)]
+
+def potwoPage(lsid):
+    regions = fixtureRegions(lsid)
+    listing = ''
+    if regions is not None:
+        # POTWO separates regions with CRLF line breaks, written as character references since parsers normalize raw CRLF to LF
+        listing = '<div id="distribution-listing"><h3>Native to:</h3><p>' + ', &#13;\n              &#13;\n              '.join(regions) + '</p></div>'
+    return f'<html><head><title>{lsid}</title></head><body><div class="c-article">{listing}</div></body></html>'
+
+''' Rows of the stub eFloras browse pages: 25 families, each with 3 genera of 4 species.
+    Pages hold 10 rows and link to every other page of the same taxon in their pager '''
+browseSize = 10
+
+def browseRows(start=None):
+    if start is None:
+        return [(str(100 + i), f'Fam{i}aceae', True) for i in range(25)]
+    start = int(start)
+    if 100 <= start < 200:
+        return [(str(start), 'Fam', True)] + [(str(start * 10 + j), f'Gen{start}x{j}', True) for j in range(3)]
+    if 1000 <= start < 2000:
+        return [(str(start), 'Gen', True)] + [(str(start * 10 + k), f'Gen{start} sp{k}', False) for k in range(4)]
+    return []
+
+def browsePage(start=None, page=1, flora=1):
+    rows = browseRows(start)
+    pageRows = rows[(page - 1) * browseSize:page * browseSize]
+    if not pageRows:
+        return '<html><body><div id="ucBrowse">No taxa found</div></body></html>'
+
+    pageCount = (len(rows) + browseSize - 1) // browseSize
+    pager = ''.join(f'<a href="browse.aspx?flora_id={flora}&amp;page={number}">{number}</a> ' for number in range(1, pageCount + 1))
+    table = ''.join(f'<tr class="underline"><td class="small">{taxon}</td><td><a href="florataxon.aspx?taxon_id={taxon}">{name}</a>'
+                    + (f' <a title="lower taxa" href="browse.aspx?start_taxon_id={taxon}">lower</a>' if lower else '')
+                    + '</td></tr>' for taxon, name, lower in pageRows)
+    return f'<html><body><table id="ucFloraTaxonList">{table}</table>{pager if pageCount > 1 else ""}</body></html>'
+
+''' Stub MediaWiki pageimages response for the given titles. About two thirds of titles have a thumbnail
+    hosted by the stub, at most 20 thumbnails are returned per response with a continue token for the rest '''
+def wikiResponse(titles, size, base, offset=0, perResponse=20):
+    pages = {}
+    thumbnails = []
+    for i, title in enumerate(titles):
+        pages[str(-i - 1)] = {'ns': 0, 'title': title, 'missing': ''}
+        if zlib.crc32(title.encode()) % 3:
+            thumbnails.append(str(-i - 1))
+
+    for page in thumbnails[offset:offset + perResponse]:
+        title = pages[page]['title'].replace(' ', '_')
+        pages[page] = {'pageid': -int(page), 'ns': 0, 'title': pages[page]['title'],
+                       'thumbnail': {'source': f'{base}/images/thumb/{quote(title)}.jpg/{size}px-{quote(title)}.jpg', 'width': size, 'height': size * 3 // 4}}
+
+    response = {'batchcomplete': '', 'query': {'pages': pages}}
+    if offset + perResponse < len(thumbnails):
+        response = {'continue': {'picontinue': str(offset + perResponse), 'continue': '||'}, 'query': {'pages': pages}}
+    return response
+
+# Small JPEG served for a stub thumbnail, the same image for the same path
+def stubImage(path, size=200):
+    from PIL import Image
+    seed = zlib.crc32(path.encode())
+    image = Image.new('RGB', (size, size * 3 // 4), ((seed >> 16) % 256, (seed >> 8) % 256, seed % 256))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+''' Zip archive served by the stub GBIF route, laid out like a GBIF dataset export: an IPNI style csv split over
+    two members next to its metadata. Each version has different rows, so a download resumed across versions shows.
+    The 'empty' archive only has the metadata, 'corrupt' is not a zip at all '''
+def datasetArchive(name='ipni', version=1, rows=40000):
+    if name == 'corrupt':
+        return b'PK not a zip archive ' * 1000
+
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w', ZIP_DEFLATED) as archive:
+        archive.writestr(ZipInfo('eml.xml', (2020, 1, 1, 0, 0, 0)), f'<eml version="{version}"/>')
+        if name != 'empty':
+            rng = random.Random(version)
+            for part in range(2):
+                lines = ''.join(f'{fixtureLSID(part * rows + i)},Taxon{rng.randrange(10 ** 9)},Author,spec.,,,,,1900,Citation,,\n' for i in range(rows))
+                archive.writestr(ZipInfo(f'{name}/part{part}.csv', (2020, 1, 1, 0, 0, 0)), lines)
+    return buffer.getvalue()
+
+''' Writes a stand-in for the WGSRPD level 3 GeoJSON: regions named like fixtureRegions on a grid over
+    the world, as jagged outlines of many points. Some are multipolygons with an island, and one has
+    a hole holding an enclave region, so simplification and hole filling are both exercised '''
+def writeRegions(path, regions=369, points=2000, seed=1):
+    rng = np.random.default_rng(seed)
+    columns = 24
+    width, height = 360 / columns, 170 / ((regions + columns - 1) // columns)
+
+    def outline(lon, lat, radius, count):
+        angles = np.linspace(0, 2 * np.pi, count)
+        radii = radius * (1 + 0.15 * rng.standard_normal(count).cumsum() / np.sqrt(count))
+        ring = np.column_stack((lon + radii * np.cos(angles), lat + 0.8 * radii * np.sin(angles)))
+        ring[-1] = ring[0]
+        return ring.round(5).tolist()
+
+    features = []
+    for i in range(regions - 1):
+        lon = -180 + (i % columns + 0.5) * width
+        lat = 85 - (i // columns + 0.5) * height
+        polygons = [[outline(lon, lat, 0.4 * min(width, height), points)]]
+        if i == 0:
+            polygons[0].append(outline(lon, lat, 0.1 * min(width, height), points // 4)[::-1])
+        elif i % 10 == 0:
+            polygons.append([outline(lon + 0.35 * width, lat + 0.35 * height, 0.05 * width, points // 10)])
+        features.append({'type': 'Feature', 'properties': {'LEVEL3_NAM': f'Region{i}', 'LEVEL3_COD': f'R{i:02d}'},
+                         'geometry': {'type': 'MultiPolygon' if len(polygons) > 1 else 'Polygon',
+                                      'coordinates': polygons if len(polygons) > 1 else polygons[0]}})
+
+    enclave = outline(-180 + 0.5 * width, 85 - 0.5 * height, 0.1 * min(width, height), points // 4)
+    features.append({'type': 'Feature', 'properties': {'LEVEL3_NAM': 'Enclave', 'LEVEL3_COD': 'ENC'},
+                     'geometry': {'type': 'Polygon', 'coordinates': [enclave]}})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return path
+
+''' Writes the saved fixtures: the IPNI csv sample, an eFloras browse page, a POTWO taxon page
+    and a MediaWiki pageimages response. The synthetic taxa.sqlite is built separately by buildTaxaDB
+    since it is too large to keep in the repository '''
+def writeFixtures():
+    os.makedirs(fixtures, exist_ok=True)
+    writeIPNISample()
+    pages = {'efloras_browse.html': browsePage(),
+             'potwo_taxon.html': potwoPage(fixtureLSID(5)),
+             'wiki_pageimages.json': json.dumps(wikiResponse(sum(fixtureNames.values(), []), 200, 'http://127.0.0.1'), indent=1)}
+    for name, page in pages.items():
+        with open(fixturePath(name), 'w', newline='') as f:
+            f.write(page)
+
+def readFixture(name):
+    with open(fixturePath(name), newline='') as f:
+        return f.read()
+
+# ------------------------------
+# STUB HTTP SERVER
+
+# Last-Modified date of every stub page, pages never change
+stubModified = 'Sat, 01 Jan 2022 00:00:00 GMT'
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        server = self.server
+
+        if url.path == '/stats':
+            return self.send(json.dumps(server.counts).encode(), 'application/json')
+        if url.path == '/control':
+            with server.lock:
+                if 'cutoff' in query:
+                    server.cutoff = int(query['cutoff'])
+                if 'datasetVersion' in query:
+                    server.datasetVersion = int(query['datasetVersion'])
+                state = {'cutoff': server.cutoff, 'datasetVersion': server.datasetVersion, 'sent': server.sent, 'notModified': server.notModified}
+            return self.send(json.dumps(state).encode(), 'application/json')
+
+        time.sleep(server.latency)
+        route = url.path.split('/')[1]
+        with server.lock:
+            server.counts[route] = server.counts.get(route, 0) + 1
+            number = sum(server.counts.values())
+
+        if route == 'w':
+            if server.maxlag and number % server.maxlag == 0:
+                body = json.dumps({'error': {'code': 'maxlag', 'info': 'Waiting for a database server'}}).encode()
+                return self.send(body, 'application/json', {'Retry-After': '0'})
+            titles = query.get('titles', '').split('|')
+            response = wikiResponse(titles, int(query.get('pithumbsize', 200)), server.url, int(query.get('picontinue', 0)))
+            self.send(json.dumps(response).encode(), 'application/json')
+        elif route == 'images':
+            size = int(url.path.rsplit('/', 1)[-1].split('px-')[0]) if 'px-' in url.path else 200
+            self.send(stubImage(url.path, size), 'image/jpeg')
+        elif route == 'efloras':
+            page = browsePage(query.get('start_taxon_id'), int(query.get('page', 1)), query.get('flora_id', 1))
+            self.send(page.encode(), 'text/html; charset=utf-8')
+        elif route == 'potwo':
+            self.send(potwoPage(url.path.rsplit('/', 1)[-1]).encode(), 'text/html; charset=utf-8')
+        elif route == 'gbif':
+            self.sendDataset(url.path.rsplit('/', 1)[-1].replace('.zip', ''))
+        else:
+            self.send(b'Not found', 'text/plain', status=404)
+
+    ''' Serves a dataset archive with an ETag, answering Range requests with 206 unless If-Range names another version.
+        When the server has a cutoff set, the response is cut off after that many bytes, once, like a dropped connection '''
+    def sendDataset(self, name):
+        server = self.server
+        body = datasetArchive(name, server.datasetVersion)
+        etag = f'"{name}-{server.datasetVersion}"'
+        extra = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+
+        status = 200
+        requested = self.headers.get('Range', '')
+        if requested.startswith('bytes=') and self.headers.get('If-Range', etag) == etag:
+            start = int(requested[len('bytes='):].split('-')[0])
+            if start >= len(body):
+                return self.send(b'', 'application/zip', {**extra, 'Content-Range': f'bytes */{len(body)}'}, 416)
+            extra['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+            body = body[start:]
+            status = 206
+
+        with server.lock:
+            cutoff, server.cutoff = server.cutoff, None
+            server.sent += len(body[:cutoff])
+        self.send(body, 'application/zip', extra, status, cutoff)
+
+    ''' Sends a response. Successful responses without validators of their own get an ETag from their content and a
+        fixed Last-Modified, and requests whose If-None-Match or If-Modified-Since still hold are answered 304 '''
+    def send(self, body, contentType, headers={}, status=200, cutoff=None):
+        if status == 200 and 'ETag' not in headers:
+            headers = {**headers, 'ETag': f'"{zlib.crc32(body):08x}"', 'Last-Modified': stubModified}
+            matched = self.headers.get('If-None-Match') == headers['ETag'] if 'If-None-Match' in self.headers \
+                else self.headers.get('If-Modified-Since') == stubModified
+            if matched:
+                with self.server.lock:
+                    self.server.notModified += 1
+                body, status = b'', 304
+
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body[:cutoff])
+        if cutoff is not None:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+''' Local server standing in for the sites the scrapers use, on a free port of 127.0.0.1.
+    Routes: /w/api.php (MediaWiki pageimages, returning maxlag errors every maxlag requests),
+    /images/ (thumbnails), /efloras/browse.aspx, /potwo/taxon/<lsid> and /gbif/<name>.zip (dataset archives, at
+    datasetVersion, cut off after cutoff bytes when set). /stats returns request counts per route, and
+    /control?cutoff=&datasetVersion= sets those two and returns them with the dataset bytes sent so far and the
+    number of 304 responses. Pages carry an ETag and Last-Modified, and conditional requests are answered 304.
+    Responses are delayed by latency seconds, standing in for the round trip to the real sites
+'''
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, maxlag=10, latency=0.02):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.maxlag = maxlag
+        self.latency = latency
+        self.datasetVersion = 1
+        self.cutoff = None
+        self.sent = 0
+        self.notModified = 0
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+''' Creates a sandbox root for a benchmark run: an empty copy of the src layout whose taxa.json points
+    the wiki API at the stub server and lifts the rate limit for it, so caches start cold and runs
+    never touch the real caches, images or trees '''
+def makeSandbox(stubUrl, path=None):
+    path = path or fixturePath('sandbox')
+    shutil.rmtree(path, ignore_errors=True)
+    for directory in ('cache', 'images', 'trees', 'datasets'):
+        os.makedirs(os.path.join(path, directory))
+
+    config = json.load(open(os.path.join(root, 'taxa.json')))
+    config['wikiAPI'] = f'{stubUrl}/w/api.php?'
+    config['hostRates'][urlparse(stubUrl).netloc] = 1000
+    with open(os.path.join(path, 'taxa.json'), 'w') as f:
+        json.dump(config, f, indent=4)
+    return path
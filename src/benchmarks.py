@@ -0,0 +1,1092 @@
+''' Benchmarks for the tree pipeline and scrapers
+    Run from the src directory, e.g. 'python benchmarks.py detachLowerRanks'
+    Each benchmark times the current implementation next to the one it replaced,
+    and checks that both produce the same output.
+    Runs are offline and reproducible: benchmarks run in a fresh sandbox root against the
+    fixture taxa.sqlite, the saved pages in fixtures/ and a local stub server for every site
+    the scrapers use (see benchfixtures.py). With --record, results are appended to
+    fixtures/results.jsonl under the current commit, and --history compares them across commits
+'''
+import os, io, sys, json, time, random, shutil, tempfile, argparse, contextlib
+import subprocess, urllib.request, urllib.parse
+import numpy as np
+import pandas as pd
+from PIL import Image
+from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from taxonomy import *
+from benchfixtures import *
+
+# ------------------------------
+# SYNTHETIC DATA
+
+# Builds an ete3 tree shaped like an NCBI descendant tree, with taxid names and sci_name/rank features
+def syntheticTree(size=100000, branching=6, seed=0):
+    rng = random.Random(seed)
+    ranks = data['ranks']
+
+    t = Tree(name='1')
+    t.add_features(sci_name='Root', rank=ranks[1], taxid=1)
+
+    count = 1
+    nodes = deque([(t, 1)])
+    while nodes and count < size:
+        parent, depth = nodes.popleft()
+        for i in range(rng.randint(1, branching)):
+            if count >= size:
+                break
+            count += 1
+
+            if rng.random() < 0.1:
+                rank, childDepth = rng.choice(['no rank', 'clade']), depth
+            else:
+                childDepth = min(depth + rng.randint(1, 3), len(ranks) - 1)
+                rank = ranks[childDepth]
+
+            roll = rng.random()
+            if roll < 0.01:
+                name = f'unclassified {parent.sci_name}'
+            elif roll < 0.015:
+                name = f'{parent.sci_name} environmental samples'
+            elif roll < 0.016:
+                name = rng.choice(data['oldTaxa'])
+            else:
+                name = f'Taxon{count}'
+
+            child = parent.add_child(name=str(count))
+            child.add_features(sci_name=name, rank=rank, taxid=count)
+            if childDepth < len(ranks) - 1:
+                nodes.append((child, childDepth))
+
+    return t
+
+# Builds a deep chain of unclassified nodes ending in a species, each with an unclassified leaf beside it,
+# the worst case for scanning the descendants of every unclassified node
+def syntheticChain(depth=5000):
+    t = Tree(name='1')
+    t.add_features(sci_name='Root', rank=data['ranks'][1], taxid=1)
+
+    node = t
+    for i in range(depth):
+        leaf = node.add_child(name=str(2 * i + 3))
+        leaf.add_features(sci_name=f'unclassified Leaf{i}', rank='no rank', taxid=2 * i + 3)
+        node = node.add_child(name=str(2 * i + 2))
+        node.add_features(sci_name=f'unclassified Taxon{i}', rank='no rank', taxid=2 * i + 2)
+    node.add_features(rank='species')
+    return t
+
+# Builds a DataFrame with the columns of the IPNI GBIF dataset, with repeated names like the real one
+def syntheticIPNI(rows=1500000, names=500000, seed=0):
+    rng = np.random.default_rng(seed)
+    nameIds = rng.integers(0, names, rows)
+    return pd.DataFrame({'lsid': [f'urn:lsid:ipni.org:names:{i}-1' for i in range(rows)],
+                         'name': [f'Taxon{i}' for i in nameIds],
+                         'rank': rng.choice(['fam.', 'gen.', 'spec.'], rows),
+                         'family': [f'Family{i % 400}' for i in nameIds]})
+
+# Builds MediaWiki pageimages query results for the given names, plus disambiguation pages for some
+def syntheticQueries(names, perQuery=50, seed=0):
+    rng = random.Random(seed)
+    pages = []
+    for i, name in enumerate(names):
+        title = f'{name} (Family{i % 97})' if rng.random() < 0.2 else name
+        page = {'pageid': i, 'ns': 0, 'title': title}
+        if rng.random() < 0.8:
+            image = rng.choice(data['genericImages']) if rng.random() < 0.05 else f'{name.replace(" ", "_")}.jpg'
+            page['thumbnail'] = {'source': f'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/{image}/200px-{image}'}
+        pages.append(page)
+    return [{'pages': {str(page['pageid']): page for page in pages[i:i + perQuery]}} for i in range(0, len(pages), perQuery)]
+
+# Builds an eFloras browse page with the given number of taxon rows, wrapped in site-like navigation markup
+def syntheticBrowsePage(rows=50, seed=0):
+    rng = random.Random(seed)
+    navigation = ''.join(f'<li><a href="/flora_page.aspx?flora_id={i}">Flora {i}</a></li>' for i in range(200))
+    items = []
+    for i in range(rows):
+        lower = '<a href="browse.aspx?start_taxon_id=1" title="lower taxa">lower taxa</a>' if rng.random() < 0.5 else ''
+        items.append(f'<tr class="underline"><td class="small">{10000 + i}</td><td><a href="florataxon.aspx?taxon_id={10000 + i}"><b>Taxon{i}</b></a></td><td>{lower}</td></tr>')
+    pager = ''.join(f'<a href="browse.aspx?flora_id=1&amp;page={i}">{i}</a> ' for i in range(1, 6))
+    return f'<html><head><title>eFloras</title></head><body><ul>{navigation}</ul><table>{"".join(items)}</table><p>{pager}</p></body></html>'
+
+# Builds a POTWO taxon page with a distribution listing among other page sections
+def syntheticTaxonPage(regions=40):
+    sections = ''.join(f'<section><h2>Section {i}</h2><p>{"Lorem ipsum dolor sit amet. " * 20}</p></section>' for i in range(30))
+    listing = ', \r\n              \r\n              '.join(f'Region {i}' for i in range(regions))
+    return f'<html><body>{sections}<div id="distribution-listing"><h3>Native to:</h3><p>\n              {listing}\n            </p></div>{sections}</body></html>'
+
+# ------------------------------
+# REPLACED IMPLEMENTATIONS
+
+# Taxonomy.detachLowerRanks before the single-pass rewrite, one search_nodes pass per rank
+def legacyDetachLowerRanks(t, rank, ranks):
+    if type(rank) == str and rank in ranks:
+        rank = ranks.index(rank)
+
+    for r in reversed(ranks):
+        if ranks.index(r) > rank:
+            for node in t.search_nodes(rank=r):
+                node.detach()
+        if ranks.index(r) == rank:
+            for node in t.search_nodes(rank=r):
+                for subnode in node.iter_descendants():
+                    subnode.detach()
+    return t
+
+# Taxonomy.removeUnclassified before the post-order pass, scanning the whole subtree of every unclassified node
+def legacyRemoveUnclassified(t, ranks):
+    for node in t.iter_descendants():
+        if 'unclassified' in node.sci_name or 'incertae' in node.sci_name:
+            keep = False
+            for subnode in node.iter_descendants():
+                if subnode.rank in ranks:
+                    keep = True
+            if not keep:
+                node.detach()
+
+# Taxonomy.cleanTree before the post-order pass, a list lookup in oldTaxa per node
+def legacyCleanTree(t):
+    for node in t.iter_descendants():
+        if 'environmental' in node.sci_name:
+            node.detach()
+        if node.sci_name in data['oldTaxa']:
+            node.detach()
+
+# Taxonomy.pruneToRank before filterTree, cleaning and removing unclassified taxa in separate passes
+def legacyPruneToRank(t, rank, ranks):
+    legacyCleanTree(t)
+    prunedTree = legacyDetachLowerRanks(t, rank, ranks)
+    legacyRemoveUnclassified(prunedTree, ranks)
+    return prunedTree
+
+# rankedLayout before the palette lookup, comparing the node's rank to every rank in the palette
+def legacyRankedLayout(node):
+    palette = data['rankedPalette']
+
+    taxaNameplate(node)
+    for rank in palette.keys():
+        if node.rank == rank:
+            nstyle = NodeStyle()
+            nstyle['bgcolor'] = palette[rank]
+            node.set_style(nstyle)
+
+# POTWOScraper.getLSIDS before the name index, two scans of the DataFrame per lookup
+def legacyGetLSIDS(ipni, taxa):
+    indecies = []
+    for index, name in ipni.name.items():
+        if name == taxa:
+            indecies.append(index)
+    lsids = []
+    for index, lsid in ipni.lsid.items():
+        if index in indecies:
+            lsids.append(lsid)
+    return lsids
+
+# Name matching from Taxonomy.thumbnailUrls before the title index, a substring test per name and page
+def legacyMatchThumbnails(taxa, queries, genericImages):
+    pages = []
+    for query in queries:
+        for page in query['pages'].values():
+            pages.append(page)
+
+    urls = {}
+    for name in taxa:
+        for page in pages:
+            if name in page['title']:
+                try:
+                    if any(i in page['thumbnail']['source'] for i in genericImages):
+                        continue
+                    else:
+                        urls[name] = page['thumbnail']['source']
+                except:
+                    continue
+    return urls
+
+# taxutilities.getParent before the bulk lineage API, one rank query per lineage element
+def legacyGetParent(taxa, rank, mode='taxid'):
+    taxa = getTaxid(taxa)
+    for parent in ncbi.get_lineage(taxa):
+        if ncbi.get_rank([parent])[parent] == rank:
+            if mode == 'taxid':
+                return parent
+            if mode == 'name':
+                return ncbi.get_taxid_translator([parent])[parent]
+
+# eFlora browse page parsing before the XPath rewrite, full BeautifulSoup DOM per page
+def legacyParseRows(text):
+    rows = []
+    soup = BeautifulSoup(text, 'lxml')
+    for item in soup.find_all('tr', class_='underline'):
+        id_listing = item.find('td', class_='small')
+        if id_listing is not None:
+            lower_taxa = item.find('a', title='lower taxa')
+            if lower_taxa is None:
+                lower_taxa = item.find('a', title='lower taxon')
+            rows.append((id_listing.get_text(), item.find('a').get_text(), lower_taxa is not None))
+    return rows
+
+# POTWO distribution parsing before the XPath rewrite
+def legacyParseDistribution(content):
+    soup = BeautifulSoup(content, 'lxml')
+    distclean = soup.find('div', id='distribution-listing').find('p').get_text().strip()
+    return distclean.split(', \r\n              \r\n              ')
+
+# thumbnailQueries before titles were packed to the API limit, sending batches of 48 titles one after another
+def legacyThumbnailQueries(tax, taxa, size):
+    params = {'prop': 'pageimages', 'piprop': 'thumbnail', 'pithumbsize': size}
+    family, species = tax.rankDepth['family'], tax.rankDepth['species']
+    families = getParents([name for name, rank in taxa.items() if family < tax.rankDepth.get(rank, -1) < species], rank='family', mode='name')
+
+    queries = []
+    titles = []
+    for name, rank in taxa.items():
+        titles.append(name)
+        if families.get(name) is not None:
+            titles.append(f'{name} ({families[name]})')
+        if len(titles) >= 48:
+            query = tax.wiki.query(params={**params, 'titles': '|'.join(titles)})
+            if query is not None:
+                queries.append(query)
+            titles = []
+    if len(titles) > 0:
+        query = tax.wiki.query(params={**params, 'titles': '|'.join(titles)})
+        if query is not None:
+            queries.append(query)
+    return queries
+
+# Taxonomy.thumbnailUrls fallback before batching, one round of queries per missed taxa, one after another
+def legacyThumbnailFallback(tax, t, size):
+    taxa = {node.sci_name: node.rank for node in t.iter_leaves()}
+    urls = tax.matchThumbnails(taxa, tax.thumbnailQueries(taxa, size))
+    for node in t.iter_leaves():
+        if node.sci_name not in urls and tax.rankDepth.get(node.rank, len(tax.ranks)) < tax.rankDepth['species']:
+            node_t = ncbi.get_descendant_taxa(node.name, return_tree=True)
+            if type(node_t) is not list:
+                node_taxa = {subnode.sci_name: subnode.rank for subnode in node_t.iter_leaves()}
+                node_urls = tax.matchThumbnails(node_taxa, tax.thumbnailQueries(node_taxa, size))
+                for name in node_taxa:
+                    if name in node_urls:
+                        urls[node.sci_name] = node_urls[name]
+                        break
+    return urls
+
+# eFlora.browseTaxa before the concurrent crawl, requesting pages one by one until 'No taxa found'
+def legacyBrowseTaxa(flora, taxonID=None, species=False):
+    rows = []
+    pageNumber = 1
+    while True:
+        page = httpCache.get(flora.home + 'browse.aspx?', params={'flora_id': flora.floraId, 'page': pageNumber, 'start_taxon_id': taxonID})
+        if page.status_code != 200 or "No taxa found" in page.text:
+            break
+        rows.extend(legacyParseRows(page.text))
+        pageNumber += 1
+
+    taxa = {}
+    for taxa_id, taxa_name, lower_taxa in rows:
+        if taxa_id != taxonID and 'x\\' not in taxa_name and '×' not in taxa_name:
+            if species and not lower_taxa and 'subg.' not in taxa_name:
+                taxa[taxa_id] = taxa_name
+            elif not species and lower_taxa and len(taxa_name.split(' ')) == 1:
+                taxa[taxa_id] = taxa_name
+    return taxa
+
+def legacyFullTree(flora):
+    tree = {}
+    for f_id, f_name in legacyBrowseTaxa(flora).items():
+        genera = legacyBrowseTaxa(flora, f_id)
+        tree[f_id] = {f_name: {g_id: {g_name: legacyBrowseTaxa(flora, g_id, species=True)} for g_id, g_name in genera.items()}}
+    return tree
+
+# distributionFromDescendants before memoization and concurrent fetching, recursing one page at a time
+def legacyDistributionFromDescendants(potwo, taxa, rank):
+    descendants = ncbi.get_descendant_taxa(taxa, return_tree=True)
+    if type(descendants) == list:
+        return
+
+    dists = {}
+    for node in descendants.iter_descendants():
+        if node.rank in potwo.ranks and potwo.ranks.index(node.rank) == potwo.ranks.index(rank) + 1:
+            node_dist = potwo.distribution(int(node.name))
+            if node_dist is not None:
+                dists[int(node.name)] = node_dist
+            elif node.rank != 'species':
+                dists[int(node.name)] = legacyDistributionFromDescendants(potwo, int(node.name), node.rank)
+
+    dist = []
+    for regions in dists.values():
+        for region in regions or []:
+            if region not in dist:
+                dist.append(region)
+    return dist
+
+# MapMaker.distributionMap before the region store, folium reading the whole GeoJSON file with a list lookup per feature, rendered to html
+def legacyDistributionMap(level3, dist):
+    import folium
+    m = folium.Map(location=[0, 0], zoom_start=2.4)
+    folium.GeoJson(level3, name='WGSRPD Level 3',
+                   style_function=lambda feature: {'fillOpacity': 1, 'opacity': 1} if feature['properties']['LEVEL3_NAM'] in dist else {'fillOpacity': 0, 'opacity': 0}).add_to(m)
+    return m.get_root().render()
+
+# GBIFScraper.datasetDownload before streaming, the whole zip fetched again after an interruption and every member extracted
+def legacyDatasetDownload(url, directory):
+    filename = url.split('/')[-1]
+    setzip = os.path.join(directory, filename)
+    setdir = os.path.join(directory, filename.replace('.zip', ''))
+
+    try:
+        with requests.get(url, stream=True) as r:
+            with open(setzip, 'wb') as f:
+                shutil.copyfileobj(r.raw, f)
+        with ZipFile(setzip) as archive:
+            archive.extractall(setdir)
+        return setdir
+    except:
+        return
+
+# ------------------------------
+# HELPERS
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+results = []
+
+def report(name, old, new):
+    results.append({'name': name, 'old': old, 'new': new})
+    print(f'{name:<40} old {old:10.4f}s   new {new:10.4f}s   x{old / max(new, 1e-9):.1f}')
+
+# Url of the stub server, set by main for the sandboxed run
+stubUrl = os.environ.get('BENCH_STUB')
+
+def stubStats():
+    return json.loads(urllib.request.urlopen(stubUrl + '/stats').read())
+
+# Sets stub server options, such as cutting off the next dataset response, returns them with the dataset bytes sent so far
+def stubControl(**options):
+    return json.loads(urllib.request.urlopen(f'{stubUrl}/control?{urllib.parse.urlencode(options)}').read())
+
+# Contents of the csv files extracted into a dataset folder, by path within it
+def datasetContents(setdir):
+    return {os.path.relpath(path, setdir): open(path, 'rb').read() for path in GBIFScraper().datasetFiles(setdir) or []}
+
+# Runs function while counting the requests the stub server receives
+def stubRequests(function, *args, **kwargs):
+    before = sum(stubStats().values())
+    result, seconds = timed(function, *args, **kwargs)
+    return result, seconds, sum(stubStats().values()) - before
+
+def loadIPNISample():
+    names = ['lsid', 'name', 'author', 'rank', 'family', 'lsid2', 'lsid3', 'lsid4', 'year', 'citation', '?', 'link']
+    return pd.read_csv(fixturePath('ipni.csv'), header=None, names=names, dtype=str)[['lsid', 'name']]
+
+# Runs function while counting the SQL statements it sends to the NCBI taxa.sqlite
+def countQueries(function, *args, **kwargs):
+    count = [0]
+    def trace(statement):
+        count[0] += 1
+    ncbi.db.set_trace_callback(trace)
+    try:
+        result, seconds = timed(function, *args, **kwargs)
+    finally:
+        ncbi.db.set_trace_callback(None)
+    return result, seconds, count[0]
+
+def treeNames(t):
+    return [node.name for node in t.traverse('preorder')]
+
+# Parent of each node by taxid, for comparing trees whose child order may differ
+def treeEdges(t):
+    return {node.name: node.up.name if node.up is not None else None for node in t.traverse()}
+
+# ------------------------------
+# BENCHMARKS
+
+def benchDetachLowerRanks(sizes=(10000, 100000, 500000), ranks=('order', 'family', 'genus')):
+    tax = Taxonomy()
+    for size in sizes:
+        for rank in ranks:
+            old, oldTime = timed(legacyDetachLowerRanks, syntheticTree(size), rank, tax.ranks)
+            new, newTime = timed(tax.detachLowerRanks, syntheticTree(size), rank)
+            assert treeNames(old) == treeNames(new), f'detachLowerRanks output differs ({size}, {rank})'
+            report(f'detachLowerRanks {size} nodes -> {rank}', oldTime, newTime)
+
+def benchGetLSIDS(rows=1500000, lookups=10000, legacyLookups=10):
+    ipni = syntheticIPNI(rows)
+    names = [f'Taxon{i}' for i in range(lookups)]
+
+    potwo, indexTime = timed(POTWOScraper, ipni)
+    print(f'{"IPNI name index build":<40} {indexTime:10.4f}s')
+
+    old, oldTime = timed(lambda: [legacyGetLSIDS(ipni, name) for name in names[:legacyLookups]])
+    new, newTime = timed(lambda: [potwo.getLSIDS(name) for name in names[:legacyLookups]])
+    assert old == new, 'getLSIDS output differs'
+    report(f'getLSIDS {legacyLookups} names', oldTime, newTime)
+
+    new, newTime = timed(lambda: [potwo.getLSIDS(name) for name in names])
+    print(f'{"getLSIDS " + str(lookups) + " names":<40} {newTime:10.4f}s')
+    print(f'{"legacy extrapolated to " + str(lookups) + " names":<40} {oldTime / legacyLookups * lookups:10.4f}s')
+
+def benchIPNIStartup(rows=1500000):
+    ipni = syntheticIPNI(rows)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, 'datasets'))
+        csv = os.path.join(root, 'datasets', 'ipni.csv')
+        ipni.to_csv(csv, header=False, index=False)
+        old, oldTime = timed(pd.read_csv, csv, header=None)
+
+        ipni.sort_values('name', kind='stable', ignore_index=True).to_feather(os.path.join(root, 'datasets', 'ipni.feather'), compression='uncompressed')
+        os.chdir(root)
+        try:
+            potwo, newTime = timed(POTWOScraper)
+        finally:
+            os.chdir(cwd)
+    report(f'IPNI csv parse vs cached startup {rows}', oldTime, newTime)
+
+def benchMatchThumbnails(sizes=(1000, 5000, 20000)):
+    tax = Taxonomy()
+    for size in sizes:
+        taxa = {f'Taxon{i}': 'genus' for i in range(size)}
+        queries = syntheticQueries(list(taxa))
+        old, oldTime = timed(legacyMatchThumbnails, taxa, queries, data['genericImages'])
+        new, newTime = timed(tax.matchThumbnails, taxa, queries)
+        # names sharing a prefix (Taxon1, Taxon10) cross-match under the old substring test
+        same = sum(old.get(name) == new.get(name) for name in taxa)
+        report(f'thumbnail matching {size} names', oldTime, newTime)
+        print(f'{"  names matched identically":<40} {same}/{size}')
+
+def benchLineage(taxa='Rosaceae', limit=2000, rank='family'):
+    descendants = ncbi.get_descendant_taxa(taxa)[:limit]
+    names = list(getNames(descendants).values())
+
+    old, oldTime, oldQueries = countQueries(lambda: {name: legacyGetParent(name, rank, mode='name') for name in names})
+    new, newTime, newQueries = countQueries(getParents, names, rank, mode='name')
+    assert {name: parent for name, parent in old.items() if parent is not None} == new, 'getParents output differs'
+    report(f'{rank} of {len(names)} {taxa} descendants', oldTime, newTime)
+    print(f'{"  SQL round-trips":<40} old {oldQueries:>10}    new {newQueries:>10}')
+
+# Times page parsing per page, on synthetic pages or on saved html files given as pages
+def benchParsing(pages=200, browsePages=None, taxonPages=None):
+    flora = eFlora(1)
+    potwo = POTWOScraper(syntheticIPNI(rows=10))
+    browsePages = browsePages or [syntheticBrowsePage(seed=i) for i in range(pages)]
+    taxonPages = taxonPages or [syntheticTaxonPage() for i in range(pages)]
+
+    old, oldTime = timed(lambda: [legacyParseRows(page) for page in browsePages])
+    new, newTime = timed(lambda: [flora.parseRows(page) for page in browsePages])
+    assert old == new, 'browse page parsing differs'
+    report('eFlora browse page, per page', oldTime / len(browsePages), newTime / len(browsePages))
+
+    old, oldTime = timed(lambda: [legacyParseDistribution(page) for page in taxonPages])
+    new, newTime = timed(lambda: [potwo.parseDistribution(page) for page in taxonPages])
+    assert old == new, 'POTWO distribution parsing differs'
+    report('POTWO taxon page, per page', oldTime / len(taxonPages), newTime / len(taxonPages))
+
+# Cleans and removes unclassified taxa on whole trees, times the full pruneToRank, then removeUnclassified on a deep chain
+def benchFilterTree(sizes=(100000, 1000000), ranks=('order', 'genus'), depth=5000):
+    tax = Taxonomy()
+    for size in sizes:
+        def legacyFilter(t):
+            legacyCleanTree(t)
+            legacyRemoveUnclassified(t, tax.ranks)
+            return t
+        old, oldTime = timed(legacyFilter, syntheticTree(size))
+        new, newTime = timed(tax.filterTree, syntheticTree(size))
+        assert treeNames(old) == treeNames(new), f'filterTree output differs ({size})'
+        report(f'clean and filter {size} nodes', oldTime, newTime)
+
+        for rank in ranks:
+            old, oldTime = timed(legacyPruneToRank, syntheticTree(size), rank, tax.ranks)
+            new, newTime = timed(tax.pruneToRank, syntheticTree(size), rank)
+            assert treeNames(old) == treeNames(new), f'pruneToRank output differs ({size}, {rank})'
+            report(f'pruneToRank {size} nodes -> {rank}', oldTime, newTime)
+
+    old, new = syntheticChain(depth), syntheticChain(depth)
+    oldTime = timed(legacyRemoveUnclassified, old, tax.ranks)[1]
+    newTime = timed(tax.removeUnclassified, new)[1]
+    assert treeNames(old) == treeNames(new), 'removeUnclassified output differs on deep chain'
+    report(f'removeUnclassified {depth} deep chain', oldTime, newTime)
+
+# Applies each layout to every node, as rendering does, and checks the node backgrounds match
+def benchLayout(size=200000):
+    from ete3.treeview.main import _FaceAreas
+    old, new = syntheticTree(size), syntheticTree(size)
+    for node in [*old.traverse(), *new.traverse()]:
+        node._temp_faces = _FaceAreas()
+    oldTime = timed(lambda: [legacyRankedLayout(node) for node in old.traverse()])[1]
+    newTime = timed(lambda: [rankedLayout(node) for node in new.traverse()])[1]
+    assert [node.img_style['bgcolor'] for node in old.traverse()] == [node.img_style['bgcolor'] for node in new.traverse()], 'layout styles differ'
+    report(f'rankedLayout on {size} nodes', oldTime, newTime)
+
+# Renders trees to svg and png one at a time, on the process pool, then again from the render cache
+def benchRender(trees=8, size=2000, formats=('svg', 'png')):
+    tax = Taxonomy()
+    trees = [syntheticTree(size, seed=i) for i in range(trees)]
+    for i, t in enumerate(trees):
+        t.sci_name = f'Benchmark{i}'
+
+    oldTime = timed(lambda: [renderTree(t, os.path.join(root, 'trees', f'{t.sci_name}.{form}')) for t in trees for form in formats])[1]
+    newTime = timed(tax.saveTrees, trees, formats, force=True)[1]
+    report(f'render {len(trees)} trees x {len(formats)} formats', oldTime, newTime)
+    cachedTime = timed(tax.saveTrees, trees, formats)[1]
+    report(f'  unchanged trees from render cache', oldTime, cachedTime)
+
+    # Workers are capped at the CPU count by default, two are asked for so that the pool runs even on a single CPU
+    paths = tax.saveTrees(trees[:2], formats, workers=1, force=True)
+    serial = [open(path, 'rb').read() for path in paths]
+    pooled, pooledTime = timed(tax.saveTrees, trees[:2], formats, workers=2, force=True)
+    assert pooled == paths and [open(path, 'rb').read() for path in paths] == serial, 'renders on the worker pool differ'
+    print(f'{"  " + str(len(paths)) + " renders on 2 spawned workers":<40} {pooledTime:10.4f}s')
+
+# Looks up stored thumbnails per leaf by file name on disk, as before, and through the image store manifest
+def benchImageStore(images=200, leaves=20000, size=100):
+    directory = tempfile.mkdtemp()
+    store = ImageStore(directory)
+    rng = np.random.default_rng(0)
+    urls = []
+    for i in range(images):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 255, (150, 200, 3), dtype=np.uint8)).save(buffer, 'JPEG')
+        url = f'https://upload.wikimedia.org/thumb/{i}/File{i}.jpg/200px-File{i}.jpg'
+        store.add(url, buffer.getvalue(), 200)
+        store.add(f'https://example.org/copy{i}.jpg', buffer.getvalue())
+        shutil.copy(store.get(url), os.path.join(directory, url.split('/')[-1]))
+        urls.append(url)
+    stored = sum(len(image['files']) for image in store.manifest['images'].values())
+    print(f'{"  stored files for " + str(2 * images) + " urls":<40} {stored:>10}')
+
+    lookups = [urls[i % images] for i in range(leaves)]
+    oldTime = timed(lambda: [os.path.exists(os.path.join(directory, url.split('/')[-1])) for url in lookups])[1]
+    newTime = timed(lambda: [store.get(url, 200) for url in lookups])[1]
+    report(f'thumbnail lookups for {leaves} leaves', oldTime, newTime)
+
+    resizeTime = timed(lambda: [store.get(url, size) for url in urls])[1]
+    print(f'{"  first " + str(size) + "px variants, per image":<40} {resizeTime / images:10.4f}s')
+
+    # Images added from worker threads, as saveImages does, encode outside the store lock
+    contents = []
+    for i in range(images):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 255, (150, 200, 3), dtype=np.uint8)).save(buffer, 'JPEG')
+        contents.append((f'https://example.org/threaded{i}.jpg', buffer.getvalue()))
+    serialTime = timed(lambda: [ImageStore(tempfile.mkdtemp()).add(url, content, size) for url, content in contents[:images // 4]])[1] * 4
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        paths, threadedTime = timed(lambda: list(pool.map(lambda item: store.add(item[0], item[1], size), contents)))
+    assert all(path is not None and os.path.exists(path) and store.get(url, size) == path for (url, content), path in zip(contents, paths)), 'threaded adds lost images'
+    report(f'  add {images} images on 4 threads', serialTime, threadedTime)
+
+    # Variants deleted by hand are made again, and images whose original was deleted, even before a variant is made, are misses
+    url, content = contents[0]
+    os.remove(store.get(url, size))
+    assert os.path.exists(store.get(url, size)), 'deleted variant not made again'
+    os.remove(store.get(url))
+    assert store.get(url, size // 2) is None and store.get(url) is None, 'image with a deleted original returned'
+    assert os.path.exists(store.add(url, content, size)), 'deleted image not stored again'
+    shutil.rmtree(directory)
+
+# Times importing taxonomy in fresh interpreters, against also importing the dependencies it used to import eagerly and opening
+# what it used to open. Fails if any of those are imported again, if the NCBI database, lookup cache, response cache
+# or image store are opened on import, or if importing takes over budget seconds
+def benchImport(runs=5, budget=1.5):
+    heavy = ['pandas', 'folium', 'imgkit', 'PIL.Image', 'bs4']
+    shared = ['ncbi', 'ncbiCache', 'httpCache', 'imageStore']
+    script = '''import sys, time
+start = time.perf_counter()
+{}import taxonomy
+{}print(time.perf_counter() - start)
+print(','.join(name for name in {} if name in sys.modules))
+print(','.join(name for name in {} if getattr(taxonomy, name)._instance is not None))'''
+
+    def run(legacy):
+        opened = ''.join(f'taxonomy.{name}.instance()\n' for name in shared)
+        code = script.format(f'import {", ".join(heavy)}\n' if legacy else '', opened if legacy else '', heavy, shared)
+        results = [subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=root).stdout.split('\n') for i in range(runs)]
+        return min(float(result[0]) for result in results), results[0][1], results[0][2]
+
+    oldTime = run(True)[0]
+    newTime, imported, opened = run(False)
+    report('import taxonomy', oldTime, newTime)
+    assert not imported, f'heavy dependencies imported by taxonomy: {imported}'
+    assert not opened, f'opened on import: {opened}'
+    assert newTime <= budget, f'import took {newTime:.2f}s, over the {budget}s budget'
+
+    # A directory with only taxa.json, and no cache or images directories, is left as it was
+    directory = tempfile.mkdtemp()
+    shutil.copy(os.path.join(root, 'taxa.json'), directory)
+    result = subprocess.run([sys.executable, '-c', 'import taxonomy'], capture_output=True, text=True, cwd=directory)
+    assert result.returncode == 0 and os.listdir(directory) == ['taxa.json'], f'import outside the source directory failed or wrote files: {result.stderr}'
+    shutil.rmtree(directory)
+
+# Cost of spans and counters left in hot paths while instrumentation is off, and of recording them while on
+def benchInstrumentation(calls=1000000, size=200000):
+    def spans():
+        for i in range(calls):
+            with instruments.span('bench'):
+                instruments.count('bench')
+
+    enabled = instruments.enabled
+    instruments.disable()
+    offTime = timed(spans)[1]
+    instruments.enable()
+    onTime = timed(spans)[1]
+    print(f'{"span and count per call":<40} off {offTime / calls * 1e9:8.0f}ns   on {onTime / calls * 1e9:8.0f}ns')
+
+    tax = Taxonomy()
+    instruments.disable()
+    offTime = timed(tax.pruneToRank, syntheticTree(size), 'genus')[1]
+    instruments.enable()
+    onTime = timed(tax.pruneToRank, syntheticTree(size), 'genus')[1]
+    report(f'pruneToRank {size} nodes, off vs on', offTime, onTime)
+    if not enabled:
+        instruments.disable()
+    instruments.reset()
+
+def benchCompactTree(sizes=(100000, 500000, 1000000), ranks=('order', 'family')):
+    tax = Taxonomy()
+    for size in sizes:
+        compact, buildTime = timed(CompactTree.fromTree, syntheticTree(size))
+        print(f'{"CompactTree build " + str(size) + " nodes":<40} {buildTime:10.4f}s')
+        for rank in ranks:
+            old, oldTime = timed(tax.pruneToRank, syntheticTree(size), rank)
+            new, newTime = timed(compact.pruneToRank, rank)
+            assert treeEdges(old) == treeEdges(new.toTree()), f'CompactTree pruning differs ({size}, {rank})'
+            report(f'pruneToRank {size} nodes -> {rank}', oldTime, newTime)
+
+# Loads and prunes clades from the NCBI taxa.sqlite through ete3 and as a CompactTree, from a small family to the whole database
+def benchCompactLoad(clades=('Rosaceae', 'Pinales', 1), rank='family'):
+    tax = Taxonomy()
+    for taxa in clades:
+        old, oldTime = timed(lambda: tax.pruneToRank(ncbi.get_descendant_taxa(taxa, return_tree=True), rank))
+        new, newTime = timed(lambda: CompactTree.fromNCBI(taxa).pruneToRank(rank).toTree())
+        assert treeEdges(old) == treeEdges(new), 'CompactTree loading differs'
+        report(f'load and prune {getName(taxa) if type(taxa) == int else taxa} -> {rank}', oldTime, newTime)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert CompactTree.fromNCBI(10 ** 9) is None, 'unknown taxid loaded'
+
+# Wiki thumbnail queries for the leaves of a fixture tree against the stub API, sequential batches of 48 against packed concurrent batches
+def benchThumbnailUrls(taxa='Pinales', rank='species', size=200):
+    tax = Taxonomy()
+    saved = json.loads(readFixture('wiki_pageimages.json'))['query']
+    names = {name: rank for rank, names in fixtureNames.items() for name in names}
+    expected = {page['title']: page['thumbnail']['source'] for page in saved['pages'].values() if 'thumbnail' in page}
+    assert tax.matchThumbnails(names, [saved]) == expected, 'saved pageimages matching differs'
+
+    t = tax.getTree(taxa, rank, thumbnails=False)
+    leaves = {node.sci_name: node.rank for node in t.iter_leaves()}
+
+    httpCache.clear()
+    old, oldTime, oldRequests = stubRequests(lambda: tax.matchThumbnails(leaves, legacyThumbnailQueries(tax, leaves, size)))
+    httpCache.clear()
+    new, newTime, newRequests = stubRequests(lambda: tax.matchThumbnails(leaves, tax.thumbnailQueries(leaves, size)))
+    assert old == new, 'thumbnail queries differ'
+    report(f'thumbnail queries {len(leaves)} {taxa} leaves', oldTime, newTime)
+    print(f'{"  API requests":<40} old {oldRequests:>10}    new {newRequests:>10}')
+
+    urls, cachedTime, cachedRequests = stubRequests(tax.thumbnailUrls, t, size)
+    report('  thumbnailUrls from response cache', oldTime, cachedTime)
+    print(f'{"  thumbnails found, requests":<40} {len(urls):>10}    {cachedRequests:>10}')
+
+    # Genera without a thumbnail of their own fall back to their species
+    t = tax.getTree(taxa, 'genus', thumbnails=False)
+    httpCache.clear()
+    old, oldTime, oldRequests = stubRequests(legacyThumbnailFallback, tax, t, size)
+    httpCache.clear()
+    new, newTime, newRequests = stubRequests(tax.thumbnailUrls, t, size)
+    assert old == new, 'thumbnail fallback differs'
+    report(f'thumbnailUrls {len(t)} {taxa} genera', oldTime, newTime)
+    print(f'{"  API requests":<40} old {oldRequests:>10}    new {newRequests:>10}')
+
+''' Fetches stub POTWO pages straight from the server, as the scrapers did, and through a cold ResponseCache, then times
+    fresh cache hits, revalidation of expired entries answered 304, and offline mode, where missing pages get a 504 '''
+def benchResponseCache(pages=100):
+    directory = tempfile.mkdtemp()
+    cache = ResponseCache(directory)
+    urls = [f'{stubUrl}/potwo/taxon/{fixtureLSID(i)}' for i in range(pages)]
+
+    old, oldTime, oldRequests = stubRequests(lambda: [fetch(url).content for url in urls])
+    cold, coldTime, coldRequests = stubRequests(lambda: [cache.get(url).content for url in urls])
+    assert old == cold and oldRequests == coldRequests == pages, 'cold cache differs'
+
+    hits, hitTime, hitRequests = stubRequests(lambda: [cache.get(url) for url in urls])
+    assert all(r.fromCache for r in hits) and [r.content for r in hits] == old and hitRequests == 0, 'fresh entries not served from cache'
+    report(f'{pages} pages, fresh cache hits', oldTime, hitTime)
+
+    notModified = stubControl()['notModified']
+    revalidated, revalidateTime, revalidateRequests = stubRequests(lambda: [cache.get(url, ttl=0) for url in urls])
+    notModified = stubControl()['notModified'] - notModified
+    assert [r.content for r in revalidated] == old and all(r.fromCache for r in revalidated), 'revalidated entries differ'
+    assert revalidateRequests == notModified == pages, 'expired entries not revalidated with 304'
+    report(f'  expired entries revalidated, 304', oldTime, revalidateTime)
+
+    # Bodies that go missing after the index is read are fetched again in full
+    cache.load = lambda *args: None
+    lost, lostTime, lostRequests = stubRequests(lambda: [cache.get(url, ttl=0) for url in urls[:10]])
+    del cache.load
+    assert [r.content for r in lost] == old[:10] and lostRequests == 20, 'missing bodies not fetched again'
+    assert all(cache.get(url).fromCache for url in urls[:10]), 'bodies fetched again not cached'
+
+    cache.offline = True
+    missing = f'{stubUrl}/potwo/taxon/{fixtureLSID(pages)}'
+    (offline, miss), offlineTime, offlineRequests = stubRequests(lambda: ([cache.get(url, ttl=0) for url in urls], cache.get(missing)))
+    assert [r.content for r in offline] == old and miss.status_code == 504 and offlineRequests == 0, 'offline mode reached the server'
+    cache.load = lambda *args: None
+    assert cache.get(urls[0]).status_code == 504, 'offline mode returned a missing body'
+    del cache.load
+    report(f'  offline, expired entries and a miss', oldTime, offlineTime)
+    print(f'{"  requests cold, hit, 304, offline":<40} {coldRequests:>6} {hitRequests:>6} {revalidateRequests:>6} {offlineRequests:>6}')
+    cache.index.close()
+    shutil.rmtree(directory)
+
+# Crawls the stub flora with eFlora.fullTree, against browsing page by page, then again from the response cache
+def benchBrowseTaxa():
+    saved = readFixture('efloras_browse.html')
+    assert legacyParseRows(saved) == eFlora(1).parseRows(saved), 'saved browse page parsing differs'
+
+    floras = [eFlora(1), eFlora(1), eFlora(1)]
+    for flora in floras:
+        flora.home = stubUrl + '/efloras/'
+
+    httpCache.clear()
+    old, oldTime, oldRequests = stubRequests(legacyFullTree, floras[0])
+    httpCache.clear()
+    new, newTime, newRequests = stubRequests(floras[1].fullTree)
+    assert old == new, 'eFlora crawl differs'
+    report(f'eFlora fullTree {len(new)} families', oldTime, newTime)
+    print(f'{"  browse requests":<40} old {oldRequests:>10}    new {newRequests:>10}')
+
+    cached, cachedTime, cachedRequests = stubRequests(floras[2].fullTree)
+    report('  fullTree from response cache', oldTime, cachedTime)
+    print(f'{"  browse requests":<40} {cachedRequests:>10}')
+
+# LSID lookups on the IPNI sample, and descendant distributions of the families of a fixture order from the stub POTWO pages
+def benchDistributions(taxa='Pinales', rank='family'):
+    saved = readFixture('potwo_taxon.html')
+    ipni = loadIPNISample()
+    potwos = [POTWOScraper(ipni), POTWOScraper(ipni), POTWOScraper(ipni)]
+    for potwo in potwos:
+        potwo.home = stubUrl + '/potwo/'
+    assert legacyParseDistribution(saved) == potwos[0].parseDistribution(saved), 'saved taxon page parsing differs'
+
+    names = ipni.name.tolist()[:200]
+    old, oldTime = timed(lambda: [legacyGetLSIDS(ipni, name) for name in names])
+    new, newTime = timed(lambda: [potwos[0].getLSIDS(name) for name in names])
+    assert old == new, 'getLSIDS output differs'
+    report(f'getLSIDS {len(names)} names, IPNI sample', oldTime, newTime)
+
+    t = ncbi.get_descendant_taxa(taxa, return_tree=True)
+    families = [int(node.name) for node in t.traverse() if node.rank == rank]
+
+    httpCache.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        old, oldTime, oldRequests = stubRequests(lambda: [legacyDistributionFromDescendants(potwos[0], taxid, rank) for taxid in families])
+        httpCache.clear()
+        new, newTime, newRequests = stubRequests(lambda: [potwos[1].distributionFromDescendants(taxid, rank) for taxid in families])
+    # the old recursion dropped branches with a single descendant, for which get_descendant_taxa returns a list
+    assert all(set(dist or []) <= set(newDist) for dist, newDist in zip(old, new)), 'distributions differ'
+    report(f'distributions of {len(families)} {taxa} families', oldTime, newTime)
+    print(f'{"  POTWO requests":<40} old {oldRequests:>10}    new {newRequests:>10}')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        cached, cachedTime = timed(lambda: [potwos[2].distributionFromDescendants(taxid, rank) for taxid in families])
+    report('  distributions from response cache', oldTime, cachedTime)
+
+# Distribution maps on the fixture regions, folium html against static PNG and SVG maps, then a batch of maps
+def benchMaps(maps=5, batch=2000, width=2000):
+    maker = MapMaker(width)
+    if not os.path.exists(maker.level3):
+        writeRegions(maker.level3)
+    rng = random.Random(0)
+    dists = {f'Taxon{i}': [f'Region{rng.randrange(369)}' for j in range(rng.randint(1, 40))] for i in range(batch)}
+    sample = list(dists.values())[:maps]
+
+    oldTime = timed(lambda: [legacyDistributionMap(maker.level3, dist) for dist in sample])[1]
+    loadTime = timed(maker.projection, width)[1]
+    print(f'{"  simplify and project regions, once":<40} {loadTime:10.4f}s')
+    newTime = timed(lambda: [maker.staticMap(dist) for dist in sample])[1]
+    report('distribution map, per map, png', oldTime / maps, newTime / maps)
+    newTime = timed(lambda: [maker.svgMap(dist) for dist in sample])[1]
+    report('  svg', oldTime / maps, newTime / maps)
+
+    image = maker.staticMap(['Region0', 'Enclave'])
+    pixels = maker.projection(width)['pixels']
+    x, y = pixels[maker.regions['index']['Enclave']][0][0][:2]
+    assert image.getpixel((int(x) + 1, int(y))) == 3, 'enclave not filled'
+
+    loaded, loadTime = timed(lambda: MapMaker(width).loadRegions())
+    print(f'{"  regions from cache, new instance":<40} {loadTime:10.4f}s')
+    MapMaker.loaded.clear()
+    loaded, loadTime = timed(lambda: MapMaker(width).loadRegions())
+    print(f'{"  regions from cache, new process":<40} {loadTime:10.4f}s')
+
+    directory = tempfile.mkdtemp()
+    for _format in ('png', 'svg'):
+        paths, batchTime = timed(maker.distributionMaps, dists, _format, directory=directory)
+        assert all(os.path.exists(path) for path in paths.values()), 'maps missing'
+        report(f'{batch} {_format} maps, extrapolated', oldTime / maps * batch, batchTime)
+    shutil.rmtree(directory)
+
+# Fills a distribution matrix from the stub POTWO pages against fetching taxa one by one, then times
+# unions and richness counts on a synthetic matrix against the same operations on lists of regions
+def benchDistributionMatrix(taxa='Pinales', rank='species', size=50000, lookups=10000):
+    ipni = loadIPNISample()
+    potwos = [POTWOScraper(ipni), POTWOScraper(ipni), POTWOScraper(ipni)]
+    for potwo in potwos:
+        potwo.home = stubUrl + '/potwo/'
+    t = ncbi.get_descendant_taxa(taxa, return_tree=True)
+    species = [int(node.name) for node in t.traverse() if node.rank == rank]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        httpCache.clear()
+        old, oldTime, oldRequests = stubRequests(lambda: {taxid: potwos[0].distribution(taxid) for taxid in species})
+        httpCache.clear()
+        matrix, newTime, newRequests = stubRequests(potwos[1].distributionMatrix, species)
+    assert all(set(old[taxid] or []) == set(matrix.distribution(taxid)) for taxid in species), 'distribution matrix differs'
+    report(f'distributions of {len(species)} {taxa} {rank}', oldTime, newTime)
+    print(f'{"  POTWO requests":<40} old {oldRequests:>10}    new {newRequests:>10}')
+
+    path = os.path.join(tempfile.mkdtemp(), 'distributions.npz')
+    matrix.save(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cachedTime = timed(potwos[2].distributionMatrix, species)[1]
+    loaded, loadTime = timed(DistributionMatrix.load, path)
+    assert (loaded.matrix != matrix.matrix).nnz == 0 and loaded.taxa == matrix.taxa, 'saved matrix differs'
+    report('  from response cache vs saved matrix', cachedTime, loadTime)
+    assert sorted(loaded.descendantUnion(taxa)) == sorted(set(region for dist in old.values() for region in dist or [])), 'descendant union differs'
+    shutil.rmtree(os.path.dirname(path))
+
+    rng = random.Random(0)
+    dists = {i: [f'Region{rng.randrange(369)}' for j in range(rng.randint(0, 40))] for i in range(size)}
+    matrix = DistributionMatrix()
+    fillTime = timed(lambda: [matrix.add(taxid, dist) for taxid, dist in dists.items()] and matrix.matrix)[1]
+    print(f'{"  fill " + str(size) + " synthetic taxa":<40} {fillTime:10.4f}s')
+
+    subset = rng.sample(range(size), lookups)
+    def legacyUnion():
+        dist = []
+        for taxid in subset:
+            for region in dists[taxid]:
+                if region not in dist:
+                    dist.append(region)
+        return dist
+    old, oldTime = timed(legacyUnion)
+    new, newTime = timed(matrix.union, subset)
+    assert sorted(old) == sorted(new), 'union differs'
+    report(f'union of {lookups} distributions', oldTime, newTime)
+
+    def legacyRichness():
+        richness = {}
+        for dist in dists.values():
+            for region in set(dist):
+                richness[region] = richness.get(region, 0) + 1
+        return richness
+    old, oldTime = timed(legacyRichness)
+    new, newTime = timed(matrix.richness)
+    assert old == new, 'richness differs'
+    report(f'richness of {size} distributions', oldTime, newTime)
+
+# Builds family trees for every order of the fixture database, applies an update to a copy of it, then reruns
+# every job as before against only the jobs the diff affects. The full rerun goes second, with renders already cached
+def benchIncremental(rank='family', changes=10):
+    directory = tempfile.mkdtemp()
+    old = fixturePath('taxa.sqlite')
+    new = os.path.join(directory, 'taxa.sqlite')
+    shutil.copy2(old, new)
+    mutateTaxaDB(new, changes)
+
+    db = sqlite3.connect(old)
+    jobs = [{**jobDefaults, 'taxa': taxid, 'rank': rank, 'thumbnails': False} for (taxid,) in db.execute("SELECT taxid FROM species WHERE rank = 'order'")]
+    db.close()
+    states = [os.path.join(directory, 'incremental.json'), os.path.join(directory, 'full.json'), os.path.join(directory, 'pool.json')]
+    with contextlib.redirect_stdout(io.StringIO()):
+        runJobs(jobs, statePath=states[0])
+    shutil.copy(states[0], states[1])
+
+    # Jobs on worker processes, whose renders are recorded by this process only, so that none are lost
+    os.remove(os.path.join(root, 'trees', 'renders.json'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        state, poolTime = timed(runJobs, jobs[:8], 2, states[2], True)
+    renders = json.load(open(os.path.join(root, 'trees', 'renders.json')))
+    assert all(os.path.basename(path) in renders for entry in state.values() for path in entry['outputs']), 'renders lost by worker processes'
+    print(f'{"  " + str(len(state)) + " jobs on 2 worker processes":<40} {poolTime:10.4f}s')
+
+    setNCBI(new)
+    try:
+        diff, diffTime = timed(diffTaxonomy, old, new)
+        print(f'{"  diff " + str(len(diff["taxids"])) + " changed taxa":<40} {diffTime:10.4f}s')
+        ncbiCache.invalidate(diff)
+        with contextlib.redirect_stdout(io.StringIO()):
+            state, newTime = timed(runJobs, jobs, 1, states[0], False, diff)
+            oldTime = timed(runJobs, jobs, 1, states[1], True)[1]
+        affected = sum(entry.get('taxid') in diff['affected'] for entry in state.values())
+        report(f'update {len(jobs)} {rank} tree jobs, {affected} affected', oldTime, newTime)
+
+        db = sqlite3.connect(old)
+        taxids = [taxid for (taxid,) in db.execute('SELECT taxid FROM species')]
+        db.close()
+        matrix = DistributionMatrix()
+        for taxid in taxids:
+            matrix.add(taxid, [f'Region{taxid % 369}', f'Region{taxid % 7}'])
+        dropped, dropTime = timed(matrix.invalidate, diff)
+        kept = [taxid for taxid in taxids if taxid not in diff['taxids']]
+        assert dropped == len(taxids) - len(kept) and matrix.taxa == kept, 'distribution matrix rows not dropped'
+        assert all(set(matrix.distribution(taxid)) == {f'Region{taxid % 369}', f'Region{taxid % 7}'} for taxid in kept[::100]), 'distribution matrix rows differ'
+        print(f'{"  drop " + str(dropped) + " distribution rows":<40} {dropTime:10.4f}s')
+    finally:
+        setNCBI(fixturePath('taxa.sqlite'))
+        shutil.rmtree(directory)
+
+''' Downloads a stub GBIF dataset that is cut off halfway, then finishes it by downloading it again as before,
+    and by resuming the partial file. Checks that a resume after the dataset changed on the server starts over,
+    that a corrupt zip left by an earlier run is fetched again, and that an archive without csv files extracts '''
+def benchDatasetDownload():
+    gbif = GBIFScraper()
+    directories = [tempfile.mkdtemp() for i in range(2)]
+    url = f'{stubUrl}/gbif/ipni.zip'
+    stubControl(datasetVersion=1)
+    size = len(datasetArchive('ipni', 1))
+    with ZipFile(io.BytesIO(datasetArchive('ipni', 1))) as archive:
+        expected = {member: archive.read(member) for member in archive.namelist() if member.endswith('.csv')}
+
+    def interrupted(download):
+        stubControl(cutoff=size // 2)
+        sent = stubControl()['sent']
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert download() is None, 'cut off download reported as complete'
+            setdir = download()
+        return setdir, stubControl()['sent'] - sent
+
+    (old, oldBytes), oldTime = timed(interrupted, lambda: legacyDatasetDownload(url, directories[0]))
+    gbif.datasets = directories[1]
+    (new, newBytes), newTime = timed(interrupted, lambda: gbif.datasetDownload(url))
+    assert datasetContents(new) == {os.path.normpath(member): content for member, content in expected.items()}, 'resumed dataset differs'
+    report(f'dataset download cut off at half', oldTime, newTime)
+    print(f'{"  bytes sent for a " + str(size >> 10) + " KB zip":<40} old {oldBytes:>10}    new {newBytes:>10}')
+
+    # The dataset changes on the server between the interruption and the resume
+    shutil.rmtree(directories[1])
+    os.makedirs(directories[1])
+    stubControl(cutoff=size // 2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        gbif.datasetDownload(url)
+        stubControl(datasetVersion=2)
+        changed = gbif.datasetDownload(url)
+    with ZipFile(io.BytesIO(datasetArchive('ipni', 2))) as archive:
+        assert datasetContents(changed) == {os.path.normpath(member): archive.read(member) for member in archive.namelist() if member.endswith('.csv')}, \
+            'resume across dataset versions mixed both'
+    stubControl(datasetVersion=1)
+
+    # A corrupt zip from an earlier run is discarded and downloaded again, an archive without csv files leaves an empty folder
+    shutil.rmtree(changed)
+    with open(os.path.join(directories[1], 'ipni.zip'), 'wb') as f:
+        f.write(datasetArchive('corrupt'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        refetched = gbif.datasetDownload(url)
+        empty = gbif.datasetDownload(f'{stubUrl}/gbif/empty.zip')
+    assert refetched is not None and datasetContents(refetched) == datasetContents(new), 'corrupt zip not downloaded again'
+    assert empty is not None and os.listdir(empty) == [], 'archive without csv files not extracted'
+    print(f'{"  changed, corrupt and empty datasets":<40} {"ok":>10}')
+    for directory in directories:
+        shutil.rmtree(directory)
+
+benchmarks = {'detachLowerRanks': benchDetachLowerRanks,
+              'getLSIDS': benchGetLSIDS,
+              'ipniStartup': benchIPNIStartup,
+              'matchThumbnails': benchMatchThumbnails,
+              'lineage': benchLineage,
+              'parsing': benchParsing,
+              'filterTree': benchFilterTree,
+              'compactTree': benchCompactTree,
+              'layout': benchLayout,
+              'render': benchRender,
+              'imageStore': benchImageStore,
+              'import': benchImport,
+              'instrumentation': benchInstrumentation,
+              'compactLoad': benchCompactLoad,
+              'responseCache': benchResponseCache,
+              'thumbnailUrls': benchThumbnailUrls,
+              'browseTaxa': benchBrowseTaxa,
+              'distributions': benchDistributions,
+              'maps': benchMaps,
+              'distributionMatrix': benchDistributionMatrix,
+              'incremental': benchIncremental,
+              'datasetDownload': benchDatasetDownload}
+
+# ------------------------------
+# RECORDING
+
+# Appends this run's results to fixtures/results.jsonl with the commit they were measured at
+def recordResults(path=None):
+    path = path or fixturePath('results.jsonl')
+    source = os.path.dirname(fixtures)
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=source).stdout.strip()
+    dirty = subprocess.run(['git', 'status', '--porcelain', '--', '.', ':!fixtures'], capture_output=True, text=True, cwd=source).stdout.strip() != ''
+    date = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    with open(path, 'a') as f:
+        for result in results:
+            f.write(json.dumps({'commit': commit, 'dirty': dirty, 'date': date, **result}) + '\n')
+    print(f'Recorded {len(results)} results for {commit}{" with uncommitted changes" if dirty else ""}')
+
+# Prints the recorded timings of each benchmark by commit, in the order they were recorded
+def printHistory(path=None, names=None):
+    path = path or fixturePath('results.jsonl')
+    if not os.path.exists(path):
+        print('No recorded results, run with --record first')
+        return
+
+    history = {}
+    with open(path) as f:
+        for line in f:
+            result = json.loads(line)
+            if not names or any(name.lower() in result['name'].lower() for name in names):
+                history.setdefault(result['name'], []).append(result)
+
+    for name, runs in history.items():
+        print(name)
+        for run in runs:
+            commit = run['commit'] + ('+' if run['dirty'] else '')
+            print(f'  {commit:<10} {run["date"]}   old {run["old"]:10.4f}s   new {run["new"]:10.4f}s   x{run["old"] / max(run["new"], 1e-9):.1f}')
+
+''' Builds the fixture database if needed, starts the stub server and reruns this script
+    in a fresh sandbox root, so every run starts from cold caches and nothing leaves the machine '''
+def runSandboxed(argv, latency):
+    if not os.path.exists(fixturePath('taxa.sqlite')):
+        buildTaxaDB()
+
+    stub = StubServer(latency=latency).start()
+    sandbox = makeSandbox(stub.url)
+    source = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, 'BENCH_STUB': stub.url, 'PYTHONPATH': os.pathsep.join([source, os.environ.get('PYTHONPATH', '')])}
+    try:
+        return subprocess.run([sys.executable, os.path.abspath(__file__)] + argv, cwd=sandbox, env=env).returncode
+    finally:
+        stub.stop()
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs benchmarks offline against the fixtures in fixtures/')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run, all by default: {", ".join(benchmarks)}')
+    parser.add_argument('--record', action='store_true', help='append results to fixtures/results.jsonl under the current commit')
+    parser.add_argument('--history', action='store_true', help='print recorded results across commits, for the given benchmarks')
+    parser.add_argument('--fixtures', action='store_true', help='rebuild the fixture database and rewrite the saved fixtures')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the stub server delays each response')
+    args = parser.parse_args()
+
+    if args.history:
+        return printHistory(names=args.names)
+    if stubUrl is None:
+        if args.fixtures:
+            buildTaxaDB()
+            writeFixtures()
+        sys.exit(runSandboxed([arg for arg in sys.argv[1:] if arg != '--fixtures'], args.latency))
+
+    setNCBI(fixturePath('taxa.sqlite'))
+    for name in args.names or benchmarks:
+        benchmarks[name]()
+    if args.record:
+        recordResults()
+
+if __name__ == '__main__': main()
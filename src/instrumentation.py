@@ -0,0 +1,128 @@
+import time, json, threading, cProfile, pstats, tracemalloc
+from contextlib import nullcontext
+
+''' Timing spans and counters for the tree pipeline.
+    Wrap a stage in 'with instruments.span(name):' and count events with instruments.count(name, amount).
+    While disabled, span returns a shared no-op context and count returns at once, so leaving
+    them in hot paths costs next to nothing. With memory, tracemalloc records the memory each span
+    allocates; with profile, cProfile runs from enable until disable.
+    report prints timings and counters, export writes them as JSON
+'''
+class Instrumentation:
+    def __init__(self, enabled=False, profile=False, memory=False):
+        self.enabled = False
+        self.noop = nullcontext()
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.profiler = None
+        self.memory = False
+        self.mergedPeak = 0
+        self.reset()
+        if enabled:
+            self.enable(profile, memory)
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+
+    # Turns recording on, and runs any hooks registered by other modules, such as query tracing
+    def enable(self, profile=False, memory=False):
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if profile and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        for hook in self.hooks:
+            hook(True)
+
+    def disable(self):
+        self.enabled = False
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.memory = False
+        for hook in self.hooks:
+            hook(False)
+
+    def span(self, name):
+        if not self.enabled:
+            return self.noop
+        return Span(self, name)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Adds a finished span to the totals of its name
+    def record(self, name, seconds, memory):
+        with self.lock:
+            span = self.spans.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max': 0.0, 'memory': 0})
+            span['calls'] += 1
+            span['seconds'] += seconds
+            span['max'] = max(span['max'], seconds)
+            span['memory'] += memory
+
+    # Timings and counters as a dictionary, for export or to merge with merge in another process
+    def snapshot(self):
+        with self.lock:
+            snapshot = {'spans': {name: dict(span) for name, span in self.spans.items()}, 'counters': dict(self.counters)}
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot['memory'] = {'current': current, 'peak': max(peak, self.mergedPeak)}
+        return snapshot
+
+    # Adds the timings and counters of a snapshot, such as one returned from a worker process
+    def merge(self, snapshot):
+        with self.lock:
+            for name, other in snapshot['spans'].items():
+                span = self.spans.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max': 0.0, 'memory': 0})
+                span['calls'] += other['calls']
+                span['seconds'] += other['seconds']
+                span['max'] = max(span['max'], other['max'])
+                span['memory'] += other['memory']
+            for name, amount in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            if 'memory' in snapshot:
+                self.mergedPeak = max(self.mergedPeak, snapshot['memory']['peak'])
+
+    def report(self, profileLines=20):
+        snapshot = self.snapshot()
+        for name, span in sorted(snapshot['spans'].items()):
+            memory = f"   memory {span['memory'] / 1024 ** 2:8.1f}MB" if self.memory else ''
+            print(f"{name:<28} calls {span['calls']:>6}   total {span['seconds']:10.3f}s   max {span['max']:8.3f}s{memory}")
+        for name, amount in sorted(snapshot['counters'].items()):
+            print(f'{name:<28} {amount:>12}')
+        if 'memory' in snapshot:
+            print(f"{'traced memory peak':<28} {snapshot['memory']['peak'] / 1024 ** 2:10.1f}MB")
+        if self.profiler is not None:
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(profileLines)
+
+    # Writes the snapshot to a JSON file, and the cProfile stats next to it when profiling
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        if self.profiler is not None:
+            self.profiler.dump_stats(path.rsplit('.', 1)[0] + '.prof')
+
+# Context manager timing one call of a stage, and its allocated memory when tracemalloc is on
+class Span:
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.memory = tracemalloc.get_traced_memory()[0] if self.instruments.memory else 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        memory = tracemalloc.get_traced_memory()[0] - self.memory if self.instruments.memory else 0
+        self.instruments.record(self.name, seconds, memory)
+        return False
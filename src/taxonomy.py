@@ -1,153 +1,244 @@
 from webutilities import *
 from taxutilities import *
+from treeutilities import *
 from ete3 import Tree, NCBITaxa, TreeStyle, NodeStyle, faces, AttrFace, ImgFace
+from urllib.parse import unquote
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import re, csv, time, argparse, multiprocessing
 
 class Taxonomy:
     def __init__(self):
         self.root = os.getcwd()
-        self.data = json.load(open(os.path.join(root, 'taxa.json')))
+        self.data = data
         self.ranks = self.data['ranks']
-        self.ncbi = NCBITaxa()
+        self.rankDepth = {rank: depth for depth, rank in enumerate(self.ranks)}
+        self.genericImages = set(self.data['genericImages'])
+        self.oldTaxa = set(self.data['oldTaxa'])
+        self.unclassifiedPattern = re.compile('unclassified|incertae')
+        self.ncbi = ncbi
         self.wiki = wikiScraper()
 
     ''' One-step thumbnail function, takes ncbi tree,
-        uses urls to download all thumbnails that haven't been downloaded yet,
-        then attaches them as image face to corresponding nodes on the tree'''
+        uses urls to download all thumbnails that haven't been downloaded yet on a thread pool,
+        then attaches them as image face to corresponding nodes on the tree.
+        Takes a list of trees to query and download thumbnails for all of them at once '''
     def getThumbnails(self, t, size=200, column=0, position='aligned'):
-        urls = self.thumbnailUrls(t, size)
+        trees = t if type(t) == list else [t]
+        urls = self.thumbnailUrls(trees, size)
         thumbnails = {}
+        missing = {}
         for taxa, url in urls.items():
-            filedir = os.path.join(self.root, 'images', url.split('/')[-1])
+            path = imageStore.get(url, size)
             
-            if os.path.exists(filedir):
+            if path is not None:
                 print(f"Using image from memory for {taxa}")
+                thumbnails[taxa] = path
             else:
-                print(f"Scraping thumbnail for {taxa}")
-                saveImage(url)
-                
-            thumbnails[taxa] = filedir         
+                missing[taxa] = url
+        
+        if missing:
+            print(f"Scraping {len(missing)} thumbnails")
+            with instruments.span('thumbnails.download'):
+                saved = saveImages(set(missing.values()), size)
+            for taxa, url in missing.items():
+                if saved[url] is not None:
+                    thumbnails[taxa] = saved[url]
         
-        for node in t.iter_leaves():
-            if node.sci_name in thumbnails.keys():
-                node.add_face(ImgFace(thumbnails[node.sci_name]), column=column, position=position)
+        for tree in trees:
+            for node in tree.iter_leaves():
+                if node.sci_name in thumbnails.keys():
+                    node.add_face(ImgFace(thumbnails[node.sci_name]), column=column, position=position)
+                    node.add_feature('thumbnail', os.path.basename(thumbnails[node.sci_name]))
+        imageStore.save()
     
     ''' Major sub function, takes ncbi tree and returns urls
         from WikiSpecies for thumbnails that correspond
-        to each leaf in the tree '''
+        to each leaf in the tree, or in each of a list of trees '''
     def thumbnailUrls(self, t, size):
+        trees = t if type(t) == list else [t]
+        
         # Compile names and ranks of the trees leaves
         taxa = {}
-        for node in t.iter_leaves():
-            taxa[node.sci_name] = node.rank
+        leaves = {}
+        for tree in trees:
+            for node in tree.iter_leaves():
+                taxa[node.sci_name] = node.rank
+                leaves.setdefault(node.sci_name, node)
         
-        # Get list of queries using names and ranks
-        queries = self.thumbnailQueries(taxa, size)
+        # Get list of queries using names and ranks, then match names with urls
+        with instruments.span('thumbnails.queries'):
+            queries = self.thumbnailQueries(taxa, size)
+        with instruments.span('thumbnails.match'):
+            urls = self.matchThumbnails(taxa, queries)
+        
+        # Attempts to find thumbnails for missed taxa, using the first descendant with a thumbnail
+        # The descendants of every missed taxa are queried together, in one batched round of requests
+        missed = {}
+        for node in leaves.values():
+            if node.sci_name not in urls and self.rankDepth.get(node.rank, len(self.ranks)) < self.rankDepth['species']:
+                node_t = self.ncbi.get_descendant_taxa(node.name, return_tree=True)
+                if type(node_t) is not list:
+                    missed[node.sci_name] = {subnode.sci_name: subnode.rank for subnode in node_t.iter_leaves()}
         
-        # Compiles pages into a single list
-        pages = []
+        if missed:
+            descendants = {}
+            for node_taxa in missed.values():
+                descendants.update(node_taxa)
+            
+            with instruments.span('thumbnails.fallback'):
+                descendant_urls = self.matchThumbnails(descendants, self.thumbnailQueries(descendants, size))
+            for name, node_taxa in missed.items():
+                for subname in node_taxa:
+                    if subname in descendant_urls:
+                        urls[name] = descendant_urls[subname]
+                        break
+                                            
+        return urls
+    
+    ''' Matches taxa names to thumbnail sources from a list of queries, in linear time.
+        Exact page titles take precedence over 'Name (Family)' disambiguation titles
+    '''
+    def matchThumbnails(self, taxa, queries):
+        exact = {}
+        disambiguated = {}
         for query in queries:
             for page in query['pages'].values():
-                pages.append(page)
+                source = page.get('thumbnail', {}).get('source')
+                if source is None or self.isGeneric(source):
+                    continue
                 
-        # Matches names with urls
+                title = self.normalizeTitle(page['title'])
+                exact[title] = source
+                if title.endswith(')') and ' (' in title:
+                    disambiguated.setdefault(title[:title.rindex(' (')], source)
+        
         urls = {}
         for name in taxa:
-            for page in pages:
-                if name in page['title']:
-                    try:
-                        if any(i in page['thumbnail']['source'] for i in self.data['genericImages']):
-                            continue
-                        else:
-                            urls[name] = page['thumbnail']['source']
-                    except:
-                        continue
-        
-        # Attempts to find thumbnails for missed taxa
-        for node in t.iter_leaves():
-            if node.sci_name not in urls.keys() and node.rank in self.ranks and self.ranks.index(node.rank) < self.ranks.index('species'):
-                node_t = ncbi.get_descendant_taxa(node.name, return_tree=True)
-                node_taxa = {}
-                if type(node_t) is not list:
-                    for subnode in node_t.iter_leaves():
-                        node_taxa[subnode.sci_name] = subnode.rank
-
-                    node_queries = self.thumbnailQueries(node_taxa, size)
-                    node_pages = []
-                    for query in node_queries:
-                        for page in query['pages'].values():
-                            node_pages.append(page)
-
-                    for name in node_taxa:
-                        for page in node_pages:
-                            if name in page['title']:
-                                try:
-                                    if any(i in page['thumbnail']['source'] for i in self.data['genericImages']):
-                                        continue
-                                    else:
-                                        urls[node.sci_name] = page['thumbnail']['source']
-                                except:
-                                    continue
-                                            
+            key = self.normalizeTitle(name)
+            source = exact.get(key, disambiguated.get(key))
+            if source is not None:
+                urls[name] = source
         return urls
     
-    ''' Batch queries taxa names 48/49 at once and returns list of queries '''
+    # Normalizes names and page titles the way MediaWiki does, for use as index keys
+    def normalizeTitle(self, title):
+        title = title.replace('_', ' ').strip()
+        return title[:1].upper() + title[1:]
+    
+    # Checks a thumbnail source against the generic images, using the original file name of thumb urls
+    def isGeneric(self, source):
+        parts = source.split('/')
+        filename = parts[-2] if '/thumb/' in source and len(parts) > 1 else parts[-1]
+        return unquote(filename) in self.genericImages
+    
+    ''' Batch queries taxa names, and 'Name (Family)' titles for taxa between family and species rank,
+        as many at once as the API allows, and returns list of queries '''
     def thumbnailQueries(self, taxa, size):
         params = {'prop': 'pageimages', 'piprop': 'thumbnail', 'pithumbsize': size}
         
-        queries = []
+        # Resolves disambiguation families for all taxa between family and species rank before any request
+        family, species = self.rankDepth['family'], self.rankDepth['species']
+        lower = [name for name, rank in taxa.items() if family < self.rankDepth.get(rank, -1) < species]
+        families = getParents(lower, rank='family', mode='name')
         
         titles = []
         for name, rank in taxa.items():
             titles.append(name)
-            
-            if rank in self.ranks and self.ranks.index(rank) < self.ranks.index('family'):
-                fam = getParent(name, rank='family', mode='name')
-                titles.append(f'{name} ({fam})')
-                
-            if len(titles) >= 48:
-                params['titles'] = '|'.join(titles)
-                query = self.wiki.query(params=params)
-                if query is not None:
-                    queries.append(query)
-                
-                titles = []
-                params['titles'] = ''
-                
-        if len(titles) > 0:
-            params['titles'] = '|'.join(titles)
-            query = self.wiki.query(params=params)
-            if query is not None:
-                queries.append(query)
-                
-        return queries
+            if families.get(name) is not None:
+                titles.append(f'{name} ({families[name]})')
         
-    ''' All-in-one function for getting a formatted tree with optional thumbnails for a given taxid '''
-    def getTree(self, taxa, rank='family', unclassified=False, clean=True, thumbnails=True):
+        return self.wiki.queryTitles(titles, params)
+        
+    ''' All-in-one function for getting a formatted tree with optional thumbnails for a given taxid
+        With compact, the tree is loaded and pruned as a CompactTree and only converted to an ete3 tree once pruned,
+        given lowerTaxa are kept below rank with pruneTaxa '''
+    def getTree(self, taxa, rank='family', unclassified=False, clean=True, thumbnails=True, compact=False, lowerTaxa=None):
         taxa = getTaxid(taxa)
         
         if taxa is not None:
-            tree = self.ncbi.get_descendant_taxa(taxa, return_tree=True)
-            prunedTree = self.pruneToRank(tree, rank)
-            if prunedTree is not None:
-                if thumbnails:
-                    self.getThumbnails(prunedTree)
-                return prunedTree
+            with instruments.span('getTree'):
+                prunedTree = self.loadTree(taxa, rank, unclassified, clean, compact, lowerTaxa)
+                if prunedTree is not None:
+                    if thumbnails:
+                        with instruments.span('thumbnails'):
+                            self.getThumbnails(prunedTree)
+                    return prunedTree
         else:
             print('Taxa invalid, try again')
             return
         
+    ''' Batch version of getTree, returns a dictionary of each given taxa and its tree.
+        Taxids are resolved in one lookup, and only the topmost taxa of overlapping lineages
+        are loaded and pruned; trees for taxa nested under them are copied out of the pruned
+        ancestor tree. Thumbnails are queried and downloaded for all trees at once, and with
+        render the trees are saved in the given format on a pool of worker processes '''
+    def getTrees(self, taxaList, rank='family', unclassified=False, clean=True, thumbnails=True, compact=False, 
+                 render=False, _format='svg', workers=None):
+        taxids = getTaxids(taxaList)
+        for taxa in taxaList:
+            if taxids.get(taxa) is None:
+                print(f'Taxa {taxa} invalid, skipping')
+        taxids = {taxa: taxid for taxa, taxid in taxids.items() if taxid is not None}
+        
+        # Finds the topmost requested ancestor of each requested taxa
+        requested = set(taxids.values())
+        lineages = getLineages(list(requested))
+        tops = {}
+        for taxid in requested:
+            ancestors = [tax for tax in (lineages.get(taxid) or [])[:-1] if tax in requested]
+            tops[taxid] = ancestors[0] if ancestors else taxid
+        
+        trees = {}
+        for taxid in dict.fromkeys(taxids.values()):
+            if tops[taxid] == taxid:
+                trees[taxid] = self.loadTree(taxid, rank, unclassified, clean, compact)
+        
+        # Copies nested trees out of their pruned ancestor, loading them on their own if pruned away
+        nodes = {}
+        for taxid, top in tops.items():
+            if top != taxid:
+                if top not in nodes:
+                    nodes[top] = {int(node.name): node for node in trees[top].traverse()} if trees[top] is not None else {}
+                node = nodes[top].get(taxid)
+                trees[taxid] = node.copy() if node is not None else self.loadTree(taxid, rank, unclassified, clean, compact)
+        
+        trees = {taxa: trees[taxids[taxa]] for taxa in taxaList if taxa in taxids and trees[taxids[taxa]] is not None}
+        if thumbnails and trees:
+            self.getThumbnails(list({id(t): t for t in trees.values()}.values()))
+        if render and trees:
+            self.saveTrees(list(trees.values()), _format, workers=workers)
+        return trees
+    
+    # Loads the NCBI tree under a taxid and prunes it to rank, as an ete3 tree or through a CompactTree
+    def loadTree(self, taxid, rank, unclassified=False, clean=True, compact=False, lowerTaxa=None):
+        if compact and not lowerTaxa:
+            with instruments.span('ncbi.descendants'):
+                compactTree = CompactTree.fromNCBI(taxid, self.ncbi.dbfile)
+            if compactTree is None:
+                return
+            with instruments.span('prune.compact'):
+                prunedTree = compactTree.pruneToRank(rank, unclassified, clean)
+            return prunedTree.toTree() if prunedTree is not None else None
+        
+        with instruments.span('ncbi.descendants'):
+            tree = self.ncbi.get_descendant_taxa(taxid, return_tree=True)
+        if type(tree) == list:
+            print(f'Taxa {taxid} has no descendant taxa')
+            return
+        if lowerTaxa:
+            return self.pruneTaxa(tree, rank, lowerTaxa, unclassified, clean)
+        return self.pruneToRank(tree, rank, unclassified, clean)
+        
     ''' Using multiple sub functions, 
         takes an NCBI tree and a given rank, 
         removes all nodes of lower ranks '''
     def pruneToRank(self, t, rank, unclassified=False, clean=True):
-        if clean:
-            self.cleanTree(t)
-
-        prunedTree = self.detachLowerRanks(t, rank)
+        with instruments.span('prune.detachLowerRanks'):
+            prunedTree = self.detachLowerRanks(t, rank)
         if prunedTree is not None:
-            if not unclassified:
-                self.removeUnclassified(prunedTree)
-            return prunedTree
+            with instruments.span('prune.filterTree'):
+                return self.filterTree(prunedTree, clean, unclassified)
         else:
             return
         
@@ -155,25 +246,28 @@ class Taxonomy:
         Prunes to given rank while keeping given lower taxa intact
     '''
     def pruneTaxa(self, t, rank, taxa, unclassified=False, clean=True):
-        for key, tax in enumerate(taxa):
-            if type(tax) == str:
-                taxa[key] = getTaxid(tax)
+        taxa = list(getTaxids(taxa).values())
+        parents = getParents(taxa, rank)
+        ranks = getRanks(taxa)
+        names = getNames(taxa)
         
         taxaParents = {}
-        for tax in taxa:
-            lineage = self.ncbi.get_lineage(tax)
-            for parent in lineage:
-                if getRank(parent) == rank:
-                    taxNode = self.pruneToRank(self.ncbi.get_descendant_taxa(tax, return_tree=True), rank=getRank(tax))
-                    taxaParents[taxNode] = parent
-        
-        if clean:
-            self.cleanTree(t)
+        for tax, parent in parents.items():
+            taxTree = self.ncbi.get_descendant_taxa(tax, return_tree=True)
+            # Taxa without descendants, such as species, come back as a list of their own taxid,
+            # they get a single node of the same tree class as t so that it can be attached to it
+            if type(taxTree) == list:
+                taxTree = type(t)()
+                taxTree.name = str(tax)
+                taxTree.add_features(sci_name=names.get(tax), rank=ranks[tax], taxid=tax)
+            taxNode = self.pruneToRank(taxTree, rank=ranks[tax])
+            taxaParents[taxNode] = parent
         
-        prunedTree = self.detachLowerRanks(t, rank)
+        with instruments.span('prune.detachLowerRanks'):
+            prunedTree = self.detachLowerRanks(t, rank)
         if prunedTree is not None:
-            if not unclassified:
-                self.removeUnclassified(prunedTree)
+            with instruments.span('prune.filterTree'):
+                self.filterTree(prunedTree, clean, unclassified)
             if taxaParents:
                 for leaf in prunedTree.iter_leaves():
                     if int(leaf.name) in taxaParents.values():
@@ -185,77 +279,346 @@ class Taxonomy:
         else:
             return
     
-    ''' Removes all nodes below given rank
-        Starts by removing lowest ranks, then moves upward
-        Then removes subnodes of taxa at given rank '''
+    ''' Removes all nodes below given rank in a single traversal
+        Nodes ranked lower than the given rank are detached along with their subtrees,
+        then nodes at the given rank have all of their descendants detached '''
     def detachLowerRanks(self, t, rank):
-        prunedTree = t
-        
-        if (type(rank)) == str and rank in self.ranks:
-            rank = self.ranks.index(rank)
+        if type(rank) == str and rank in self.rankDepth:
+            rank = self.rankDepth[rank]
 
         if type(rank) == int and rank <= len(self.ranks) - 1:
-            for r in reversed(self.ranks):
-                if self.ranks.index(r) > rank:
-                    for node in prunedTree.search_nodes(rank=r):
-                        node.detach()
-                if self.ranks.index(r) == rank:
-                    for node in prunedTree.search_nodes(rank=r):
-                        for subnode in node.iter_descendants():
-                            subnode.detach()
-            return prunedTree
+            rankDepth = self.rankDepth
+            
+            nodes = [t]
+            while nodes:
+                node = nodes.pop()
+                if rankDepth.get(node.rank) == rank:
+                    for child in node.get_children():
+                        child.detach()
+                    continue
+                    
+                for child in node.get_children():
+                    depth = rankDepth.get(child.rank)
+                    if depth is not None and depth > rank:
+                        child.detach()
+                    else:
+                        nodes.append(child)
+            return t
         else:
             print("Invalid Rank Type - Requires Valid Rank String or Int Between 0 and 26")
             return None
     
+    ''' Removes 'environmental samples' nodes, outdated taxa, and unclassified and incertae sedis taxa
+        without ranked subtaxa in one pass. Cleaned subtrees are skipped on the way down, then nodes
+        are visited children first so whether a node has ranked descendants is known from its children.
+        Detaching and cleaning only remove whole subtrees, so this can run before or after detachLowerRanks '''
+    def filterTree(self, t, clean=True, unclassified=False):
+        rankDepth, oldTaxa, pattern = self.rankDepth, self.oldTaxa, self.unclassifiedPattern
+
+        nodes, dropped = [], []
+        stack = [t]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            for child in node.children:
+                if clean and ('environmental' in child.sci_name or child.sci_name in oldTaxa):
+                    dropped.append(child)
+                else:
+                    stack.append(child)
+        for node in dropped:
+            node.detach()
+
+        if not unclassified:
+            hasRanked = set()
+            for node in reversed(nodes):
+                if node is t:
+                    break
+                below = node in hasRanked
+                if below or node.rank in rankDepth:
+                    hasRanked.add(node.up)
+                if not below and pattern.search(node.sci_name):
+                    node.detach()
+        return t
+
     ''' Removes unclassified and incertae sedis taxa, if they have no valid subtaxa '''
     def removeUnclassified(self, t):
-        for node in t.iter_descendants():
-            if 'unclassified' in node.sci_name or 'incertae' in node.sci_name:
-                keep = False
-                for subnode in node.iter_descendants():
-                    if subnode.rank in self.ranks:
-                        keep = True
-                if not keep:
-                    node.detach()
+        self.filterTree(t, clean=False)
 
     ''' Removes 'environmental samples' nodes and outdated taxa '''
     def cleanTree(self, t):
-        for node in t.iter_descendants():
-            if 'environmental' in node.sci_name:
-                node.detach()
-            if node.sci_name in data['oldTaxa']:
-                node.detach()
+        self.filterTree(t, unclassified=True)
 
     ''' Renders given tree to given format, outputs to trees subdirectory '''
     def saveTree(self, t, _format='svg', layout=rankedLayout):
-        directory = os.path.join(root, 'trees', f'{t.sci_name}.{_format}')
-        t.render(directory, layout=layout)
+        return self.saveTrees([t], _format, layout, workers=1)[0]
 
-def main():
-    tax = Taxonomy()
+    ''' Renders a list of trees to one or more formats, outputs to trees subdirectory.
+        Each tree and format is a separate job on a pool of spawned worker processes, as forking after Qt
+        has started is unsafe, with as many workers as given or by default at most one per CPU.
+        Jobs are rendered in this process instead with a single worker or fewer jobs than workers,
+        where starting the pool and pickling trees to it costs more than it saves.
+        Renders are recorded in trees/renders.json under a hash of the tree, layout and format,
+        and are skipped when the file is already there with the same hash, unless forced.
+        Given a renders dictionary, renders are added to it instead, for the caller to record them
+        with recordRenders, as runJobs does for its worker processes '''
+    def saveTrees(self, trees, _format='svg', layout=rankedLayout, workers=None, force=False, renders=None):
+        formats = [_format] if type(_format) == str else list(_format)
+        workers = workers or min(self.data['treeRender']['workers'], os.cpu_count() or 1)
+        manifestPath = os.path.join(root, 'trees', 'renders.json')
+        manifest = json.load(open(manifestPath)) if os.path.exists(manifestPath) else {}
+        
+        paths = []
+        jobs = {}
+        for t in trees:
+            newick = t.write(format=1, features=['sci_name', 'rank', 'thumbnail'])
+            for form in formats:
+                filename = f'{t.sci_name}.{form}'
+                path = os.path.join(root, 'trees', filename)
+                key = self.renderKey(newick, layout, form)
+                paths.append(path)
+                
+                if not force and manifest.get(filename) == key and os.path.exists(path):
+                    print(f'Using render from memory for {filename}')
+                else:
+                    jobs[path] = (t, key)
+        
+        with instruments.span('render'):
+            if workers > 1 and len(jobs) >= workers:
+                with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    list(pool.map(renderTree, [t for t, key in jobs.values()], jobs.keys(), [layout] * len(jobs)))
+            else:
+                for path, (t, key) in jobs.items():
+                    renderTree(t, path, layout)
+        
+        rendered = {os.path.basename(path): key for path, (t, key) in jobs.items()}
+        if renders is not None:
+            renders.update(rendered)
+        elif rendered:
+            recordRenders(rendered)
+        return paths
     
-    '''
-    taxa = input("Enter a Taxa (Scientific Name or NCBI ID): ")
-    rank = input("Rank: ").lower()
+    # Hash of a tree's newick with features, the layout function and palette, and the output format
+    def renderKey(self, newick, layout, _format):
+        layoutName = f'{layout.__module__}.{layout.__qualname__}'
+        palette = json.dumps(self.data['rankedPalette'], sort_keys=True)
+        return hashlib.sha256('\n'.join([newick, layoutName, palette, _format]).encode()).hexdigest()
+
+# Adds renders to trees/renders.json, rereading it first as other processes may have rendered trees since it was loaded.
+# The file is replaced in one step, so that it is never read half written
+def recordRenders(renders):
+    manifestPath = os.path.join(root, 'trees', 'renders.json')
+    manifest = json.load(open(manifestPath)) if os.path.exists(manifestPath) else {}
+    manifest.update(renders)
+    temp = manifestPath + f'.{os.getpid()}'
+    with open(temp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp, manifestPath)
+
+# Renders a tree to path, at module level so it can run in worker processes
+def renderTree(t, path, layout=rankedLayout):
+    t.render(path, layout=layout)
+    return path
+
+# ------------------------------
+# BATCH JOBS
+
+jobDefaults = {'rank': 'family', 'lowerTaxa': [], 'thumbnails': True, 'format': ['svg'], 'compact': False}
+
+''' Reads a CSV or JSON manifest of tree jobs. Each job has a taxa and optionally a rank, lowerTaxa,
+    thumbnails and format; in CSV files lowerTaxa and format are separated by ';'.
+    Missing values are taken from defaults '''
+def readManifest(path, defaults=jobDefaults):
+    with open(path, newline='') as f:
+        rows = json.load(f) if path.endswith('.json') else list(csv.DictReader(f))
     
-    savedTaxa = []
-    savedTaxaResponse = input("Would you like to keep any lower taxa (Y|N)").lower()
-    if savedTaxaResponse == 'y' or savedTaxaResponse == 'yes':
-        savedTaxaNames = input("Enter taxa names (i.e. 'taxa, taxa, taxa')").split(", ")
-        for name in savedTaxaNames:
-            nameToID = getTaxid(name)
-            savedTaxa.append(nameToID)
+    jobs = []
+    for row in rows:
+        job = {**defaults, **{key: value for key, value in row.items() if value not in (None, '')}}
+        for key in ('lowerTaxa', 'format'):
+            if type(job[key]) == str:
+                job[key] = [value.strip() for value in job[key].split(';') if value.strip()]
+        for key in ('thumbnails', 'compact'):
+            if type(job[key]) == str:
+                job[key] = job[key].strip().lower() in ('1', 'y', 'yes', 'true')
+        job['taxa'] = int(job['taxa']) if str(job['taxa']).isdigit() else job['taxa']
+        jobs.append(job)
+    return jobs
+
+# Identifies a job by its settings, for the job state file
+def jobKey(job):
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+# Taxonomy of each worker process, created once per process so its caches stay warm between jobs.
+# Workers open the same NCBI database as the process that started them
+worker = None
+
+def initWorker(instrument=None, dbfile=None):
+    global worker
+    setNCBI(dbfile)
+    worker = Taxonomy()
+    if instrument is not None:
+        instruments.enable(**instrument)
+
+# Runs one job through getTree, getThumbnails and saveTrees, returns its state entry and the time of each stage
+def runJob(job):
+    tax = worker or Taxonomy()
+    timings = {}
     
-    thumbnailsResponse = input("Thumbnails? (Y|N)").lower()
-    if thumbnailsResponse == 'y' or thumbnailsResponse == 'yes':
-        thumbnails = True
+    start = time.perf_counter()
+    tree = tax.getTree(job['taxa'], rank=job['rank'], thumbnails=False, compact=job['compact'], lowerTaxa=job['lowerTaxa'])
+    timings['tree'] = time.perf_counter() - start
+    if tree is None:
+        return None, timings
+    
+    if job['thumbnails']:
+        start = time.perf_counter()
+        tax.getThumbnails(tree)
+        timings['thumbnails'] = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    renders = {}
+    outputs = tax.saveTrees([tree], job['format'], workers=1, renders=renders)
+    timings['render'] = time.perf_counter() - start
+    return {'taxid': int(tree.name), 'outputs': outputs, 'renders': renders}, timings
+
+# Runs a job in a worker process, returning the spans and counters it recorded so they can be merged
+def runWorkerJob(job):
+    instruments.reset()
+    return (*runJob(job), instruments.snapshot() if instruments.enabled else None)
+
+''' Runs jobs on a pool of worker processes, skipping jobs whose outputs are up to date:
+    the job state file records each finished job with its root taxid, outputs and the NCBI database version.
+    Given the diffTaxonomy diff of an NCBI update, jobs built from the old database are only rerun if
+    their root taxid is affected by the update, the others are carried over to the new version.
+    Prints a timing summary per stage at the end, and returns the state of every job '''
+def runJobs(jobs, workers=1, statePath=None, force=False, diff=None):
+    statePath = statePath or os.path.join(root, 'trees', 'jobs.json')
+    state = json.load(open(statePath)) if os.path.exists(statePath) else {}
+    version = ncbiVersion()
+    
+    pending = {}
+    carried = 0
+    for job in jobs:
+        key = jobKey(job)
+        entry = state.get(key)
+        upToDate = entry is not None and 'error' not in entry and all(os.path.exists(path) for path in entry['outputs'])
+        if upToDate and entry['version'] != version:
+            upToDate = (diff is not None and entry['version'] == diff['versions'][0]
+                        and entry['taxid'] not in diff['affected'] and job['taxa'] not in diff['names'])
+            if upToDate and not force:
+                entry['version'] = version
+                carried += 1
+    
+        if not force and upToDate:
+            print(f"Skipping {job['taxa']}, up to date")
+        else:
+            pending[key] = job
+    
+    if carried:
+        print(f'{carried} jobs unaffected by the NCBI update')
+        with open(statePath, 'w') as f:
+            json.dump(state, f, indent=1)
+    
+    stages = {}
+    def record(key, job, entry, timings):
+        for stage, seconds in timings.items():
+            stages.setdefault(stage, []).append(seconds)
+        if entry is None:
+            return fail(key, job, 'no tree')
+        # Renders are only recorded here, as workers rewriting the render manifest at once would lose each other's
+        renders = entry.pop('renders')
+        if renders:
+            recordRenders(renders)
+        save(key, {**entry, 'taxa': job['taxa'], 'version': version})
+    
+    # Failed jobs are kept in the state file with their error, and run again next time
+    def fail(key, job, error):
+        print(f"Job for {job['taxa']} failed: {error}")
+        save(key, {'taxa': job['taxa'], 'version': version, 'outputs': [], 'error': error})
+    
+    def save(key, entry):
+        state[key] = entry
+        with open(statePath, 'w') as f:
+            json.dump(state, f, indent=1)
+    
+    start = time.perf_counter()
+    if workers > 1 and len(pending) > 1:
+        context = multiprocessing.get_context('spawn')
+        instrument = {'profile': False, 'memory': instruments.memory} if instruments.enabled else None
+        with ProcessPoolExecutor(min(workers, len(pending)), mp_context=context, initializer=initWorker, initargs=(instrument, ncbi.dbfile)) as pool:
+            futures = {pool.submit(runWorkerJob, job): key for key, job in pending.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    entry, timings, snapshot = future.result()
+                    record(key, pending[key], entry, timings)
+                    if snapshot is not None:
+                        instruments.merge(snapshot)
+                except Exception as e:
+                    fail(key, pending[key], f'{type(e).__name__}: {e}')
     else:
-        thumbnails = False
+        global worker
+        worker = worker or Taxonomy()
+        for key, job in pending.items():
+            try:
+                record(key, job, *runJob(job))
+            except Exception as e:
+                fail(key, job, f'{type(e).__name__}: {e}')
     
-    tree = tax.getTree(taxa, rank=rank, thumbnails=thumbnails)
-    if tree is not None:
-        tax.saveTree(tree)
-    '''
+    failed = sum('error' in state.get(key, {}) for key in pending)
+    print(f'\n{len(pending)} jobs run, {failed} failed, {len(jobs) - len(pending)} up to date, {time.perf_counter() - start:.1f}s')
+    for stage, times in stages.items():
+        print(f'{stage:<12} jobs {len(times):>5}   total {sum(times):10.2f}s   mean {sum(times) / len(times):8.2f}s   max {max(times):8.2f}s')
+    return state
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds and renders taxonomy trees in batches')
+    parser.add_argument('manifest', nargs='?', help='CSV or JSON manifest of jobs (taxa, rank, lowerTaxa, thumbnails, format)')
+    parser.add_argument('--taxa', nargs='+', default=[], help='taxa to build trees for, in addition to the manifest')
+    parser.add_argument('--rank', default=jobDefaults['rank'], help='default rank to prune trees to')
+    parser.add_argument('--format', nargs='+', default=jobDefaults['format'], help='default output formats')
+    parser.add_argument('--no-thumbnails', dest='thumbnails', action='store_false', help='skip thumbnails by default')
+    parser.add_argument('--compact', action='store_true', help='load and prune trees as CompactTrees')
+    parser.add_argument('--workers', type=int, default=data['treeRender']['workers'], help='number of worker processes')
+    parser.add_argument('--state', help='job state file, trees/jobs.json by default')
+    parser.add_argument('--force', action='store_true', help='rerun jobs even if they are up to date')
+    parser.add_argument('--update', metavar='TAXDUMP', nargs='?', const='', help='update the NCBI database first, from a taxdump file if given, and only rerun jobs the update affects')
+    parser.add_argument('--since', metavar='TAXA_SQLITE', help='only rerun jobs affected by changes from this older NCBI database to the current one')
+    parser.add_argument('--matrices', metavar='NPZ', nargs='+', default=[], help='saved distribution matrices to drop changed and removed taxa from after --update or --since')
+    parser.add_argument('--instrument', metavar='JSON', nargs='?', const='', help='report stage spans and counters, and export them to JSON if given')
+    parser.add_argument('--profile', action='store_true', help='with --instrument, also run cProfile in the main process')
+    parser.add_argument('--memory', action='store_true', help='with --instrument, also trace memory with tracemalloc')
+    args = parser.parse_args()
+    
+    if args.instrument is not None:
+        instruments.enable(args.profile, args.memory)
+    
+    defaults = {**jobDefaults, 'rank': args.rank, 'format': args.format, 'thumbnails': args.thumbnails, 'compact': args.compact}
+    jobs = readManifest(args.manifest, defaults) if args.manifest else []
+    jobs += [{**defaults, 'taxa': int(taxa) if taxa.isdigit() else taxa} for taxa in args.taxa]
+    if not jobs:
+        parser.error('no jobs given, pass a manifest or --taxa')
+    
+    diff = None
+    if args.update is not None:
+        diff = updateNCBI(args.update or None)
+    elif args.since:
+        diff = diffTaxonomy(args.since)
+        ncbiCache.invalidate(diff)
+    if diff is not None:
+        print(', '.join(f'{len(diff[kind])} {kind}' for kind in ('added', 'removed', 'renamed', 'reparented', 'reranked')) + ' taxa')
+        for path in args.matrices:
+            matrix = DistributionMatrix.load(path)
+            dropped = matrix.invalidate(diff) if matrix is not None else 0
+            if dropped:
+                matrix.save(path)
+                print(f'{dropped} taxa dropped from {path}')
+    
+    runJobs(jobs, args.workers, args.state, args.force, diff)
+    if instruments.enabled:
+        print()
+        instruments.report()
+        if args.instrument:
+            instruments.export(args.instrument)
     
-if __name__ == '__main__': main()
\ No newline at end of file
+if __name__ == '__main__': main()
@@ -1,43 +1,364 @@
-import os, json
+import os, json, shutil, sqlite3, threading
+from collections import OrderedDict
 from ete3 import Tree, NCBITaxa, TreeStyle, NodeStyle, faces, AttrFace, ImgFace
+from instrumentation import *
 
 root = os.getcwd()
 data = json.load(open(os.path.join(root, 'taxa.json')))
-ncbi = NCBITaxa()
+instruments = Instrumentation(**data['instrumentation'])
+
+''' Shared object created by factory on first use, so that importing doesn't open, create or download
+    anything. Modules use it through globals such as ncbi, attributes are read from and set on the object itself.
+    The object is returned by instance rather than get, which the shared objects define themselves.
+    reset drops it, to be created again on next use, by another factory if given
+'''
+class SharedInstance:
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_instance', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+    
+    def instance(self):
+        with self._lock:
+            if self._instance is None:
+                object.__setattr__(self, '_instance', self._factory())
+            return self._instance
+    
+    def reset(self, factory=None):
+        with self._lock:
+            if factory is not None:
+                object.__setattr__(self, '_factory', factory)
+            object.__setattr__(self, '_instance', None)
+    
+    def __getattr__(self, name):
+        return getattr(self.instance(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(self.instance(), name, value)
+
+# Opens an NCBITaxa, downloading the database on a first run, and counts its queries while instrumentation is on
+def openNCBI(dbfile=None):
+    taxa = NCBITaxa(dbfile=dbfile)
+    taxa.db.set_trace_callback(traceQuery if instruments.enabled else None)
+    return taxa
+
+# Shared NCBITaxa, used by every module and class. Use setNCBI to switch to another taxa.sqlite
+ncbi = SharedInstance(openNCBI)
+
+# Points the shared ncbi at another taxa.sqlite, or back at ete3's default with None
+def setNCBI(dbfile=None):
+    ncbi.reset(lambda: openNCBI(dbfile))
+
+def traceQuery(statement):
+    instruments.count('sqlite.queries')
+
+# Turns query counting on or off for an NCBI database that is already open
+def traceNCBI(enabled):
+    if ncbi._instance is not None:
+        ncbi._instance.db.set_trace_callback(traceQuery if enabled else None)
+
+instruments.hooks.append(traceNCBI)
 
 # ------------------------------
 # TREE LAYOUT FUNCTIONS AND STYLES
 
+# Attribute faces and per rank node styles, built once and shared by every node they're added to
+nameFace = AttrFace("sci_name")
+rankFace = AttrFace("rank")
+rankedStyles = {rank: NodeStyle(bgcolor=color) for rank, color in data['rankedPalette'].items()}
+
 # Adds attribute faces for scientific names and ranks; base function to be used in other layouts
 def taxaNameplate(node):
-    faces.add_face_to_node(AttrFace("sci_name"), node, column=0)
-    faces.add_face_to_node(AttrFace("rank"), node, column=0)
+    faces.add_face_to_node(nameFace, node, column=0)
+    faces.add_face_to_node(rankFace, node, column=0)
 
 # Colors nodes based on rank, using predetermined palette; (Includes taxa nameplate layout)
 def rankedLayout(node):
-    palette = data['rankedPalette']
-    
     taxaNameplate(node)
-    for rank in palette.keys():
-        if node.rank == rank:
-            nstyle = NodeStyle()
-            nstyle['bgcolor'] = palette[rank]
-            node.set_style(nstyle)
+    style = rankedStyles.get(node.rank)
+    if style is not None:
+        node.set_style(style)
+
+# ------------------------------
+# NCBI LOOKUP CACHE
+
+# Identifies the current NCBI database file, or another taxa.sqlite, changes whenever ncbi.update_taxonomy_database rewrites it
+def ncbiVersion(dbfile=None):
+    stat = os.stat(dbfile or ncbi.dbfile)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+''' Opens an sqlite store shared between threads and worker processes, creating its directory.
+    In WAL mode readers don't block the writer, and writers wait up to timeout seconds
+    for each other instead of failing with "database is locked"
+'''
+def openStore(path, timeout=60):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    store = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    store.execute('PRAGMA journal_mode=WAL')
+    store.execute('PRAGMA synchronous=NORMAL')
+    return store
+
+''' Bounded LRU cache of NCBI lookups (name to taxid, taxid to name, rank and lineage),
+    with an optional sqlite store on disk that persists between runs.
+    Both are cleared automatically when the NCBI database version changes, unless carried over an update with invalidate.
+    Keeps hit and miss counters per kind of lookup, see stats and exportStats
+'''
+class LookupCache:
+    def __init__(self, maxsize=100000, path=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+        self.version = None
+        self.lock = threading.RLock()
+        
+        self.store = None
+        if path is not None:
+            self.store = openStore(path)
+            self.store.execute('CREATE TABLE IF NOT EXISTS lookups (kind TEXT, key TEXT, value TEXT, PRIMARY KEY (kind, key))')
+            self.store.execute('CREATE TABLE IF NOT EXISTS meta (version TEXT)')
+            self.store.commit()
+    
+    # Empties memory and disk store if the NCBI database has changed since they were filled
+    def checkVersion(self):
+        version = ncbiVersion()
+        if version == self.version:
+            return
+        
+        self.entries.clear()
+        if self.store is not None:
+            stored = self.store.execute('SELECT version FROM meta').fetchone()
+            if stored is None or stored[0] != version:
+                self.store.execute('DELETE FROM lookups')
+                self.store.execute('DELETE FROM meta')
+                self.store.execute('INSERT INTO meta (version) VALUES (?)', (version,))
+                self.store.commit()
+        self.version = version
+    
+    ''' Takes a kind of lookup and list of keys, returns dictionary of cached values
+        and list of keys that still have to be resolved. Keys missing from memory
+        are looked up in the disk store in one query per 500 keys
+    '''
+    def lookup(self, kind, keys):
+        with self.lock:
+            self.checkVersion()
+            
+            found = {}
+            missing = []
+            for key in keys:
+                if (kind, key) in self.entries:
+                    self.entries.move_to_end((kind, key))
+                    found[key] = self.entries[(kind, key)]
+                else:
+                    missing.append(key)
+            
+            if missing and self.store is not None:
+                stored = {}
+                for i in range(0, len(missing), 500):
+                    chunk = [json.dumps(key) for key in missing[i:i + 500]]
+                    rows = self.store.execute(f'SELECT key, value FROM lookups WHERE kind = ? AND key IN ({",".join("?" * len(chunk))})', [kind] + chunk)
+                    for key, value in rows:
+                        stored[json.loads(key)] = json.loads(value)
+                self.remember(kind, stored)
+                found.update(stored)
+                missing = [key for key in missing if key not in stored]
+            
+            self.hits[kind] = self.hits.get(kind, 0) + len(found)
+            self.misses[kind] = self.misses.get(kind, 0) + len(missing)
+            return found, missing
+    
+    # Adds dictionary of keys and resolved values of given kind to memory and the disk store
+    def update(self, kind, values):
+        with self.lock:
+            self.remember(kind, values)
+            if self.store is not None:
+                self.store.executemany('INSERT OR REPLACE INTO lookups (kind, key, value) VALUES (?, ?, ?)',
+                                       [(kind, json.dumps(key), json.dumps(value)) for key, value in values.items()])
+                self.store.commit()
+    
+    # Adds values to memory only, evicting least recently used entries past maxsize
+    def remember(self, kind, values):
+        for key, value in values.items():
+            self.entries[(kind, key)] = value
+            self.entries.move_to_end((kind, key))
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+    
+    ''' Carries the cache over an NCBI update described by a diffTaxonomy diff, instead of emptying it:
+        only lookups of changed names and taxids, and lineages through moved or removed taxa, are dropped.
+        A cache filled from another database version than the diff's old one is left to checkVersion
+    '''
+    def invalidate(self, diff):
+        oldVersion, newVersion = diff['versions']
+        moved = diff['reparented'] | diff['removed']
+        def stale(kind, key, value):
+            if kind == 'taxid':
+                return key in diff['names']
+            return key in diff['taxids'] or (kind == 'lineage' and value is not None and not moved.isdisjoint(value))
+
+        with self.lock:
+            if self.version == oldVersion:
+                for entry in [entry for entry, value in self.entries.items() if stale(*entry, value)]:
+                    del self.entries[entry]
+                self.version = newVersion
+
+            if self.store is not None:
+                stored = self.store.execute('SELECT version FROM meta').fetchone()
+                if stored is not None and stored[0] == oldVersion:
+                    rows = self.store.execute('SELECT kind, key, value FROM lookups').fetchall()
+                    self.store.executemany('DELETE FROM lookups WHERE kind = ? AND key = ?',
+                                           [(kind, key) for kind, key, value in rows if stale(kind, json.loads(key), json.loads(value))])
+                    self.store.execute('UPDATE meta SET version = ?', (newVersion,))
+                    self.store.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version = None
+            if self.store is not None:
+                self.store.execute('DELETE FROM meta')
+                self.store.commit()
+    
+    # Returns hit and miss counters for each kind of lookup, and the number of entries in memory
+    def stats(self):
+        with self.lock:
+            kinds = set(self.hits) | set(self.misses)
+            stats = {kind: {'hits': self.hits.get(kind, 0), 'misses': self.misses.get(kind, 0)} for kind in kinds}
+            stats['size'] = len(self.entries)
+            return stats
+    
+    def exportStats(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=4)
+
+ncbiCache = SharedInstance(lambda: LookupCache(data['ncbiCache']['maxsize'],
+                                              os.path.join(root, 'cache', 'ncbi.sqlite') if data['ncbiCache']['persist'] else None))
+
+''' Resolves keys of given kind through the cache, sends the rest to query in one call
+    and caches what it returns, remembering keys it couldn't resolve as None.
+    Returns dictionary of keys and values for resolved keys only
+'''
+def cachedLookup(kind, keys, query):
+    found, missing = ncbiCache.lookup(kind, list(dict.fromkeys(keys)))
+    instruments.count('ncbi.lookups', len(found) + len(missing))
+    instruments.count('ncbi.cacheMisses', len(missing))
+    if missing:
+        resolved = query(missing)
+        resolved = {key: resolved.get(key) for key in missing}
+        ncbiCache.update(kind, resolved)
+        found.update(resolved)
+    return {key: value for key, value in found.items() if value is not None}
+
+# ------------------------------
+# NCBI UPDATES
+
+''' Compares two NCBI taxa.sqlite files, returns the sets of taxids added, removed, renamed, reparented
+    and reranked in newDB, along with every changed taxid, their old and new names, and the affected taxids:
+    the changed taxa and all their ancestors in either database, the taxa whose subtrees differ.
+    Both databases are compared in one sqlite connection, with the old one attached
+'''
+def diffTaxonomy(oldDB, newDB=None):
+    newDB = newDB or ncbi.dbfile
+    diff = {'versions': [ncbiVersion(oldDB), ncbiVersion(newDB)],
+            'added': set(), 'removed': set(), 'renamed': set(), 'reparented': set(), 'reranked': set(),
+            'taxids': set(), 'names': set(), 'affected': set()}
+
+    def mark(taxid, name, track):
+        diff['taxids'].add(taxid)
+        diff['names'].add(name)
+        diff['affected'].update(int(ancestor) for ancestor in track.split(','))
+
+    db = sqlite3.connect(newDB)
+    db.execute('ATTACH DATABASE ? AS old', (oldDB,))
+    for kind, database, other in (('added', 'main', 'old'), ('removed', 'old', 'main')):
+        for taxid, name, track in db.execute(f'SELECT taxid, spname, track FROM {database}.species WHERE taxid NOT IN (SELECT taxid FROM {other}.species)'):
+            diff[kind].add(taxid)
+            mark(taxid, name, track)
+
+    changed = db.execute('''SELECT new.taxid, new.parent != old.parent, new.spname != old.spname COLLATE BINARY, new.rank != old.rank,
+                                   new.spname, old.spname, new.track, old.track
+                            FROM main.species AS new JOIN old.species AS old ON new.taxid = old.taxid
+                            WHERE new.parent != old.parent OR new.spname != old.spname COLLATE BINARY OR new.rank != old.rank''')
+    for taxid, reparented, renamed, reranked, newName, oldName, newTrack, oldTrack in changed:
+        for kind, flag in (('reparented', reparented), ('renamed', renamed), ('reranked', reranked)):
+            if flag:
+                diff[kind].add(taxid)
+        mark(taxid, newName, newTrack)
+        mark(taxid, oldName, oldTrack)
+    db.close()
+    return diff
+
+''' Updates the NCBI database through ncbi.update_taxonomy_database, from a taxdump file if given,
+    keeping the previous database next to it as taxa.sqlite.previous. The lookup cache keeps
+    everything the update didn't change. Returns the diff between the previous and updated databases
+'''
+def updateNCBI(taxdump=None):
+    dbfile = ncbi.dbfile
+    previous = dbfile + '.previous'
+    shutil.copy2(dbfile, previous)
+
+    ncbi.update_taxonomy_database(taxdump)
+    ncbi.reset()
+
+    diff = diffTaxonomy(previous, dbfile)
+    ncbiCache.invalidate(diff)
+    return diff
 
 # ------------------------------
 # TAXA UTILITIES
 
 # returns parent at specified rank of given taxa
 def getParent(taxa, rank, mode='taxid'):
-    taxa = getTaxid(taxa)
+    return getParents([taxa], rank, mode).get(taxa)
+
+# takes list of taxa and returns dictionary of each taxa and its parent at specified rank, using one lineage and one rank query
+def getParents(taxa, rank, mode='taxid'):
+    taxids = getTaxids(taxa)
+    lineages = getLineages(list(set(taxids.values())))
+    
+    ancestors = set()
+    for lineage in lineages.values():
+        ancestors.update(lineage)
+    ranks = getRanks(list(ancestors))
+    
+    parents = {}
+    for tax, taxid in taxids.items():
+        for parent in lineages.get(taxid, []):
+            if ranks.get(parent) == rank:
+                parents[tax] = parent
+                break
     
-    lineage = ncbi.get_lineage(taxa)
-    for parent in lineage:
-        if ncbi.get_rank([parent])[parent] == rank:
-            if mode == 'taxid':
-                return parent
-            if mode == 'name':
-                return ncbi.get_taxid_translator([parent])[parent]
+    if mode == 'name':
+        names = getNames(list(set(parents.values())))
+        parents = {tax: names.get(parent) for tax, parent in parents.items()}
+    return parents
+
+# takes list of scientific names and/or taxids and returns dictionary of each taxa and its taxid
+def getTaxids(taxa):
+    taxids = {tax: tax for tax in taxa if type(tax) == int}
+    names = [tax for tax in taxa if type(tax) == str]
+    if names:
+        query = lambda names: {name: found[0] for name, found in ncbi.get_name_translator(names).items()}
+        taxids.update(cachedLookup('taxid', names, query))
+    return taxids
+
+# takes list of taxids and/or scientific names and returns dictionary of each taxa and its scientific name
+def getNames(taxa):
+    names = {tax: tax for tax in taxa if type(tax) == str}
+    taxids = [tax for tax in taxa if type(tax) == int]
+    if taxids:
+        names.update(cachedLookup('name', taxids, ncbi.get_taxid_translator))
+    return names
+
+# takes list of taxa and returns dictionary of each taxa and its rank
+def getRanks(taxa):
+    taxids = getTaxids(taxa)
+    ranks = cachedLookup('rank', list(set(taxids.values())), ncbi.get_rank)
+    return {tax: ranks[taxid] for tax, taxid in taxids.items() if taxid in ranks}
+
+# takes list of taxids and returns dictionary of each taxid and its lineage, from root to taxid
+def getLineages(taxids):
+    return cachedLookup('lineage', taxids, ncbi.get_lineage_translator)
 
 # takes single scientific name and returns single corresponding taxid
 def getTaxid(taxa):
@@ -47,10 +368,7 @@ def getTaxid(taxa):
         for spec_char, char in data['specialChars'].items():
             taxa.replace(spec_char, char)
 
-        taxa_to_taxid = ncbi.get_name_translator([taxa]).get(taxa)
-        if taxa_to_taxid is not None:
-            taxid = taxa_to_taxid[0]
-            return taxid
+        return getTaxids([taxa]).get(taxa)
     
 # takes single taxid and returns single corresponding scientific name         
 def getName(taxa):
@@ -59,15 +377,8 @@ def getName(taxa):
             taxa.replace(spec_char, char)
         return taxa
     else:
-        taxid_to_taxa = ncbi.get_taxid_translator([taxa]).get(taxa)
-        if taxid_to_taxa is not None:
-            taxa = taxid_to_taxa
-            return taxa
+        return getNames([taxa]).get(taxa)
 
 # takes single taxa and returns single corresponding rank
 def getRank(taxa):
-    if type(taxa) == str:
-        taxa = getTaxid(taxa)
-    
-    rank = ncbi.get_rank([taxa])[taxa]
-    return rank
\ No newline at end of file
+    return getRanks([taxa]).get(taxa)
@@ -0,0 +1,253 @@
+import os, pickle, sqlite3
+import numpy as np
+from taxutilities import *
+
+# Pre and postorder taxid lists of NCBI databases, by database file and the pickle's size and mtime
+traverses = {}
+
+''' Pre and postorder list of every taxid in an NCBI database, in which each taxid appears once before
+    and once after its descendants, leaves only once. Read from the traverse pickle ete3 writes next to
+    taxa.sqlite, once per version of the pickle, where ete3 reads it again on every get_descendant_taxa '''
+def ncbiTraverse(dbfile):
+    path = dbfile + '.traverse.pkl'
+    if not os.path.exists(path):
+        print(f'NCBI traverse not found, expected at {path}')
+        return
+
+    stat = os.stat(path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    cached = traverses.get(dbfile)
+    if cached is None or cached[0] != version:
+        with open(path, 'rb') as f:
+            cached = traverses[dbfile] = (version, pickle.load(f))
+    return cached[1]
+
+''' Compact array-backed taxonomy tree, an alternative to ete3 trees for large clades
+    Nodes are stored in breadth-first order, so each level of the tree is a contiguous
+    slice and every parent comes before its children. Each node is a position in the
+    taxid, parent, first child and next sibling arrays, with its rank as a small int
+    code and its name as an index into an interned string table.
+    Pruning and filtering passes work level by level on whole arrays and return
+    a new CompactTree; convert to an ete3 Tree with toTree only when rendering
+'''
+class CompactTree:
+    def __init__(self, taxids, parents, ranks, names):
+        taxids = np.asarray(taxids, dtype=np.int64)
+        parents = np.asarray(parents, dtype=np.int64)
+
+        # Interns ranks and names into string tables
+        rankNames, rankCodes = np.unique(np.asarray(ranks, dtype=object), return_inverse=True)
+        self.rankNames = list(rankNames)
+        self.rankDepth = np.array([data['ranks'].index(rank) if rank in data['ranks'] else -1 for rank in self.rankNames], dtype=np.int16)
+        strings, nameCodes = np.unique(np.asarray(names, dtype=object), return_inverse=True)
+        self.strings = list(strings)
+
+        # Parent taxids to positions, the root is the node whose parent isn't in the tree
+        order = np.argsort(taxids)
+        found = np.searchsorted(taxids[order], parents).clip(0, len(taxids) - 1)
+        parent = np.where((taxids[order][found] == parents) & (taxids != parents), order[found], -1)
+        root = np.flatnonzero(parent == -1)
+
+        # Breadth-first order, expanding one whole level of children at a time
+        children = np.argsort(parent, kind='stable')
+        counts = np.bincount(parent[parent >= 0], minlength=len(taxids))
+        offsets = np.concatenate([[0], np.cumsum(counts)]) + np.count_nonzero(parent < 0)
+
+        levels = [root]
+        while len(levels[-1]):
+            frontier = levels[-1]
+            total = counts[frontier].sum()
+            starts = np.repeat(offsets[frontier] - np.concatenate([[0], np.cumsum(counts[frontier])[:-1]]), counts[frontier])
+            levels.append(children[starts + np.arange(total)])
+        bfs = np.concatenate(levels)
+
+        self.setArrays(taxids[bfs], self.reindex(parent, bfs), rankCodes[bfs].astype(np.int8), nameCodes[bfs].astype(np.int32),
+                       np.repeat(np.arange(len(levels)), [len(level) for level in levels]).astype(np.int16))
+
+    # Converts parent positions to positions within the given ordering of nodes
+    def reindex(self, parent, order):
+        position = np.full(len(parent), -1, dtype=np.int64)
+        position[order] = np.arange(len(order))
+        mapped = parent[order]
+        return np.where(mapped >= 0, position[mapped.clip(0)], -1).astype(np.int32)
+
+    # Stores node arrays and derives first child, next sibling and level slices from them
+    def setArrays(self, taxid, parent, rank, name, level):
+        self.taxid = taxid
+        self.parent = parent
+        self.rank = rank
+        self.name = name
+        self.level = level
+
+        n = len(taxid)
+        self.firstChild = np.full(n, -1, dtype=np.int32)
+        nodes = np.arange(n, dtype=np.int32)
+        hasParent = parent >= 0
+        first = hasParent & np.concatenate([[True], parent[1:] != parent[:-1]])
+        self.firstChild[parent[first]] = nodes[first]
+
+        self.nextSibling = np.full(n, -1, dtype=np.int32)
+        same = hasParent[:-1] & (parent[1:] == parent[:-1])
+        self.nextSibling[:-1][same] = nodes[1:][same]
+
+        bounds = np.searchsorted(level, np.arange(level.max() + 2 if n else 1))
+        self.levels = [slice(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+    ''' Loads the subtree under given taxa straight from the ete3 taxa.sqlite. Its taxids are the span
+        between the two visits of taxa in the pre and postorder traverse ete3 keeps next to the database,
+        and their rows are read in a single join on the taxid primary key '''
+    @classmethod
+    def fromNCBI(cls, taxa, dbfile=None):
+        taxid = getTaxid(taxa)
+        if taxid is None:
+            print('Taxa invalid, try again')
+            return
+
+        dbfile = dbfile or ncbi.dbfile
+        traverse = ncbiTraverse(dbfile)
+        if traverse is None:
+            return
+        try:
+            start = traverse.index(taxid)
+        except ValueError:
+            print(f'Taxid {taxid} not found in the NCBI database')
+            return
+        # Leaves are only visited once
+        try:
+            end = traverse.index(taxid, start + 1)
+        except ValueError:
+            end = start
+
+        instruments.count('sqlite.queries')
+        db = sqlite3.connect(dbfile)
+        db.execute('CREATE TEMP TABLE subtree (taxid INTEGER PRIMARY KEY)')
+        db.executemany('INSERT OR IGNORE INTO subtree VALUES (?)', ((tax,) for tax in traverse[start:end + 1]))
+        rows = db.execute('SELECT species.taxid, parent, spname, rank FROM subtree JOIN species ON species.taxid = subtree.taxid').fetchall()
+        db.close()
+        if not rows:
+            print(f'Taxid {taxid} not found in the NCBI database')
+            return
+
+        taxids, parents, names, ranks = zip(*rows)
+        parents = [-1 if tax == taxid else parent for tax, parent in zip(taxids, parents)]
+        return cls(taxids, parents, ranks, names)
+
+    # Builds a compact tree from an ete3 tree with sci_name and rank features, such as an NCBI descendant tree
+    @classmethod
+    def fromTree(cls, t):
+        taxids, parents, ranks, names = [], [], [], []
+        for node in t.traverse('levelorder'):
+            taxids.append(int(node.name))
+            parents.append(int(node.up.name) if node.up is not None else -1)
+            ranks.append(node.rank)
+            names.append(node.sci_name)
+        return cls(taxids, parents, ranks, names)
+
+    def __len__(self):
+        return len(self.taxid)
+
+    def sciName(self, node):
+        return self.strings[self.name[node]]
+
+    def rankName(self, node):
+        return self.rankNames[self.rank[node]]
+
+    # Yields the positions of the children of a node
+    def children(self, node):
+        child = self.firstChild[node]
+        while child != -1:
+            yield child
+            child = self.nextSibling[child]
+
+    # Depth of each node's rank in the taxa.json ranks, -1 for unranked nodes
+    def depths(self):
+        return self.rankDepth[self.rank]
+
+    # Extends a mask of dropped nodes to their whole subtrees, one level at a time
+    def dropSubtrees(self, drop):
+        drop = drop.copy()
+        for level in self.levels[1:]:
+            drop[level] |= drop[self.parent[level]]
+        return drop
+
+    # Returns a new CompactTree with only the nodes kept in mask, which must include every kept node's parent
+    def subset(self, keep):
+        tree = object.__new__(CompactTree)
+        tree.rankNames, tree.rankDepth, tree.strings = self.rankNames, self.rankDepth, self.strings
+
+        order = np.flatnonzero(keep)
+        tree.setArrays(self.taxid[order], self.reindex(self.parent.astype(np.int64), order),
+                       self.rank[order], self.name[order], self.level[order])
+        return tree
+
+    # Marks nodes whose interned name matches function, testing each distinct name in the tree once
+    def nameMask(self, function):
+        codes = np.unique(self.name)
+        flags = np.zeros(len(self.strings), dtype=bool)
+        flags[codes] = [function(self.strings[code]) for code in codes]
+        return flags[self.name]
+
+    ''' Removes all nodes below given rank: ranked nodes lower than it
+        are removed with their subtrees, and nodes at it lose their descendants '''
+    def detachLowerRanks(self, rank):
+        if type(rank) == str and rank in data['ranks']:
+            rank = data['ranks'].index(rank)
+        if type(rank) != int or rank > len(data['ranks']) - 1:
+            print("Invalid Rank Type - Requires Valid Rank String or Int Between 0 and 26")
+            return
+
+        depths = self.depths()
+        target = (depths == rank) & (depths >= 0)
+        drop = depths > rank
+        drop[self.parent >= 0] |= target[self.parent[self.parent >= 0]]
+        drop[self.parent < 0] = False
+        return self.subset(~self.dropSubtrees(drop))
+
+    # Removes 'environmental samples' nodes and outdated taxa with their subtrees
+    def cleanTree(self):
+        oldTaxa = set(data['oldTaxa'])
+        drop = self.nameMask(lambda name: 'environmental' in name or name in oldTaxa)
+        drop[self.parent < 0] = False
+        return self.subset(~self.dropSubtrees(drop))
+
+    # Removes unclassified and incertae sedis taxa that have no ranked descendants, computed bottom-up
+    def removeUnclassified(self):
+        ranked = self.depths() >= 0
+        hasRanked = np.zeros(len(self), dtype=bool)
+        for level in reversed(self.levels[1:]):
+            below = (ranked[level] | hasRanked[level]).astype(np.float64)
+            hasRanked |= np.bincount(self.parent[level], weights=below, minlength=len(self)) > 0
+
+        drop = self.nameMask(lambda name: 'unclassified' in name or 'incertae' in name) & ~hasRanked
+        drop[self.parent < 0] = False
+        return self.subset(~self.dropSubtrees(drop))
+
+    # Keeps only nodes whose rank is one of the given ranks, along with their ancestors
+    def filterRanks(self, ranks):
+        keep = np.isin(self.rank, [code for code, rank in enumerate(self.rankNames) if rank in ranks])
+        for level in reversed(self.levels[1:]):
+            keep[self.parent[level][keep[level]]] = True
+        return self.subset(keep)
+
+    ''' Compact equivalent of Taxonomy.pruneToRank
+        Both detaching and cleaning only drop whole subtrees, so detaching first
+        gives the same tree while leaving far fewer names to test '''
+    def pruneToRank(self, rank, unclassified=False, clean=True):
+        tree = self.detachLowerRanks(rank)
+        if tree is not None and clean:
+            tree = tree.cleanTree()
+        if tree is not None and not unclassified:
+            tree = tree.removeUnclassified()
+        return tree
+
+    # Converts to an ete3 Tree with the same taxid names and sci_name, rank and taxid features as NCBI trees
+    def toTree(self):
+        nodes = []
+        for i in range(len(self)):
+            if self.parent[i] < 0:
+                node = Tree(name=str(self.taxid[i]))
+            else:
+                node = nodes[self.parent[i]].add_child(name=str(self.taxid[i]))
+            node.add_features(sci_name=self.sciName(i), rank=self.rankName(i), taxid=int(self.taxid[i]))
+            nodes.append(node)
+        return nodes[0] if nodes else None
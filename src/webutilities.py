@@ -1,31 +1,481 @@
 from taxutilities import *
-import os, io, time, json, shutil, csv
-import requests, lxml
-import folium, imgkit
-import pandas as pd
-from PIL import Image
-from bs4 import BeautifulSoup
+import os, io, re, time, json, shutil, csv, hashlib, sqlite3, pickle
+import requests, lxml, lxml.html, threading
+import numpy as np
 from zipfile import *
+from urllib.parse import urlparse, urlencode
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from ete3 import Tree, NCBITaxa, TreeStyle, NodeStyle, faces, AttrFace, ImgFace
 
-root = os.getcwd()
-data = json.load(open(os.path.join(root, 'taxa.json'), 'r'))
 headers = data['headers']
 
 # ------------------------------
 # GENERAL UTILITIES
-def saveImage(url):
-    url_content = requests.get(url, headers=headers).content
 
-    filename = url.split('/')[-1]
-    directory = os.path.join(root, 'images', filename)
+htmlParser = lxml.html.HTMLParser(encoding='utf-8')
 
-    _bytes = io.BytesIO(url_content)
-    image = Image.open(_bytes).convert('RGB')
-    with open(directory, 'wb') as f:
-        image.save(f, 'JPEG', quality=85)
+# Parses html into an lxml tree for XPath extraction, much cheaper than a full BeautifulSoup DOM
+def parseHTML(text):
+    if type(text) == str:
+        text = text.encode('utf-8')
+    return lxml.html.fromstring(text, parser=htmlParser)
+
+# XPath condition matching elements that have the given class, like BeautifulSoup's class_ argument
+def hasClass(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+''' Spaces out requests to the same host so that no host sees more than
+    the given number of requests per second, shared between threads.
+    Hosts listed in rates get their own requests per second '''
+class HostLimiter:
+    def __init__(self, requestsPerSecond, rates={}):
+        self.interval = 1 / requestsPerSecond
+        self.intervals = {host: 1 / rate for host, rate in rates.items()}
+        self.lock = threading.Lock()
+        self.next = {}
+    
+    # Blocks until the next request slot for the url's host
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next.get(host, now))
+            self.next[host] = start + self.intervals.get(host, self.interval)
+        time.sleep(start - now)
+
+# Shared session pooling connections across requests and worker threads
+session = requests.Session()
+session.headers.update(headers)
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(data['imageFetch']['workers'], data['eFloraCrawl']['workers']))
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+
+limiter = HostLimiter(data['imageFetch']['requestsPerSecond'], data['hostRates'])
+
+''' GET request through the shared session, rate limited per host.
+    Connection errors, 429 and 5xx responses are retried with exponential backoff
+    starting at the maxlag etiquette delay, or after Retry-After when the server sends it
+'''
+def fetch(url, retries=data['imageFetch']['retries'], **kwargs):
+    backoff = data['thumbnailFetch']['maxlag']
+    for attempt in range(retries + 1):
+        limiter.wait(url)
+        instruments.count('http.requests')
+        try:
+            r = session.get(url, timeout=30, **kwargs)
+            if not kwargs.get('stream'):
+                instruments.count('http.bytes', len(r.content))
+            if r.status_code not in (429, 500, 502, 503, 504) or attempt == retries:
+                return r
+            delay = float(r.headers.get('Retry-After', backoff * 2 ** attempt))
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+        time.sleep(delay)
+
+''' Managed store of thumbnail images in the images directory.
+    Each image is kept once per content hash as a JPEG original, with one JPEG variant
+    per requested pixel size resized locally from it, so asking for a new size doesn't refetch.
+    manifest.json maps each image source to its hash and each hash to its files, so lookups
+    don't touch the filesystem, and files are evicted least recently used first past maxBytes
+'''
+class ImageStore:
+    def __init__(self, directory, maxBytes=256 * 1024 ** 2, quality=85):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.quality = quality
+        self.lock = threading.RLock()
+        
+        os.makedirs(directory, exist_ok=True)
+        self.prefix = os.path.join(directory, '')
+        self.manifestPath = os.path.join(directory, 'manifest.json')
+        self.manifest = {'sources': {}, 'images': {}}
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as f:
+                self.manifest = json.load(f)
+    
+    # Identifies the image behind a url, wiki thumbnail urls of every size share the url of their original file
+    def source(self, url):
+        if '/thumb/' in url:
+            return url.rsplit('/', 1)[0].replace('/thumb/', '/')
+        return url
+    
+    ''' Returns the path of the image for url at size (longest side in pixels, None for as fetched),
+        or None if it has to be fetched: when it isn't stored, was only fetched at a smaller size,
+        or its files have been deleted since they were recorded '''
+    def get(self, url, size=None):
+        with self.lock:
+            entry = self.manifest['sources'].get(self.source(url))
+            if entry is None or entry['digest'] not in self.manifest['images']:
+                return
+            if size is not None and entry['fetched'] is not None and entry['fetched'] < size:
+                return
+            path = self.stored(entry['digest'], size)
+        return self.existing(entry['digest'], path) or self.variant(entry['digest'], size)
+    
+    # Key of the file for an image at size, its original when that is already small enough
+    def variantKey(self, image, size):
+        return 'original' if size is None or max(image['width'], image['height']) <= size else str(size)
+    
+    # Path of the file for an image at size, marking it as used, or None if that size wasn't made yet.
+    # Called with the lock held, on every lookup, so the path is joined to a prefix rather than with os.path.join
+    def stored(self, digest, size):
+        image = self.manifest['images'][digest]
+        file = image['files'].get(self.variantKey(image, size))
+        if file is not None:
+            file['accessed'] = time.time()
+            return self.prefix + file['name']
+    
+    # Returns path if its file is still there, otherwise forgets the file, along with its image if it was the original
+    def existing(self, digest, path):
+        if path is None or os.path.exists(path):
+            return path
+        self.discard(digest, os.path.basename(path))
+    
+    def discard(self, digest, name):
+        with self.lock:
+            image = self.manifest['images'].get(digest)
+            if image is None:
+                return
+            for key, file in list(image['files'].items()):
+                if file['name'] == name:
+                    del image['files'][key]
+            removed = []
+            if 'original' not in image['files']:
+                removed = [file['name'] for file in self.manifest['images'].pop(digest)['files'].values()]
         
-    return directory
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+    
+    ''' Resizes the original of an image the first time a size is asked for, returns the path of the new file.
+        Returns None, for the image to be fetched again, if the original was evicted or deleted in the meantime '''
+    def variant(self, digest, size):
+        from PIL import Image
+        with self.lock:
+            image = self.manifest['images'].get(digest)
+            if image is None or 'original' not in image['files']:
+                return
+            key = self.variantKey(image, size)
+            name = image['files']['original']['name']
+        
+        try:
+            resized = Image.open(os.path.join(self.directory, name))
+            resized.thumbnail((size, size), Image.LANCZOS)
+        except OSError:
+            self.discard(digest, name)
+            return
+        return self.write(digest, key, resized)
+    
+    ''' Saves an image as a JPEG file of the given image hash and records it in the manifest, returns its path.
+        Encoding happens outside the lock, which is only taken to update the manifest. Originals add their image,
+        variants of an image evicted in the meantime are written but not recorded '''
+    def write(self, digest, key, image):
+        name = f'{digest}.jpg' if key == 'original' else f'{digest}-{key}.jpg'
+        path = os.path.join(self.directory, name)
+        image.save(path + f'.{threading.get_ident()}', 'JPEG', quality=self.quality)
+        os.replace(path + f'.{threading.get_ident()}', path)
+        file = {'name': name, 'bytes': os.path.getsize(path), 'accessed': time.time()}
+        
+        with self.lock:
+            if key == 'original':
+                self.manifest['images'].setdefault(digest, {'width': image.width, 'height': image.height, 'files': {}})
+            if digest in self.manifest['images']:
+                self.manifest['images'][digest]['files'][key] = file
+        return path
+    
+    ''' Stores downloaded image content for url, fetched at size, and returns its path at size.
+        Identical content under different urls is stored once, returns None if it can't be decoded.
+        Content already stored is only recorded under url, unless its files have been deleted since.
+        New content is decoded and encoded outside the lock '''
+    def add(self, url, content, size=None):
+        digest = hashlib.sha256(content).hexdigest()
+        source = self.source(url)
+        with self.lock:
+            known = digest in self.manifest['images']
+            if known:
+                self.manifest['sources'][source] = {'digest': digest, 'fetched': size}
+                path = self.stored(digest, size)
+        if known:
+            path = self.existing(digest, path) or self.variant(digest, size)
+            if path is not None:
+                return path
+        
+        from PIL import Image
+        try:
+            image = Image.open(io.BytesIO(content)).convert('RGB')
+        except OSError:
+            print(f'Could not decode image {url}')
+            return
+        self.write(digest, 'original', image)
+        
+        with self.lock:
+            self.manifest['sources'][source] = {'digest': digest, 'fetched': size}
+            path = self.stored(digest, size) if digest in self.manifest['images'] else None
+        return path or self.variant(digest, size)
+    
+    # Removes least recently used files past maxBytes, an image goes along with its variants when its original does
+    def evict(self):
+        with self.lock:
+            files = [(file['accessed'], digest, key, file) for digest, image in self.manifest['images'].items()
+                     for key, file in image['files'].items()]
+            total = sum(file['bytes'] for accessed, digest, key, file in files)
+            
+            removed = []
+            for accessed, digest, key, file in sorted(files, key=lambda f: f[0]):
+                if total <= self.maxBytes:
+                    break
+                image = self.manifest['images'].get(digest)
+                if image is None or key not in image['files']:
+                    continue
+                
+                keys = list(image['files']) if key == 'original' else [key]
+                for k in keys:
+                    total -= image['files'][k]['bytes']
+                    removed.append(image['files'].pop(k)['name'])
+                if key == 'original':
+                    del self.manifest['images'][digest]
+            
+            if removed:
+                images = self.manifest['images']
+                self.manifest['sources'] = {source: entry for source, entry in self.manifest['sources'].items() if entry['digest'] in images}
+        
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+    
+    # Evicts past maxBytes and writes the manifest, keeping images that other processes have stored since it was loaded
+    def save(self):
+        self.evict()
+        with self.lock:
+            if os.path.exists(self.manifestPath):
+                with open(self.manifestPath) as f:
+                    stored = json.load(f)
+                for digest, image in stored['images'].items():
+                    original = image['files'].get('original')
+                    if digest not in self.manifest['images'] and original and os.path.exists(os.path.join(self.directory, original['name'])):
+                        self.manifest['images'][digest] = image
+                for source, entry in stored['sources'].items():
+                    if source not in self.manifest['sources'] and entry['digest'] in self.manifest['images']:
+                        self.manifest['sources'][source] = entry
+            
+            temp = self.manifestPath + f'.{os.getpid()}'
+            with open(temp, 'w') as f:
+                json.dump(self.manifest, f)
+            os.replace(temp, self.manifestPath)
+    
+    def clear(self):
+        with self.lock:
+            for image in self.manifest['images'].values():
+                for file in image['files'].values():
+                    try:
+                        os.remove(os.path.join(self.directory, file['name']))
+                    except OSError:
+                        pass
+            self.manifest = {'sources': {}, 'images': {}}
+        self.save()
+
+imageStore = SharedInstance(lambda: ImageStore(os.path.join(root, 'images'), **data['imageStore']))
+
+# Downloads image into the image store at size, returns its path, or None if it failed
+def saveImage(url, size=None):
+    path = imageStore.get(url, size)
+    if path is not None:
+        return path
+    
+    try:
+        r = fetch(url)
+    except requests.RequestException as e:
+        print(f'Image request failed for {url}: {e}')
+        return
+    if r.status_code != 200:
+        print(f'Image request failed for {url}: {r.status_code}')
+        return
+    
+    return imageStore.add(url, r.content, size)
+
+# Downloads several images at once on a bounded thread pool, returns dictionary of urls and paths
+def saveImages(urls, size=None, workers=data['imageFetch']['workers']):
+    urls = list(urls)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        saved = dict(zip(urls, pool.map(lambda url: saveImage(url, size), urls)))
+    imageStore.save()
+    return saved
+
+# Stand-in for a requests Response, returned by the response cache
+class CachedResponse:
+    def __init__(self, url, status_code, content, encoding=None, fromCache=False, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+        self.fromCache = fromCache
+    
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+    
+    def json(self):
+        return json.loads(self.text)
+
+''' Persistent cache of GET responses shared by the scrapers.
+    Bodies are stored once per content hash under cache/http, and an sqlite index maps
+    each url and its parameters to a body, its validators and when it was fetched.
+    Entries older than their ttl are revalidated with If-None-Match/If-Modified-Since,
+    the least recently used are evicted past maxBytes, and in offline mode only
+    cached responses are returned (or a 504 when there is none)
+'''
+class ResponseCache:
+    def __init__(self, directory, ttl=604800, maxBytes=1024 ** 3, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        
+        os.makedirs(directory, exist_ok=True)
+        self.index = openStore(os.path.join(directory, 'index.sqlite'))
+        self.index.execute('''CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, digest TEXT, size INT,
+                              encoding TEXT, etag TEXT, modified TEXT, fetched REAL, accessed REAL)''')
+        self.index.commit()
+    
+    # Key for a url and its parameters, ignoring parameters that requests would drop
+    def key(self, url, params=None):
+        params = sorted((k, str(v)) for k, v in (params or {}).items() if v is not None)
+        return hashlib.sha256(f'{url}?{urlencode(params)}'.encode()).hexdigest()
+    
+    def bodyPath(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+    
+    ''' Returns the response for url and params, from the cache when it is fresh
+        or still valid on the server, otherwise fetching and caching it.
+        Falls back to a stale copy if the server can't be reached.
+        Successful responses are only stored if validate, when given, accepts them
+    '''
+    def get(self, url, params=None, ttl=None, validate=None, **kwargs):
+        ttl = self.ttl if ttl is None else ttl
+        key = self.key(url, params)
+        headers = kwargs.pop('headers', {})
+        with self.lock:
+            entry = self.index.execute('SELECT digest, encoding, etag, modified, fetched FROM responses WHERE key = ?', (key,)).fetchone()
+        if entry is not None and not os.path.exists(self.bodyPath(entry[0])):
+            entry = self.forget(key)
+        
+        if entry is not None:
+            digest, encoding, etag, modified, fetched = entry
+            if self.offline or time.time() - fetched < ttl:
+                cached = self.load(key, url, digest, encoding)
+                if cached is not None:
+                    instruments.count('http.cacheHits')
+                    return cached
+                entry = self.forget(key)
+        if entry is None and self.offline:
+            return CachedResponse(url, 504, b'')
+        
+        validators = {}
+        if entry is not None and etag:
+            validators['If-None-Match'] = etag
+        if entry is not None and modified:
+            validators['If-Modified-Since'] = modified
+        
+        try:
+            r = fetch(url, params=params, headers={**headers, **validators}, **kwargs)
+        except requests.RequestException:
+            cached = self.load(key, url, digest, encoding) if entry is not None else None
+            if cached is not None:
+                return cached
+            raise
+        
+        if r.status_code == 304 and entry is not None:
+            cached = self.load(key, url, digest, encoding)
+            if cached is not None:
+                with self.lock:
+                    self.index.execute('UPDATE responses SET fetched = ? WHERE key = ?', (time.time(), key))
+                    self.index.commit()
+                instruments.count('http.revalidated')
+                return cached
+            # The body went missing since the entry was read, so it is fetched again without validators
+            self.forget(key)
+            r = fetch(url, params=params, headers=headers, **kwargs)
+        
+        if r.status_code == 200 and (validate is None or validate(r)):
+            self.store(key, url, r)
+        return r
+    
+    # Removes the index entry of a response whose body has gone missing, returns None in place of the entry
+    def forget(self, key):
+        with self.lock:
+            self.index.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.index.commit()
+    
+    # Reads a cached body and marks the entry as used, returns None if the body has gone missing
+    def load(self, key, url, digest, encoding):
+        try:
+            with open(self.bodyPath(digest), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return
+        with self.lock:
+            self.index.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.index.commit()
+        return CachedResponse(url, 200, content, encoding, fromCache=True)
+    
+    # Writes body under its content hash, records the entry and evicts if over size
+    def store(self, key, url, r):
+        digest = hashlib.sha256(r.content).hexdigest()
+        path = self.bodyPath(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + f'.{threading.get_ident()}', 'wb') as f:
+                f.write(r.content)
+            os.replace(path + f'.{threading.get_ident()}', path)
+        
+        now = time.time()
+        with self.lock:
+            self.index.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key, url, digest, len(r.content), r.encoding, r.headers.get('ETag'), r.headers.get('Last-Modified'), now, now))
+            self.index.commit()
+        self.evict()
+    
+    # Removes least recently used entries until the bodies fit in maxBytes, deleting unreferenced bodies
+    def evict(self):
+        with self.lock:
+            total = self.index.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM responses)').fetchone()[0]
+            if total <= self.maxBytes:
+                return
+            
+            removed = set()
+            for key, digest, size in self.index.execute('SELECT key, digest, size FROM responses ORDER BY accessed').fetchall():
+                if total <= self.maxBytes:
+                    break
+                self.index.execute('DELETE FROM responses WHERE key = ?', (key,))
+                if self.index.execute('SELECT 1 FROM responses WHERE digest = ?', (digest,)).fetchone() is None:
+                    total -= size
+                    removed.add(digest)
+            self.index.commit()
+        
+        for digest in removed:
+            try:
+                os.remove(self.bodyPath(digest))
+            except OSError:
+                pass
+    
+    def clear(self):
+        with self.lock:
+            self.index.execute('DELETE FROM responses')
+            self.index.commit()
+        for entry in os.listdir(self.directory):
+            if len(entry) == 2:
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+httpCache = SharedInstance(lambda: ResponseCache(os.path.join(root, 'cache', 'http'), **data['httpCache']))
 
 # ------------------------------
 # WEB SCRAPERS
@@ -35,30 +485,78 @@ class wikiScraper:
     def __init__(self):
         self.root = os.getcwd()
         self.images = os.path.join(self.root, 'images')
-        self.data = json.load(open(self.root + '/taxa.json', 'r'))
+        self.data = data
 
         self.api = self.data['wikiAPI']
         self.ranks = self.data['ranks']
   
-    # function that uses MediaWiki Query action, and returns the json retrieved
-    def query(self, _format='json', params={}):
-        params['action'] = 'query'
-        params['format'] = _format
+    ''' function that uses MediaWiki Query action, and returns the json retrieved
+        Follows continue tokens until the query is complete, merging the pages of each part '''
+    def query(self, _format='json', params=None):
+        params = {**(params or {}), 'action': 'query', 'format': _format, 'maxlag': self.data['thumbnailFetch']['maxlag']}
         
-        r = requests.get(self.api, params=params, headers=headers)
-        if r.status_code == 200:
+        merged = {}
+        while True:
+            result = self.request(params)
+            if result is None:
+                return
+            if 'query' not in result:
+                print('No query found for this request')
+                return
+            
+            for key, value in result['query'].items():
+                if key == 'pages':
+                    for page, info in value.items():
+                        merged.setdefault('pages', {}).setdefault(page, {}).update(info)
+                elif type(value) == list:
+                    merged.setdefault(key, []).extend(value)
+                else:
+                    merged[key] = value
+            
+            if 'continue' not in result:
+                return merged
+            params = {**params, **result['continue']}
+    
+    # Sends an API request and returns its json, waiting and retrying while the servers report maxlag
+    def request(self, params, retries=data['imageFetch']['retries']):
+        for attempt in range(retries + 1):
+            r = httpCache.get(self.api, params=params, validate=self.validQuery)
+            if r.status_code != 200:
+                print('Request failed')
+                return
             try:
-                return r.json()['query']
-            except:
+                result = r.json()
+            except ValueError:
                 print('No query found for this request')
-        else:
-            print('Request failed')
+                return
+            
+            if result.get('error', {}).get('code') != 'maxlag' or attempt == retries:
+                return result
+            time.sleep(float(r.headers.get('Retry-After', params['maxlag'] * 2 ** attempt)))
+    
+    ''' Queries many titles with the same params, packing as many titles into each request as the API allows,
+        and sending up to workers requests at once. Returns the list of queries '''
+    def queryTitles(self, titles, params, workers=data['thumbnailFetch']['workers']):
+        limit = self.data['thumbnailFetch']['titleLimit']
+        titles = list(dict.fromkeys(titles))
+        batches = [titles[i:i + limit] for i in range(0, len(titles), limit)]
+        
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            queries = pool.map(lambda batch: self.query(params={**params, 'titles': '|'.join(batch)}), batches)
+            return [query for query in queries if query is not None]
+    
+    # Only responses with query results are cached, so errors such as maxlag get retried
+    def validQuery(self, r):
+        try:
+            return 'query' in r.json()
+        except ValueError:
+            return False
             
 # GBIF DATASET SCRAPER
 class GBIFScraper:
     def __init__(self):
         self.root = os.getcwd()
-        self.data = json.load(open(self.root + '/taxa.json', 'r'))
+        self.data = data
         
         self.datasets = os.path.join(self.root, 'datasets')
 
@@ -79,7 +577,8 @@ class GBIFScraper:
                 return self.datasetFiles(setdir)
             else:
                 setdir = self.datasetDownload(url)
-                return self.datasetFiles(setdir)
+                if setdir is not None:
+                    return self.datasetFiles(setdir)
     
     # Queries GBIF api for the endpoint of a given dataset, returns url
     def datasetRequest(self, uuid):
@@ -102,22 +601,139 @@ class GBIFScraper:
         else:
             print('No datafiles found')
     
-    # Takes dataset url, downloads and extracts zip file into datasets directory, returns directory of resulting folder
-    # Doesnt work with big datasets, idk why, fml
-    def datasetDownload(self, url):
+    ''' Takes dataset url, downloads and extracts zip file into datasets directory, returns directory of resulting folder
+        The zip is streamed to disk in chunks and resumed from where it stopped if interrupted.
+        Its size is checked against the server's, and against an md5 checksum if one is given.
+        A zip that turns out not to be valid is deleted and downloaded once more
+    '''
+    def datasetDownload(self, url, checksum=None, chunkSize=1024 * 1024, attempts=2):
         filename = url.split('/')[-1]
-        setzip = os.path.join(self.datadir, filename)
-        setdir = os.path.join(self.datadir, filename.replace('.zip', ''))
+        setzip = os.path.join(self.datasets, filename)
+        setdir = os.path.join(self.datasets, filename.replace('.zip', ''))
         
-        try:
-            with requests.get(url, stream=True) as r:
-                with open(setzip, 'wb') as f:
-                    shutil.copyfileobj(r.raw, f)
-            with ZipFile(setzip) as archive:
-                archive.extractall(setdir)
-            return setdir
-        except:
-            return
+        for attempt in range(attempts):
+            if not os.path.exists(setzip):
+                try:
+                    if not self.streamDownload(url, setzip + '.part', chunkSize):
+                        return
+                except requests.RequestException as e:
+                    print(f'Dataset download failed: {e}')
+                    return
+                
+                if checksum is not None and self.fileChecksum(setzip + '.part', chunkSize) != checksum.lower():
+                    print(f'Checksum mismatch for {filename}, discarding download')
+                    os.remove(setzip + '.part')
+                    return
+                os.replace(setzip + '.part', setzip)
+            
+            try:
+                self.datasetExtract(setzip, setdir, chunkSize)
+                return setdir
+            except BadZipFile:
+                print(f'{filename} is not a valid zip file, discarding it')
+                os.remove(setzip)
+                shutil.rmtree(setdir + '.part', ignore_errors=True)
+    
+    ''' Streams url into path chunk by chunk, appending to an existing partial file
+        with an HTTP Range request. The partial file's ETag (or Last-Modified) is kept next
+        to it and sent as If-Range, so a file that changed on the server since is downloaded
+        again from the start instead of being appended to. Prints progress, returns True
+        once the file on disk matches the size reported by the server
+    '''
+    def streamDownload(self, url, path, chunkSize=1024 * 1024):
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        validatorPath = path + '.etag'
+        validator = None
+        if offset > 0 and os.path.exists(validatorPath):
+            with open(validatorPath) as f:
+                validator = f.read().strip()
+        
+        rangeHeaders = dict(headers)
+        if offset > 0 and validator:
+            rangeHeaders['Range'] = f'bytes={offset}-'
+            rangeHeaders['If-Range'] = validator
+        else:
+            offset = 0
+        
+        instruments.count('http.requests')
+        with requests.get(url, stream=True, headers=rangeHeaders, timeout=60) as r:
+            if r.status_code == 416:
+                total = int(r.headers.get('Content-Range', '*/0').split('/')[-1])
+                return total == offset
+            r.raise_for_status()
+            
+            if r.status_code == 206 and r.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                total = int(r.headers['Content-Range'].split('/')[-1])
+                mode = 'ab'
+            else:
+                total = int(r.headers.get('Content-Length', 0)) or None
+                offset = 0
+                mode = 'wb'
+                
+                # Weak ETags can't be used with If-Range
+                etag = r.headers.get('ETag')
+                validator = etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified')
+                if validator:
+                    with open(validatorPath, 'w') as f:
+                        f.write(validator)
+                elif os.path.exists(validatorPath):
+                    os.remove(validatorPath)
+            
+            done = offset
+            reported = time.time()
+            with open(path, mode) as f:
+                for chunk in r.iter_content(chunk_size=chunkSize):
+                    f.write(chunk)
+                    done += len(chunk)
+                    instruments.count('http.bytes', len(chunk))
+                    if time.time() - reported > 1:
+                        reported = time.time()
+                        progress = f'{done / total:.1%}' if total else f'{done >> 20} MB'
+                        print(f'Downloading {os.path.basename(url)}: {progress}')
+        
+        size = os.path.getsize(path)
+        if total is not None and size != total:
+            print(f'Incomplete download, {size} of {total} bytes')
+            if size > total:
+                os.remove(path)
+            return False
+        
+        if os.path.exists(validatorPath):
+            os.remove(validatorPath)
+        return True
+    
+    # Returns md5 hex digest of given file, read in chunks
+    def fileChecksum(self, path, chunkSize=1024 * 1024):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunkSize), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+    
+    ''' Extracts only the csv files from a dataset zip, streaming each member to disk.
+        Members are extracted into a temporary folder that replaces setdir once complete,
+        and members already extracted by an interrupted run are skipped.
+        An archive without csv files leaves an empty setdir
+    '''
+    def datasetExtract(self, setzip, setdir, chunkSize=1024 * 1024):
+        partdir = setdir + '.part'
+        os.makedirs(partdir, exist_ok=True)
+        with ZipFile(setzip) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or '.csv' not in member.filename:
+                    continue
+                
+                target = os.path.normpath(os.path.join(partdir, member.filename))
+                if not target.startswith(os.path.normpath(partdir) + os.sep):
+                    continue
+                if os.path.exists(target) and os.path.getsize(target) == member.file_size:
+                    continue
+                
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with archive.open(member) as source, open(target + '.part', 'wb') as f:
+                    shutil.copyfileobj(source, f, chunkSize)
+                os.replace(target + '.part', target)
+        os.replace(partdir, setdir)
 
     # function for instantiating NameUsages from taxids; filters invalid taxa;
     def nameUsage(self, taxa):
@@ -142,30 +758,74 @@ class GBIFScraper:
 
 # Handles Plants of the World Online data scraping
 class POTWOScraper:
-    def __init__(self):
-        gbif = GBIFScraper()
-        ipniCSV = gbif.getDataset('046bbc50-cae2-47ff-aa43-729fbf53f7c5')
-        for csv in ipniCSV:
-            self.ipni = pd.read_csv(csv, header=None)
-            self.ipni.rename(columns={0:'lsid', 1:'name', 2:'author', 3:'rank', 4:'family', 5:'lsid2', 6:'lsid3', 7:'lsid4', 8:'year', 9:'citation', 10:'?', 11:'link'}, inplace=True)
+    def __init__(self, ipni=None):
+        self.root = os.getcwd()
+        self.home = 'http://www.plantsoftheworldonline.org/'
+        
+        if ipni is None:
+            ipni = self.loadIPNI()
+        self.ipni = ipni
+        self.lsidIndex = self.indexLSIDS(self.ipni)
             
         self.ranks = ['family', 'genus', 'species']
+        self.distributions = {}
+        self.workers = data['potwoFetch']['workers']
+    
+    ''' Loads the IPNI dataset from a columnar cache in the datasets directory,
+        reading only the given columns. The first call reads every IPNI csv with
+        fixed dtypes, sorts it by name and writes the cache, so later startups
+        skip both the GBIF request and the csv parsing
+    '''
+    def loadIPNI(self, columns=['lsid', 'name']):
+        import pandas as pd
+        cache = os.path.join(self.root, 'datasets', 'ipni.feather')
+        if os.path.exists(cache):
+            return pd.read_feather(cache, columns=columns)
+        
+        gbif = GBIFScraper()
+        ipniCSV = gbif.getDataset(data['gbifDatasets']['IPNI'])
+        if ipniCSV is None:
+            print('IPNI dataset not found')
+            return
+        
+        names = ['lsid', 'name', 'author', 'rank', 'family', 'lsid2', 'lsid3', 'lsid4', 'year', 'citation', '?', 'link']
+        ipni = pd.concat([pd.read_csv(csv, header=None, names=names, dtype=str) for csv in ipniCSV], ignore_index=True)
+        ipni['rank'] = ipni['rank'].astype('category')
+        ipni['family'] = ipni['family'].astype('category')
+        ipni = ipni.sort_values('name', kind='stable', ignore_index=True)
+        
+        ipni.to_feather(cache, compression='uncompressed')
+        return ipni[columns]
+    
+    ''' Builds a sorted index of distinct IPNI names, with the offset of each name's run of LSIDs,
+        keeping dataset order within each name. Built once at load time so lookups are binary searches
+        instead of DataFrame scans; the cached dataset is already sorted.
+        Without a dataset, when it couldn't be loaded, the index is empty and lookups find no LSIDs
+    '''
+    def indexLSIDS(self, ipni):
+        if ipni is None:
+            print('IPNI dataset unavailable, no LSIDs will be found')
+            return np.zeros(0, dtype=object), np.zeros(1, dtype=int), np.zeros(0, dtype=object)
+        
+        ipni = ipni[ipni.name.notna()]
+        if not ipni.name.is_monotonic_increasing:
+            ipni = ipni.sort_values('name', kind='stable')
+        names = ipni.name.to_numpy(dtype=object)
+        starts = np.flatnonzero(np.concatenate([[True], names[1:] != names[:-1]])) if len(names) else np.zeros(0, dtype=int)
+        return names[starts], np.append(starts, len(names)), ipni.lsid.to_numpy(dtype=object)
     
     ''' Searches IPNI for LSIDs matching given taxa, then returns as list'''
     def getLSIDS(self, taxa):
         if type(taxa) == int:
             taxa = getName(taxa)
-            
-        indecies = []
-        for index, name in self.ipni.name.items():
-            if name == taxa:
-                indecies.append(index)
-        lsids = []
-        for index, lsid in self.ipni.lsid.items():
-            if index in indecies:
-                lsids.append(lsid)
-                
-        return lsids
+        if taxa is None:
+            return []
+        
+        names, offsets, lsids = self.lsidIndex
+        i = names.searchsorted(taxa)
+        if i == len(names) or names[i] != taxa:
+            return []
+        return lsids[offsets[i]:offsets[i + 1]].tolist()
     
     ''' Takes taxa as id or name, returns distribution from POTWO as 
         list of regions or as dictionary of names and distributions
@@ -191,50 +851,252 @@ class POTWOScraper:
     
             
     # Internal function that finds valid lsid for given taxa, returns native distribution listed on POTWO page
-    def distribution(self, taxa):
-        lsids = self.getLSIDS(taxa)
-    
-        for lsid in lsids:
+    # Takes the taxa's LSIDs when already looked up, as worker threads must not query NCBI themselves
+    # Results are memoized per taxa, taxa without a distribution only once every page was fetched
+    def distribution(self, taxa, lsids=None):
+        if taxa in self.distributions:
+            return self.distributions[taxa]
+        
+        dist = None
+        failed = False
+        for lsid in self.getLSIDS(taxa) if lsids is None else lsids:
             if lsid is not None:
-                request = requests.get(f'http://www.plantsoftheworldonline.org/taxon/{lsid}')
+                try:
+                    request = httpCache.get(f'{self.home}taxon/{lsid}')
+                except requests.RequestException as e:
+                    print(f'POTWO request failed for {taxa}: {e}')
+                    failed = True
+                    continue
+                
                 if request.status_code == 200:
-                    soup = BeautifulSoup(request.content, 'lxml')
-                    try:
-                        distraw = soup.find('div', id='distribution-listing').find('p')
-                        distclean = distraw.get_text().strip()
-
-                        dist = []
-                        for loc in distclean.split(', \r\n              \r\n              '):
-                            dist.append(loc)
-                        return dist
-                    except:
+                    dist = self.parseDistribution(request.text)
+                    if dist is not None:
+                        break
+                    else:
                         print(f'Distribution not found for {taxa}')
+                else:
+                    failed = True
+        
+        if dist is not None or not failed:
+            self.distributions[taxa] = dist
+        return dist
+    
+    # Extracts the native regions from a POTWO taxon page, or None if it has no distribution listing
+    def parseDistribution(self, text):
+        distraw = parseHTML(text).xpath("//div[@id='distribution-listing']//p")
+        if distraw:
+            distclean = distraw[0].text_content().strip()
+
+            dist = []
+            for loc in distclean.split(', \r\n              \r\n              '):
+                dist.append(loc)
+            return dist
     
     # Takes a taxid with no distribution on POTWO, returns a distribution using its descendants' pages
     def distributionFromDescendants(self, taxa, rank):
-        dist = []
-        dists = {}
-        
         descendants = ncbi.get_descendant_taxa(taxa, return_tree=True)
         if type(descendants) == list:
             return
         
-        for node in descendants.iter_descendants():
-            if node.rank in self.ranks and self.ranks.index(node.rank) == self.ranks.index(rank) + 1:
-                node_dist = self.getDistribution(int(node.name))
-                if node_dist is not None:
-                    dists[int(node.name)] = node_dist
-                elif node.rank in self.ranks and node.rank != 'species':
-                    dists[int(node.name)] = self.distributionFromDescendants(int(node.name), node.rank)
-        
-        for d, regions in dists.items():
-            if regions is not None:
-                for region in regions:
-                    if region not in dist:
-                        dist.append(region)
+        dists = dict(self.iterDistributions(taxa, rank, descendants))
+        
+        dist = {}
+        for node in descendants.traverse():
+            for region in dists.get(int(node.name), []):
+                dist[region] = None
                     
-        return dist
+        return list(dist)
+    
+    ''' Generator of (taxid, distribution) pairs for the descendants that make up the
+        distribution of given taxa, yielded as their pages arrive. The descendant tree
+        is only built once: descendants at the next rank are fetched concurrently, and
+        those without a distribution are replaced by their own next-rank descendants
+        until every branch has a distribution or reaches species
+    '''
+    def iterDistributions(self, taxa, rank, descendants=None):
+        if descendants is None:
+            descendants = ncbi.get_descendant_taxa(taxa, return_tree=True)
+            if type(descendants) == list:
+                return
+        nodes = {int(node.name): node for node in descendants.traverse()}
         
+        # LSIDs are looked up on this thread by the names already in the tree, and passed to the workers
+        lsids = {taxid: self.getLSIDS(node.sci_name) for taxid, node in nodes.items()}
+        frontier = self.nextRank(nodes.get(taxa, descendants), rank)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while frontier:
+                futures = {pool.submit(self.distribution, int(node.name), lsids.get(int(node.name), [])): node for node in frontier}
+                frontier = []
+                for future in as_completed(futures):
+                    node = futures[future]
+                    dist = future.result()
+                    if dist is not None:
+                        yield int(node.name), dist
+                    elif node.rank != 'species':
+                        frontier.extend(self.nextRank(node, node.rank))
+    
+    # Returns descendants of node that are one rank below given rank
+    def nextRank(self, node, rank):
+        if rank not in self.ranks or rank == self.ranks[-1]:
+            return []
+        
+        lower = self.ranks[self.ranks.index(rank) + 1]
+        return [subnode for subnode in node.iter_descendants() if subnode.rank == lower]
+
+    ''' Fills a DistributionMatrix with the distributions of given taxa, fetching pages concurrently.
+        Taxa already in the matrix are skipped, so a saved matrix can be extended without scraping
+        it again. Taxa without a distribution get an empty row. Returns the matrix
+    '''
+    def distributionMatrix(self, taxa, matrix=None):
+        matrix = matrix if matrix is not None else DistributionMatrix()
+        taxids = [taxid for taxid in getTaxids(taxa).values() if taxid not in matrix.taxonIndex]
+
+        # LSIDs are looked up on this thread, naming every taxid in one NCBI query, and passed to the workers
+        lsids = {taxid: self.getLSIDS(name) for taxid, name in getNames(taxids).items()}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for taxid, dist in zip(taxids, pool.map(lambda taxid: self.distribution(taxid, lsids.get(taxid, [])), taxids)):
+                matrix.add(taxid, dist)
+        return matrix
+        
+''' Presence of taxa in WGSRPD level 3 regions, as a sparse taxa by regions matrix
+    Rows are taxids and columns region names, both kept in the order they were added. Rows are
+    added one distribution at a time and the scipy CSR matrix is only rebuilt when it is next used.
+    Unions, intersections and richness counts are column operations on the rows of the taxa asked
+    for. save and load keep the matrix with its labels in one npz file, so nothing is parsed again
+'''
+class DistributionMatrix:
+    def __init__(self, taxa=(), regions=()):
+        self.taxa = []
+        self.taxonIndex = {}
+        self.regions = []
+        self.regionIndex = {}
+        self.rows = []
+        self.columns = []
+        self.cached = None
+
+        for region in regions:
+            self.region(region)
+        for taxid in taxa:
+            self.add(taxid, None)
+
+    # Column of a region, adding it if new
+    def region(self, region):
+        column = self.regionIndex.get(region)
+        if column is None:
+            column = self.regionIndex[region] = len(self.regions)
+            self.regions.append(region)
+        return column
+
+    # Adds or extends the row of a taxid with the regions of its distribution, which may be None
+    def add(self, taxid, dist):
+        row = self.taxonIndex.get(taxid)
+        if row is None:
+            row = self.taxonIndex[taxid] = len(self.taxa)
+            self.taxa.append(taxid)
+
+        for region in dist or []:
+            self.rows.append(row)
+            self.columns.append(self.region(region))
+        self.cached = None
+
+    ''' Drops the rows of taxa changed or removed by an NCBI update described by a diffTaxonomy diff,
+        so that distributionMatrix fetches them again under their new names. Returns the number of rows dropped
+    '''
+    def invalidate(self, diff):
+        kept = [taxid for taxid in self.taxa if taxid not in diff['taxids']]
+        if len(kept) == len(self.taxa):
+            return 0
+
+        position = {self.taxonIndex[taxid]: row for row, taxid in enumerate(kept)}
+        cells = [(position[row], column) for row, column in zip(self.rows, self.columns) if row in position]
+        dropped = len(self.taxa) - len(kept)
+        self.taxa = kept
+        self.taxonIndex = {taxid: row for row, taxid in enumerate(kept)}
+        self.rows = [row for row, column in cells]
+        self.columns = [column for row, column in cells]
+        self.cached = None
+        return dropped
+
+    # Presence of every taxon in every region, as a boolean scipy CSR matrix
+    @property
+    def matrix(self):
+        if self.cached is None:
+            from scipy import sparse
+            cells = np.ones(len(self.rows), dtype=bool)
+            self.cached = sparse.csr_matrix((cells, (self.rows, self.columns)), shape=(len(self.taxa), len(self.regions)), dtype=bool)
+            self.cached.sum_duplicates()
+        return self.cached
+
+    def __len__(self):
+        return len(self.taxa)
+
+    # Row positions of given taxids and names that are in the matrix
+    def taxonRows(self, taxa):
+        taxids = getTaxids([tax for tax in taxa if type(tax) == str])
+        return [self.taxonIndex[tax] for tax in (taxids.get(tax, tax) for tax in taxa) if tax in self.taxonIndex]
+
+    # Number of given taxa, or of all taxa, present in each region
+    def counts(self, taxa=None):
+        matrix = self.matrix if taxa is None else self.matrix[self.taxonRows(taxa)]
+        return np.asarray(matrix.sum(axis=0)).ravel()
+
+    # Regions of a single taxon
+    def distribution(self, taxa):
+        rows = self.taxonRows([taxa])
+        if not rows:
+            return
+        return [self.regions[column] for column in self.matrix[rows[0]].indices]
+
+    # Regions where any of given taxa are present
+    def union(self, taxa):
+        return [self.regions[column] for column in np.flatnonzero(self.counts(taxa))]
+
+    # Regions where all of given taxa are present
+    def intersection(self, taxa):
+        rows = self.taxonRows(taxa)
+        if not rows:
+            return []
+        return [self.regions[column] for column in np.flatnonzero(self.counts(taxa) == len(rows))]
+
+    # Union of the distributions of a taxon and all its descendants in the matrix, without fetching any page
+    def descendantUnion(self, taxa):
+        taxid = getTaxid(taxa)
+        if taxid is None:
+            return
+        return self.union([taxid] + ncbi.get_descendant_taxa(taxid, intermediate_nodes=True))
+
+    # Dictionary of each region and the number of given taxa, or of all taxa, present in it
+    def richness(self, taxa=None):
+        return {self.regions[column]: int(count) for column, count in enumerate(self.counts(taxa)) if count}
+
+    # Taxids present in a region
+    def regionTaxa(self, region):
+        column = self.regionIndex.get(region)
+        if column is None:
+            return []
+        return [self.taxa[row] for row in self.matrix[:, column].nonzero()[0]]
+
+    # Saves the matrix and its taxa and regions to an npz file
+    def save(self, path):
+        matrix = self.matrix
+        np.savez_compressed(path, indices=matrix.indices, indptr=matrix.indptr, shape=matrix.shape,
+                            taxa=np.array(self.taxa, dtype=np.int64), regions=np.array(self.regions, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        from scipy import sparse
+        if not os.path.exists(path):
+            print(f'Distribution matrix not found at {path}')
+            return
+
+        stored = np.load(path)
+        distributions = cls(stored['taxa'].tolist(), stored['regions'].tolist())
+        indices, indptr = stored['indices'], stored['indptr']
+        distributions.cached = sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=tuple(stored['shape']))
+        distributions.rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)).tolist()
+        distributions.columns = indices.tolist()
+        return distributions
+
 ''' eFloras.org Data Scraper
     Takes flora name or id on initialization
     New instance must be created for each flora
@@ -243,27 +1105,47 @@ class POTWOScraper:
 '''
 class eFlora:
     def __init__(self, flora):
-        self.ncbi = NCBITaxa()
+        self.ncbi = ncbi
         self.home = 'http://www.efloras.org/'
         self.floraId = self.getFloraID(flora)
+        
+        self.workers = data['eFloraCrawl']['workers']
+        self.pageSize = None
+        self.browsed = {}
+        self.lock = threading.Lock()
     
     ''' Uses related functions to compile and return a dictionary
         containing taxon ids and scientific names for all taxa in
-        the flora, properly organized taxonomically
+        the flora, properly organized taxonomically.
+        Genera and species are crawled concurrently. When given a checkpoint
+        path, finished families are saved there as they complete, and families
+        already in an existing checkpoint are not crawled again
     '''
-    def fullTree(self):
+    def fullTree(self, checkpoint=None):
         tree = {}
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint, 'r') as f:
+                tree = json.load(f)
         
         f = self.families()
-        for f_id, f_name in f.items():
-            genera = {}
-            g = self.genera(f_id)
-            for g_id, g_name in g.items():
-                genera[g_id] = {g_name: self.species(g_id)}
-                
-            tree[f_id] = {f_name: genera}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            g = {f_id: pool.submit(self.genera, f_id) for f_id in f if f_id not in tree}
+            s = {}
+            for f_id, genera in g.items():
+                s[f_id] = {g_id: (g_name, pool.submit(self.species, g_id)) for g_id, g_name in genera.result().items()}
             
-        return tree
+            for f_id, genera in s.items():
+                tree[f_id] = {f[f_id]: {g_id: {g_name: species.result()} for g_id, (g_name, species) in genera.items()}}
+                if checkpoint is not None:
+                    self.saveCheckpoint(tree, checkpoint)
+            
+        return {f_id: tree[f_id] for f_id in f if f_id in tree}
+    
+    # Writes partial tree to checkpoint path, replacing the previous checkpoint only once fully written
+    def saveCheckpoint(self, tree, checkpoint):
+        with open(checkpoint + '.part', 'w') as f:
+            json.dump(tree, f)
+        os.replace(checkpoint + '.part', checkpoint)
     
     ''' Calls and returns browseTaxa with no arguments, returning 
         dictionary of taxon ids and corresponding families
@@ -288,10 +1170,11 @@ class eFlora:
     def species(self, taxonID=None):
         species = {}
         
-        if len(self.browseTaxa(taxonID)) == 0:
+        lower = self.browseTaxa(taxonID)
+        if len(lower) == 0:
             species = self.browseTaxa(taxonID, species=True)  
         else:
-            for g_ID, g_name in self.browseTaxa(taxonID).items():
+            for g_ID, g_name in lower.items():
                 species[g_ID] = {g_name: self.browseTaxa(g_ID, species=True)}
             
         return species
@@ -301,42 +1184,103 @@ class eFlora:
         defaults to the highest ranking, which is family.
     '''
     def browseTaxa(self, taxonID=None, species=False):
-        pages = []
-        pageNumber = 1
-        while pageNumber != 0:
-            page = requests.get(self.home + 'browse.aspx?', 
-                                 headers=headers, 
-                                 params={'flora_id': self.floraId, 'page': pageNumber, 'start_taxon_id': taxonID})
-            
-            if "No taxa found" in page.text:
-                pageNumber = 0
-            else:
-                pages.append(page)
-                pageNumber += 1
-        
         taxa = {}
-        for page in pages:
-            soup = BeautifulSoup(page.text, 'lxml')
-            
-            taxa_list = soup.find_all('tr', class_='underline')
-            for item in taxa_list:
-                id_listing = item.find('td', class_='small')
-                
-                if id_listing is not None:
-                    taxa_id = id_listing.get_text()
-                    taxa_name = item.find('a').get_text()
-                    lower_taxa = item.find('a', title='lower taxa')
-                    if lower_taxa is None:
-                        lower_taxa = item.find('a', title='lower taxon')
-                    
-                    if taxa_id != taxonID and 'x\\' not in taxa_name and '×' not in taxa_name:
-                        if species and lower_taxa is None and 'subg.' not in taxa_name:
-                            taxa[taxa_id] = taxa_name
-                        elif not species and lower_taxa is not None and len(taxa_name.split(' ')) == 1:
-                            taxa[taxa_id] = taxa_name
+        for taxa_id, taxa_name, lower_taxa in self.browseRows(taxonID):
+            if taxa_id != taxonID and 'x\\' not in taxa_name and '×' not in taxa_name:
+                if species and not lower_taxa and 'subg.' not in taxa_name:
+                    taxa[taxa_id] = taxa_name
+                elif not species and lower_taxa and len(taxa_name.split(' ')) == 1:
+                    taxa[taxa_id] = taxa_name
 
         return taxa
     
+    ''' Returns the parsed rows of every browse page below given taxa ID, as
+        (taxon id, name, has lower taxa) tuples. Each taxon is only fetched once,
+        even when several threads ask for it at the same time
+    '''
+    def browseRows(self, taxonID=None):
+        with self.lock:
+            rows = self.browsed.get(taxonID)
+            owner = rows is None
+            if owner:
+                rows = self.browsed[taxonID] = Future()
+        
+        if owner:
+            try:
+                rows.set_result(self.fetchRows(taxonID))
+            except Exception as e:
+                with self.lock:
+                    del self.browsed[taxonID]
+                rows.set_exception(e)
+        return rows.result()
+    
+    ''' Fetches every browse page below given taxa ID. The page count is read from
+        the pager on the first page and the remaining pages are fetched concurrently
+        on a pool that only lives for this taxon. Pages that link further than the first
+        are followed in turn, and a page without a pager is only followed by probing the next
+        page when it is as full as the first page of a paged listing, or no listing was paged yet
+    '''
+    def fetchRows(self, taxonID=None):
+        first = self.browsePage(taxonID, 1)
+        if first is None:
+            return []
+        
+        rows, pageCount = first
+        pages = {1: rows}
+        if pageCount > 1:
+            self.pageSize = len(rows)
+        
+        number = 1
+        while pageCount == number and (self.pageSize is None or len(pages[number]) >= self.pageSize):
+            page = self.browsePage(taxonID, number + 1)
+            if page is None:
+                break
+            number += 1
+            pages[number], pageCount = page[0], max(number, page[1])
+        
+        requested = set(pages)
+        while True:
+            numbers = [number for number in range(2, pageCount + 1) if number not in requested]
+            if not numbers:
+                break
+            requested.update(numbers)
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(numbers))) as pool:
+                for number, page in zip(numbers, pool.map(lambda number: self.browsePage(taxonID, number), numbers)):
+                    if page is not None:
+                        pages[number] = page[0]
+                        pageCount = max(pageCount, page[1])
+        
+        return [row for number in sorted(pages) for row in pages[number]]
+    
+    ''' Fetches and parses a single browse page, returns its rows and the highest
+        page number linked from its pager, or None past the last page
+    '''
+    def browsePage(self, taxonID, pageNumber):
+        page = httpCache.get(self.home + 'browse.aspx?', 
+                             params={'flora_id': self.floraId, 'page': pageNumber, 'start_taxon_id': taxonID})
+        
+        if page.status_code != 200 or "No taxa found" in page.text:
+            return
+        
+        pageCount = max([pageNumber] + [int(number) for number in re.findall(r'[?&;]page=(\d+)', page.text)])
+        return self.parseRows(page.text), pageCount
+    
+    # Parses taxon id, name and whether it has lower taxa from each row of a browse page
+    def parseRows(self, text):
+        rows = []
+        
+        for item in parseHTML(text).xpath(f"//tr[{hasClass('underline')}]"):
+            id_listing = item.xpath(f".//td[{hasClass('small')}]")
+            
+            if id_listing:
+                taxa_id = id_listing[0].text_content()
+                taxa_name = item.xpath(".//a")[0].text_content()
+                lower_taxa = item.xpath(".//a[@title='lower taxa' or @title='lower taxon']")
+                
+                rows.append((taxa_id, taxa_name, len(lower_taxa) > 0))
+        
+        return rows
+    
     # converts flora names to flora ids on initialization
     def getFloraID(self, flora):
         if type(flora) == int:
@@ -361,8 +1305,9 @@ class Jepson:
         Including higher taxa, name, status, distribution, etc.
     '''
     def taxon(self, tid):
-        r = requests.get(self.home + 'eflora_display.php?', headers=headers, params={'tid': tid})
-        soup = BeautifulSoup(r.text, 'lxml')
+        from bs4 import BeautifulSoup, SoupStrainer
+        r = httpCache.get(self.home + 'eflora_display.php?', params={'tid': tid})
+        soup = BeautifulSoup(r.text, 'lxml', parse_only=SoupStrainer('div', id='content'))
         
         # Identify and store higher taxa and body tables, for later scraping
         content = soup.find('div', {'id': 'content'})
@@ -401,45 +1346,246 @@ class Jepson:
         
         return taxon
 
-# FOLIUM CLASS FOR CREATING MAPS FROM POTWO DISTRIBUTIONS - UNDER CONSTRUCTION
+''' Douglas-Peucker simplification of a ring of lon/lat points, keeping the points that lie further
+    than tolerance degrees from the simplified outline. Works on one span of the ring at a time,
+    measuring all of its points at once, instead of recursing point by point '''
+def simplifyRing(points, tolerance):
+    if len(points) < 4:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, len(points) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+
+        a, b = points[start], points[end]
+        between = points[start + 1:end]
+        dx, dy = b - a
+        norm = np.hypot(dx, dy)
+        if norm == 0:
+            distance = np.hypot(between[:, 0] - a[0], between[:, 1] - a[1])
+        else:
+            distance = np.abs(dx * (between[:, 1] - a[1]) - dy * (between[:, 0] - a[0])) / norm
+
+        furthest = int(distance.argmax())
+        if distance[furthest] > tolerance:
+            keep[start + 1 + furthest] = True
+            spans.append((start, start + 1 + furthest))
+            spans.append((start + 1 + furthest, end))
+    return points[keep]
+
+''' Maps of POTWO distributions over the WGSRPD level 3 regions
+    The level 3 GeoJSON is only parsed and simplified once: the simplified regions are cached next
+    to it and shared by every MapMaker, along with their projections to each map width. Regions are
+    found through a name and code index, and maps are drawn straight to PNG with PIL or written as
+    SVG paths, without a browser. distributionMap still builds a folium map, from the simplified regions
+'''
 class MapMaker:
-    def __init__(self):
+    loaded = {}
+
+    def __init__(self, width=data['distributionMap']['width']):
         self.root = os.getcwd()
         self.level3 = os.path.join(self.root, 'maps', 'wgsrpd', 'level3.geojson')
-        
-        '''
-        self.options = {'format': 'png', 
-                        'height': '1000',
-                        'width': '3000',
-                        'crop-h': '100',
-                        'crop-w': '100',
-                        'crop-x': '50',
-                        'crop-y': '50'}
-        '''
-        
-    ''' Currently the only function of this class. Generates folium map of the 
-        world, applies level 3 WGSRPD region overlay, then changes opacity of
-        regions not in given distribution to 0. Returns processed map.
+        self.directory = os.path.join(self.root, 'maps', 'distributions')
+
+        self.width = width
+        self.tolerance = data['distributionMap']['tolerance']
+        self.colors = data['distributionMap']['colors']
+        self.regions = None
+
+    ''' Loads the simplified regions, from the cache unless the GeoJSON or tolerance changed since it was written.
+        Each region is a list of polygons, each polygon a list of lon/lat rings with its exterior first '''
+    def loadRegions(self):
+        if self.regions is not None:
+            return self.regions
+        if not os.path.exists(self.level3):
+            print('WGSRPD level 3 GeoJSON not found, expected at ' + self.level3)
+            return
+
+        stat = os.stat(self.level3)
+        source = [stat.st_size, stat.st_mtime, self.tolerance]
+        shared = self.loaded.get(self.level3)
+        if shared is None or shared['source'] != source:
+            shared = self.readRegions(source)
+            shared['projections'] = {}
+            shared['index'] = {}
+            for i, (name, code) in enumerate(zip(shared['names'], shared['codes'])):
+                shared['index'][name] = i
+                if code is not None:
+                    shared['index'][code] = i
+            self.loaded[self.level3] = shared
+
+        self.regions = shared
+        return self.regions
+
+    # Reads the simplified regions cache, or simplifies the GeoJSON and writes the cache
+    def readRegions(self, source):
+        cache = self.level3.rsplit('.', 1)[0] + '.simplified.pkl'
+        if os.path.exists(cache):
+            with open(cache, 'rb') as f:
+                regions = pickle.load(f)
+            if regions['source'] == source:
+                return regions
+
+        with open(self.level3, 'r') as f:
+            geojson = json.load(f)
+
+        regions = {'source': source, 'names': [], 'codes': [], 'polygons': []}
+        for feature in geojson['features']:
+            geometry = feature['geometry']
+            if geometry is None:
+                continue
+
+            polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+            regions['names'].append(feature['properties']['LEVEL3_NAM'])
+            regions['codes'].append(feature['properties'].get('LEVEL3_COD'))
+            regions['polygons'].append([[simplifyRing(np.asarray(ring, dtype=np.float64)[:, :2], self.tolerance).astype(np.float32)
+                                         for ring in polygon] for polygon in polygons])
+
+        with open(cache + '.part', 'wb') as f:
+            pickle.dump(regions, f)
+        os.replace(cache + '.part', cache)
+        return regions
+
+    # Positions of the regions of a distribution, matched by level 3 name or code, regions not in WGSRPD are skipped
+    def regionIndices(self, dist):
+        index = self.regions['index']
+        return sorted({index[region] for region in dist or [] if region in index})
+
+    ''' Projects the regions onto an equirectangular map width pixels wide, once per width.
+        Keeps flat pixel coordinates of each ring for PIL, an SVG path for each region,
+        and a base image of all regions with a mask of their borders '''
+    def projection(self, width):
+        if self.loadRegions() is None:
+            return
+        projection = self.regions['projections'].get(width)
+        if projection is not None:
+            return projection
+
+        from PIL import Image, ImageDraw, ImageColor
+        height = width // 2
+        scale = width / 360
+
+        pixels = []
+        paths = []
+        for polygons in self.regions['polygons']:
+            rings = [[np.column_stack(((ring[:, 0] + 180) * scale, (90 - ring[:, 1]) * scale)) for ring in polygon] for polygon in polygons]
+            pixels.append([[ring.ravel().tolist() for ring in polygon] for polygon in rings])
+            d = ''.join('M' + 'L'.join(f'{x:.1f},{y:.1f}' for x, y in ring) + 'Z' for polygon in rings for ring in polygon)
+            paths.append(f'<path d="{d}"/>')
+
+        # Palette image: background, land, border, native
+        palette = [ImageColor.getrgb(self.colors[key]) for key in ('background', 'land', 'border', 'native')]
+        base = Image.new('P', (width, height), 0)
+        base.putpalette([channel for color in palette for channel in color])
+        self.fillRegions(ImageDraw.Draw(base), pixels, range(len(pixels)), 1, 0)
+
+        borders = Image.new('L', (width, height), 0)
+        draw = ImageDraw.Draw(borders)
+        for polygons in pixels:
+            for polygon in polygons:
+                for ring in polygon:
+                    draw.polygon(ring, outline=255)
+
+        projection = {'width': width, 'height': height, 'pixels': pixels, 'paths': paths, 'land': ''.join(paths), 'base': base, 'borders': borders}
+        self.regions['projections'][width] = projection
+        return projection
+
+    ''' Fills the given regions with a palette color and their holes with another. Regions without holes
+        are filled again afterwards, so enclaves sitting in the holes of other regions keep their fill '''
+    def fillRegions(self, draw, pixels, indices, fill, holeFill):
+        for i in indices:
+            for polygon in pixels[i]:
+                draw.polygon(polygon[0], fill=fill)
+                for hole in polygon[1:]:
+                    draw.polygon(hole, fill=holeFill)
+        for i in indices:
+            if all(len(polygon) == 1 for polygon in pixels[i]):
+                for polygon in pixels[i]:
+                    draw.polygon(polygon[0], fill=fill)
+
+    # Draws a distribution onto a copy of the base map, returns the PIL image and saves it when given a path
+    def staticMap(self, dist, path=None, width=None):
+        projection = self.projection(width or self.width)
+        if projection is None:
+            return
+
+        from PIL import ImageDraw
+        image = projection['base'].copy()
+        self.fillRegions(ImageDraw.Draw(image), projection['pixels'], self.regionIndices(dist), 3, 1)
+        image.paste(2, mask=projection['borders'])
+
+        # Fast zlib level, palette maps are mostly flat color and compress well at any level
+        if path is not None:
+            image.save(path, compress_level=1)
+        return image
+
+    # Writes a distribution as an SVG map, native regions drawn over the land from the projected paths, returns the SVG text
+    def svgMap(self, dist, path=None, width=None):
+        projection = self.projection(width or self.width)
+        if projection is None:
+            return
+
+        width, height = projection['width'], projection['height']
+        native = ''.join(projection['paths'][i] for i in self.regionIndices(dist))
+        svg = (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+               f'<rect width="{width}" height="{height}" fill="{self.colors["background"]}"/>'
+               f'<g fill="{self.colors["land"]}" stroke="{self.colors["border"]}" stroke-width="0.5" fill-rule="evenodd">{projection["land"]}</g>'
+               f'<g fill="{self.colors["native"]}" stroke="{self.colors["border"]}" stroke-width="0.5" fill-rule="evenodd">{native}</g></svg>')
+
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(svg)
+        return svg
+
+    ''' Saves maps for many distributions, given as a dictionary of taxa and their lists of regions,
+        in the distributions directory as png or svg. Maps are drawn on a thread pool, PIL releases
+        the GIL while drawing and encoding. Returns a dictionary of taxa and map paths '''
+    def distributionMaps(self, dists, _format='png', width=None, directory=None, workers=data['distributionMap']['workers']):
+        if self.projection(width or self.width) is None:
+            return
+
+        directory = directory or self.directory
+        os.makedirs(directory, exist_ok=True)
+        draw = self.svgMap if _format == 'svg' else self.staticMap
+
+        paths = {taxa: os.path.join(directory, f'{taxa}.{_format}') for taxa in dists}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda taxa: draw(dists[taxa], paths[taxa], width), dists))
+        return paths
+
+    # Simplified regions as a GeoJSON FeatureCollection, built once, for folium
+    def geojson(self):
+        if 'geojson' not in self.regions:
+            features = []
+            for name, code, polygons in zip(self.regions['names'], self.regions['codes'], self.regions['polygons']):
+                geometry = {'type': 'MultiPolygon', 'coordinates': [[ring.tolist() for ring in polygon] for polygon in polygons]}
+                features.append({'type': 'Feature', 'properties': {'LEVEL3_NAM': name, 'LEVEL3_COD': code}, 'geometry': geometry})
+            self.regions['geojson'] = {'type': 'FeatureCollection', 'features': features}
+        return self.regions['geojson']
+
+    ''' Generates folium map of the world, applies level 3 WGSRPD region overlay,
+        then changes opacity of regions not in given distribution to 0. Returns processed map.
+        Use staticMap or svgMap for map images
     '''
     def distributionMap(self, dist):
+        import folium
+        if self.loadRegions() is None:
+            return
+
         m = folium.Map(location=[0, 0], zoom_start=2.4)
-        
-        self.dist = dist
-        folium.GeoJson(self.level3, 
-                       name='WGSRPD Level 3', 
+
+        self.dist = set(dist)
+        folium.GeoJson(self.geojson(),
+                       name='WGSRPD Level 3',
                        style_function=self.dist_function
                       ).add_to(m)
-        
+
         return m
-        
-        ''' Work-In-Progress method of rendering image from map
-        path = os.path.join(self.root, 'temp', 'map.html')
-        m.save(path)
-        
-        img = imgkit.from_file(path, os.path.join(self.root, 'maps', 'map.png'), options=self.options)
-        return img
-        '''
-    
+
     # style function that sets opacity of regions not within
     def dist_function(self, feature):
         if feature['properties']['LEVEL3_NAM'] in self.dist:
@@ -447,4 +1593,4 @@ class MapMaker:
                      'opacity': 1 }
         else:
             return { 'fillOpacity': 0,
-                     'opacity': 0 }
\ No newline at end of file
+                     'opacity': 0 }